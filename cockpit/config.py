@@ -176,6 +176,23 @@ def _default_cockpit_config():
             # 'loadPosition' : '',
             # 'unloadPosition' : '',
         },
+        'saving' : {
+            ## 1 GiB of images waiting to be written to disk.
+            'queue-budget' : '1073741824',
+            'queue-overflow' : 'spill',
+        },
+        'mosaic' : {
+            ## Default temporary directory.
+            'store-dir' : '',
+            ## 512 MiB of tile textures.
+            'texture-budget' : '512',
+            ## 1 GiB of megatile textures.
+            'megatile-budget' : '1024',
+            ## No autosave.
+            'autosave-dir' : '',
+            ## Image one tile at a time.
+            'hardware-spiral' : 'no',
+        },
     }
     return default
 
@@ -227,12 +227,20 @@ class LegacyDSP(ExecutorDevice):
         self._lastAnalogs = 4*[0]
         # Store last movement profile for debugging
         self._lastProfile = None
+        # Last movement profile that the DSP holds, or None if unknown.
+        self._uploadedProfile = None
 
     def finalizeInitialization(self):
         super(LegacyDSP, self).finalizeInitialization()
         for line in range(4):
             self.setAnalog(line, 65536//2)
 
+    ## User clicked the abort button.  The DSP may no longer hold the last
+    # profile.
+    def onAbort(self):
+        self._uploadedProfile = None
+        super(LegacyDSP, self).onAbort()
+
     def onPrepareForExperiment(self, *args):
         super(self.__class__, self).onPrepareForExperiment(*args)
         self._lastAnalogs = [line for line in self._currentAnalogs]
@@ -292,108 +300,103 @@ class LegacyDSP(ExecutorDevice):
         #  - separate analogue and digital events into different lists;
         #  - generate a structure that describes the profile.
 
-        actions = actions_from_table(table, startIndex, stopIndex, repDuration)
-
-        # Profiles
-        analogs = [ [], [], [], [] ] # A list of lists (one per channel) of tuples (ticks, (analog values))
-        digitals = [] # A list of tuples (ticks, digital state)
-        # Need to track time of last analog events to workaround a
-        # DSP bug later. Also used to detect when events exceed timing
-        # resolution
-        tLastA = None
-
+        profile = profile_from_table(table, startIndex, stopIndex, repDuration)
 
         # The DSP executes an analogue movement profile, which is defined using
         # offsets relative to a baseline at the time the profile was initialized.
         # These offsets are encoded as unsigned integers, so at profile
         # intialization, each analogue channel must be at or below the lowest
         # value it needs to reach in the profile.
-        lowestAnalogs = list(np.amin([x[1][1] for x in actions], axis=0))
+        lowestAnalogs = profile.analogs.min(axis=0).tolist()
         for line, lowest in enumerate(lowestAnalogs):
             if lowest < self._lastAnalogs[line]:
                 self._lastAnalogs[line] = lowest
                 self.setAnalog(line, lowest)
 
-        for (t, (darg, aargs)) in actions:
-            # Convert t to ticks as int while rounding up. The rounding is
-            # necessary, otherwise e.g. 10.1 and 10.1999999... both result in 101.
-            ticks = int(float(t) * self.tickrate + 0.5)
-
-            # Digital actions - one at every time point.
-            if len(digitals) == 0:
-                digitals.append((ticks, darg))
-            elif ticks == digitals[-1][0]:
-                # Used to check for conflicts here, but that's not so trivial.
-                # We need to allow several bits to change at the same time point, but
-                # they may show up as multiple events in the actionTable. For now, just
-                # take the most recent state.
-                if darg != digitals[-1][1]:
-                    digitals[-1] = (ticks, darg)
-                else:
-                    pass
-            else:
-                digitals.append((ticks, darg))
-
-            # Analogue actions - only enter into profile on change.
-            # DSP uses offsets from value when the profile was loaded.
-            offsets = map(lambda base, new: new - base, self._lastAnalogs, aargs)
-            for offset, a in zip(offsets, analogs):
-                if ( (len(a) == 0 ) or (len(a) > 0 and offset != a[-1][1])):
-                    a.append((ticks, offset))
-                    tLastA = t
+        # Digital actions - one at every tick, with the most recent state
+        # of those that fall on the same tick.  Converting to ticks rounds
+        # to nearest, otherwise e.g. 10.1 and 10.1999999... both result
+        # in 101.
+        dticks, dstates = profile.getDigitalEvents(self.tickrate)
+        # Analogue actions - only enter into profile on change.
+        # DSP uses offsets from value when the profile was loaded.
+        analogs = []
+        for line, base in enumerate(self._lastAnalogs):
+            aticks, levels = profile.getAnalogEvents(self.tickrate, line)
+            analogs.append((aticks, levels - base))
 
         # Work around some DSP bugs:
         # * The action table needs at least two events to execute correctly.
         # * Last action must be digital --- if the last analog action is at the same
         #   time or after the last digital action, it will not be performed.
         # Both can be avoided by adding a digital action that does nothing.
-        if len(digitals) == 1 or tLastA >= digitals[-1][0]:
+        tLastA = max(aticks[-1] for aticks, offsets in analogs)
+        if len(dticks) == 1 or tLastA >= dticks[-1]:
             # Just duplicate the last digital action, one tick later.
-            digitals.append( (digitals[-1][0]+1, digitals[-1][1]) )
+            dticks = np.append(dticks, dticks[-1] + 1)
+            dstates = np.append(dstates, dstates[-1])
 
         # Update records of last positions.
-        self._lastDigital = digitals[-1][1]
-        self._lastAnalogs = list(map(lambda x, y: x - (y[-1:][1:] or 0), self._lastAnalogs, analogs))
+        self._lastDigital = int(dstates[-1])
 
         events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
                        'Waiting for\nDSP to finish', (255, 255, 0))
         # Convert digitals to array of uints.
-        digitalsArr = np.array(digitals, dtype=np.uint32).reshape(-1,2)
+        digitalsArr = np.column_stack((dticks, dstates)).astype(np.uint32)
         # Convert analogs to array of uints.
-        analogsArr = [np.array(a, dtype=np.uint32).reshape(-1, 2) for a in analogs]
+        analogsArr = [np.column_stack(a).astype(np.uint32) for a in analogs]
 
 
         # Create a description dict. Will be byte-packed by server-side code.
-        maxticks = max(chain([d[0] for d in digitals],
-                             [a[0] for a in chain.from_iterable(analogs)]))
+        maxticks = int(max(chain([dticks[-1]],
+                                 [aticks[-1] for aticks, offsets in analogs])))
         description = {}
         description['count'] = maxticks
         description['clock'] = 1000. / float(self.tickrate)
         description['InitDio'] = self._lastDigital
-        description['nDigital'] = len(digitals)
-        description['nAnalog'] = [len(a) for a in analogs]
+        description['nDigital'] = len(dticks)
+        description['nAnalog'] = [len(aticks) for aticks, offsets in analogs]
 
         self._lastProfile = (description, digitalsArr, analogsArr)
 
-        self.connection.profileSet(description, digitalsArr, *analogsArr)
-        self.connection.DownloadProfile()
+        # The DSP keeps the last profile it was sent, so it need not be
+        # sent again if it has not changed, e.g. when the same experiment
+        # is rerun.
+        if not self._isUploaded(self._lastProfile):
+            self._uploadedProfile = None
+            self.connection.profileSet(description, digitalsArr, *analogsArr)
+            self.connection.DownloadProfile()
+            self._uploadedProfile = self._lastProfile
         self.connection.InitProfile(numReps)
         events.executeAndWaitFor(events.EXECUTOR_DONE % self.name, self.connection.trigCollect)
         events.publish(events.EXPERIMENT_EXECUTION)
 
 
+    ## Return whether the DSP already holds profile, a (description,
+    # digitals, analogs) tuple.
+    def _isUploaded(self, profile):
+        if self._uploadedProfile is None:
+            return False
+        description, digitalsArr, analogsArr = profile
+        lastDescription, lastDigitalsArr, lastAnalogsArr = self._uploadedProfile
+        return (description == lastDescription
+                and np.array_equal(digitalsArr, lastDigitalsArr)
+                and len(analogsArr) == len(lastAnalogsArr)
+                and all(np.array_equal(a, b)
+                        for a, b in zip(analogsArr, lastAnalogsArr)))
+
+
+def profile_from_table(table, startIndex, stopIndex, repDuration):
+    ## Take the states from startIndex up to stopIndex of an
+    ## ExecutorProfile, or of a list of (time, (digital, analogs))
+    ## actions, with times relative to the first of them.  If there are
+    ## repeats, add an extra action to wait until repDuration expired.
+    if not isinstance(table, cockpit.handlers.executor.ExecutorProfile):
+        table = cockpit.handlers.executor.ExecutorProfile.fromActions(table)
+    return table.rebase(startIndex, stopIndex, repDuration)
+
+
 def actions_from_table(table, startIndex, stopIndex, repDuration):
     ## Take time and arguments (i.e. omit handler) from table to
     ## generate actions.
-    t0 = float(table[startIndex][0])
-    actions = [(float(row[0])-t0,) + tuple(row[1:])
-               for row in table[startIndex:stopIndex]]
-
-    ## If there are repeats, add an extra action to wait until
-    ## repDuration expired.
-    if repDuration is not None:
-        repDuration = float(repDuration)
-        if actions[-1][0] < repDuration:
-            ## Repeat the last event at t0 + repDuration
-            actions.append((t0+repDuration,) + tuple(actions[-1][1:]))
-    return actions
+    return profile_from_table(table, startIndex, stopIndex, repDuration)[:]
@@ -70,13 +70,29 @@ FPGA_IDLE_STATE = 3
 FPGA_ABORTED_STATE = 4
 FPGA_HEARTBEAT_RATE = .1  # At which rate is the FPGA sending update status signals
 MASTER_IP = '10.6.19.11'
+# Encodings of the tables sent to the RT-ipAddress. Each table entry is a
+# (ticks, value) pair of 32 bit unsigned integers, sent either as the
+# decimal string of the 64 bit integer (ticks << 32 | value), or packed
+# as two big-endian 32 bit integers, i.e. the same 64 bit integer in
+# binary.
+TABLE_ENCODING_DECIMAL = 'decimal'
+TABLE_ENCODING_BINARY = 'binary'
+# Number of bytes of packed tables to send at a time, between reports of
+# the progress of the upload.
+TABLE_CHUNK_SIZE = 2 ** 16
 
 
 class NIcRIO(executorDevices.ExecutorDevice):
+    # Config options:
+    #   ipaddress, sendport, receiveport -- of the RT-ipAddress
+    #   tableencoding -- how to upload tables, 'binary' for RT software that
+    #       accepts packed tables, or 'decimal' (the default) for decimal
+    #       strings, which all RT software accepts.
     _config_types = {
         'ipaddress': str,
         'sendport': int,
         'receiveport': int,
+        'tableencoding': str,
     }
 
     def __init__(self, name, config):
@@ -100,7 +116,8 @@ class NIcRIO(executorDevices.ExecutorDevice):
     def initialize(self):
         """Connect to ni's RT-ipAddress computer. Overrides ExecutorDevice's initialize.
         """
-        self.connection = Connection(parent=self, ipAddress=self.ipAddress, port=self.port, localIp=MASTER_IP)
+        self.connection = Connection(parent=self, ipAddress=self.ipAddress, port=self.port, localIp=MASTER_IP,
+                                     tableEncoding=self.config.get('tableencoding', TABLE_ENCODING_DECIMAL))
         self.connection.connect()
         self.connection.Abort()
 
@@ -167,65 +184,61 @@ class NIcRIO(executorDevices.ExecutorDevice):
         - separate analogue and digital events into different lists
         - generate a structure that describes the profile
         """
-        # Profiles
-        analogs = [[] for x in range(self.nrAnalogLines)]  # A list of lists (one per channel) of tuples (ticks, (analog values))
-        digitals = list()  # A list of tuples (ticks, digital state)
-        # # Need to track time of last analog events
-        # t_last_analog = None
-
-        for t, (digital_args, analog_args) in actions:
-            # Convert t to ticks as int while rounding up. The rounding is
-            # necessary, otherwise e.g. 10.1 and 10.1999999... both result in 101.
-            ticks = int(float(t) * self.tickrate + 0.5)
-
-            # Digital actions - one at every time point.
-            if len(digitals) == 0:
-                digitals.append((ticks, digital_args))
-            elif ticks == digitals[-1][0]:  # TODO: verify if we need this for the FPGA
-                # Used to check for conflicts here, but that's not so trivial.
-                # We need to allow several bits to change at the same time point, but
-                # they may show up as multiple events in the actionTable. For now, just
-                # take the most recent state.
-                if digital_args != digitals[-1][1]:
-                    digitals[-1] = (ticks, digital_args)
-                else:
-                    pass
-            else:
-                digitals.append((ticks, digital_args))
-
-            # Analogue actions - only enter into profile on change.
-            # NI-cRIO uses absolute values.
-            for analog, analog_arg in zip(analogs, analog_args):
-                if len(analog) == 0:  # analogs list is empty
-                    analog.append((ticks, analog_arg))
-                elif analog[-1][1] != analog_arg:
-                    analog.append((ticks, analog_arg))
-                else:
-                    pass
+        if not isinstance(actions, cockpit.handlers.executor.ExecutorProfile):
+            actions = cockpit.handlers.executor.ExecutorProfile.fromActions(actions)
+        # Digital actions - one at every tick, with the most recent state
+        # of those that fall on the same tick.  Converting to ticks rounds
+        # to nearest, otherwise e.g. 10.1 and 10.1999999... both result
+        # in 101.
+        dticks, dstates = actions.getDigitalEvents(self.tickrate)
+        # Analogue actions - only enter into profile on change.
+        # NI-cRIO uses absolute values.
+        analogs = [actions.getAnalogEvents(self.tickrate, line)
+                   for line in range(self.nrAnalogLines)]
 
         # Update records of last positions.
-        self._lastDigital = digitals[-1][1]
-        self._lastAnalogs = map(lambda x, y: x - (y[-1:][1:] or 0), self._lastAnalogs, analogs)
+        self._lastDigital = int(dstates[-1])
 
         # Convert digitals to array of uints.
-        digitalsArr = np.array(digitals, dtype=np.uint32).reshape(-1, 2)
+        digitalsArr = np.column_stack((dticks, dstates)).astype(np.uint32)
         # Convert analogs to array of uints.
-        analogsArr = [np.array(a, dtype=np.uint32).reshape(-1, 2) for a in analogs]
+        analogsArr = [np.column_stack(a).astype(np.uint32) for a in analogs]
 
         # Create a description dict. Will be byte-packed by server-side code.
-        maxticks = max(chain([d[0] for d in digitals],
-                             [a[0] for a in chain.from_iterable(analogs)]))
+        maxticks = int(max(chain([dticks[-1]],
+                                 [aticks[-1] for aticks, levels in analogs])))
 
         description = {'count': maxticks,
                        'clock': 1000. / float(self.tickrate),
                        'InitDio': self._lastDigital,
-                       'nDigital': len(digitals),
-                       'nAnalog': [len(a) for a in analogs]}
+                       'nDigital': len(dticks),
+                       'nAnalog': [len(aticks) for aticks, levels in analogs]}
 
         self._lastProfile = (description, digitalsArr, analogsArr)
 
         return [description, digitalsArr, [*analogsArr]]
 
+    def executeTable(self, table, startIndex, stopIndex, numReps, repDuration):
+        """Execute the events in an experiment ActionTable, starting at startIndex
+        and proceeding up to but not through stopIndex.
+
+        Overrides ExecutorDevice's executeTable, to upload the tables adapted to the cRIO.
+        """
+        profile = executorDevices.profile_from_table(table, startIndex, stopIndex, repDuration)
+        actions = self._adaptActions(profile)
+
+        events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
+                       'Waiting for\nFPGA to finish', (255, 255, 0))
+        self.connection.PrepareActions(actions, numReps, progressCallback=self.onUploadProgress)
+        events.executeAndWaitFor(events.EXECUTOR_DONE % self.name, self.connection.RunActions)
+        events.publish(events.EXPERIMENT_EXECUTION)
+
+    def onUploadProgress(self, numBytesSent, numBytes):
+        """Show the progress of uploading tables to the cRIO"""
+        events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
+                       'Uploading to FPGA\n%d%%' % (100 * numBytesSent // max(1, numBytes)),
+                       (255, 255, 0))
+
     @cockpit.util.threads.locked
     def runSequence(self, sequence):
         """Runs a sequence of times-digital pairs"""
@@ -260,8 +273,12 @@ class NIcRIO(executorDevices.ExecutorDevice):
 
 class Connection:
     """This class handles the connection with NI's RT-ipAddress computer."""
-    def __init__(self, parent, ipAddress, port, localIp):
+    def __init__(self, parent, ipAddress, port, localIp, tableEncoding=TABLE_ENCODING_DECIMAL):
+        if tableEncoding not in (TABLE_ENCODING_DECIMAL, TABLE_ENCODING_BINARY):
+            raise ValueError('Unknown table encoding: %s' % tableEncoding)
         self.parent = parent
+        # How to encode tables sent to the RT-ipAddress
+        self.tableEncoding = tableEncoding
         self.ipAddress = ipAddress
         self.port = port
         # Local IP address to use for communication, in the event that this
@@ -377,13 +394,7 @@ class Connection:
                           'Message Length': msgLength,
                           'Number of Messages': len(sendArgs)
                           }
-
-        try:
-            # Send the actual command
-            self.connection.send(json.dumps(messageCluster).encode())
-            self.connection.send(b'\r\n')
-        except socket.error as msg:
-            print('Send messageCluster failed.\n', msg)
+        self._sendMessageCluster(messageCluster)
 
         try:
             # Send the actual messages buffer
@@ -392,6 +403,51 @@ class Connection:
         except socket.error as msg:
             print('Send buffer failed.\n', msg)
 
+        self._receiveConfirmation()
+
+    def runBinaryCommand(self, command, table, progressCallback=None):
+        """This method sends to the RT-ipAddress a Json command message with a table
+        of (ticks, value) pairs packed in binary, in the same way as runCommand, but:
+        - the messages are the 8 bytes of each pair, as two big-endian 32bit integers
+        - the message cluster has an 'Encoding' of 'binary'
+
+        table is an array of shape (n, 2) of integers that fit in 32bits unsigned
+
+        progressCallback, if given, is called with the number of bytes sent so far
+        and the total number of bytes, after every chunk of TABLE_CHUNK_SIZE bytes.
+        """
+        buf = memoryview(packTable(table))
+
+        messageCluster = {'Command': command,
+                          'Message Length': 8,
+                          'Number of Messages': len(buf) // 8,
+                          'Encoding': TABLE_ENCODING_BINARY
+                          }
+        self._sendMessageCluster(messageCluster)
+
+        try:
+            # Send the packed table a chunk at a time
+            for start in range(0, len(buf), TABLE_CHUNK_SIZE):
+                chunk = buf[start:start + TABLE_CHUNK_SIZE]
+                self.connection.sendall(chunk)
+                if progressCallback is not None:
+                    progressCallback(start + len(chunk), len(buf))
+        except socket.error as msg:
+            print('Send buffer failed.\n', msg)
+
+        self._receiveConfirmation()
+
+    def _sendMessageCluster(self, messageCluster):
+        """Sends a message cluster, which describes a command and the messages to follow"""
+        try:
+            # Send the actual command
+            self.connection.send(json.dumps(messageCluster).encode())
+            self.connection.send(b'\r\n')
+        except socket.error as msg:
+            print('Send messageCluster failed.\n', msg)
+
+    def _receiveConfirmation(self):
+        """Receives the acknowledgement of a command, and prints any error"""
         try:
             # receive confirmation error
             # errorLength = int(self.connection.recv(4).decode())
@@ -449,38 +505,40 @@ class Connection:
 
         self.runCommand(self.commandDict['updateNrReps'], newCount, msgLength)
 
-    def sendTables(self, digitalsTable, analogueTables, msgLength=20, digitalsBitDepth=32, analoguesBitDepth=16):
+    def sendTables(self, digitalsTable, analogueTables, msgLength=20, digitalsBitDepth=32, analoguesBitDepth=16,
+                   progressCallback=None):
         """Sends through TCP the digitals and analogue tables to the RT-ipAddress.
 
         Analogues lists must be ordered form 0 onward and without gaps. That is,
         (0), (0,1), (0,1,2) or (0,1,2,3). If a table is missing a dummy table must be introduced
         msgLength is an int indicating the length of every digital table element as a decimal string
-        """
-        # Convert the digitals numpy table into a list of messages for the TCP
-        digitalsList = list()
+        progressCallback, if given, is called with the number of bytes sent so far and
+        the total number of bytes of all the tables.
 
-        for t, value in digitalsTable:  # TODO: Change this into a more efficient code
-            digitalsValue = int(np.binary_repr(t, 32) + np.binary_repr(value, 32), 2)
-            digitalsList.append(digitalsValue)
+        Tables are sent with the encoding of this connection. Binary tables are sent
+        as one buffer each; decimal tables as one decimal string of msgLength
+        characters per element.
+        """
+        tables = [digitalsTable] + list(analogueTables)
+        commands = [self.commandDict['sendDigitals']]
+        commands += [int(self.commandDict['sendAnalogues']) + channel for channel in range(len(analogueTables))]
 
         # Send digitals after flushing the FPGA FIFOs
         self.runCommand(self.commandDict['flushFIFOs'])
-        self.runCommand(self.commandDict['sendDigitals'], digitalsList, msgLength)
-
-        # Send Analogues
-        analogueChannel = 0
-        for analogueTable in analogueTables:
-
-            # Convert the analogues numpy table into a list of messages for the TCP
-            analogueList = list()
-
-            for t, value in analogueTable:  # TODO: optimize this
-                analogueValue = int(np.binary_repr(t, 32) + np.binary_repr(value, 32), 2)
-                analogueList.append(analogueValue)
 
-            command = int(self.commandDict['sendAnalogues']) + analogueChannel
-            self.runCommand(command, analogueList, msgLength)
-            analogueChannel = analogueChannel + 1
+        if self.tableEncoding == TABLE_ENCODING_BINARY:
+            numBytes = sum(8 * len(table) for table in tables)
+            numBytesSent = 0
+            for command, table in zip(commands, tables):
+                tableProgress = None
+                if progressCallback is not None:
+                    tableProgress = lambda sent, total: progressCallback(numBytesSent + sent, numBytes)
+                self.runBinaryCommand(command, table, tableProgress)
+                numBytesSent += 8 * len(table)
+        else:
+            for command, table in zip(commands, tables):
+                # Convert the numpy table into a list of messages for the TCP
+                self.runCommand(command, joinTable(table).tolist(), msgLength)
 
     def writeIndexes(self, indexSet, digitalsStartIndex, digitalsStopIndex, analoguesStartIndexes, analoguesStopIndexes,
                      msgLength=20):
@@ -515,11 +573,12 @@ class Connection:
         # send indexes.
         self.runCommand(self.commandDict['sendStartStopIndexes'], sendList, msgLength)
 
-    def PrepareActions(self, actions, numReps):
+    def PrepareActions(self, actions, numReps, progressCallback=None):
         """Sends a actions table to the cRIO and programs the execution of a number of repetitions.
         It does not trigger the execution"""
         # We upload the tables to the cRIO
-        self.sendTables(digitalsTable=actions[1], analogueTables=actions[2])
+        self.sendTables(digitalsTable=actions[1], analogueTables=actions[2],
+                        progressCallback=progressCallback)
 
         # Now we can send the Indexes.
         # The indexes will tell the FPGA where the table starts and ends.
@@ -655,6 +714,19 @@ class Connection:
         self.runCommand(self.commandDict['runSequence'], sendList, msgLength)
 
 
+def packTable(table):
+    """Packs a table of (ticks, value) pairs into bytes, as two big-endian
+    32 bit unsigned integers per pair."""
+    return np.ascontiguousarray(table, dtype='>u4').reshape(-1, 2).tobytes()
+
+
+def joinTable(table):
+    """Joins each (ticks, value) pair of a table into a 64 bit unsigned integer
+    (ticks << 32 | value), and returns an array of them."""
+    table = np.asarray(table, dtype=np.uint32).reshape(-1, 2).astype(np.uint64)
+    return (table[:, 0] << np.uint64(32)) | table[:, 1]
+
+
 class FPGAStatus(threading.Thread):
     def __init__(self, parent, host, port):
         threading.Thread.__init__(self)
@@ -50,10 +50,12 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
+import collections
 from itertools import chain
 import re
 import sys
 import threading
+import time
 import traceback
 
 ## This module handles the event-passing system between the UI and the 
@@ -81,7 +83,21 @@ EXECUTOR_DONE = 'executor done %s' # must be sufficed with device/handler name
 VIDEO_MODE_TOGGLE = 'video mode toggle'
 ## TODO - make changes throughout to use the string variables defined above.
 
-## Maps event types to lists of callers for when those events occur.
+## Delivery policies for subscribers, see subscribe.
+# Call the subscriber on the publisher's thread, before publish returns.
+DELIVER_SYNC = 'sync'
+# Queue every event for the subscriber, which is called on a worker
+# thread of its own, in the order the events were published.
+DELIVER_QUEUED = 'queued'
+# As DELIVER_QUEUED, but only keep the latest of the events waiting to be
+# delivered, e.g. for displays that only need the newest image.
+DELIVER_LATEST = 'latest'
+DELIVERY_POLICIES = (DELIVER_SYNC, DELIVER_QUEUED, DELIVER_LATEST)
+
+## Maps event types to tuples of callers for when those events occur.
+# The tuples are replaced, never modified, so publish can iterate over
+# them without holding subscriberLock while subscribers are added and
+# removed.
 eventToSubscriberMap = {} # type: Dict[str, Sequence[Callable[..., None]]]
 
 ## As eventToSubscriberMap, except that these subscribers only care about the
@@ -91,16 +107,146 @@ eventToOneShotSubscribers = {}
 ## Lock around the above two dicts.
 subscriberLock = threading.Lock()
 
+## Maps event types to their DispatchStats, while measuring latency.
+eventToDispatchStats = {}
+
+## Whether to measure dispatch latency, see measureLatency.
+_shouldMeasureLatency = False
+
+
+## Statistics of the delivery of one type of event to its subscribers.
+# Latency is the time from publishing an event to a subscriber returning
+# from handling it.  It includes the wait before the subscriber is called,
+# which is spent on earlier subscribers and, for queued subscribers, in
+# the queue.  Times are in seconds.
+class DispatchStats:
+    def __init__(self):
+        ## Number of deliveries to subscribers.
+        self.count = 0
+        self.totalLatency = 0.
+        self.maxLatency = 0.
+        self.totalWait = 0.
+        self.maxWait = 0.
+        ## Number of events that DELIVER_LATEST subscribers never got,
+        # because a later event replaced them.
+        self.numCoalesced = 0
+        self.lock = threading.Lock()
+
+    def addDelivery(self, wait, latency):
+        with self.lock:
+            self.count += 1
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+
+    def addCoalesced(self):
+        with self.lock:
+            self.numCoalesced += 1
+
+    def getMeanLatency(self):
+        if not self.count:
+            return 0.
+        return self.totalLatency / self.count
+
+
+## Start, or stop, measuring the latency of delivering events.  Starting
+# clears any previous measurements.
+def measureLatency(shouldMeasure=True):
+    global _shouldMeasureLatency
+    with subscriberLock:
+        if shouldMeasure:
+            eventToDispatchStats.clear()
+        _shouldMeasureLatency = shouldMeasure
+
+
+## Return the DispatchStats of the specified event type, or None if it has
+# not been delivered while measuring latency.
+def getDispatchStats(eventType):
+    return eventToDispatchStats.get(eventType)
+
+
+## Return the DispatchStats for eventType, creating them if needed.
+def _getOrCreateDispatchStats(eventType):
+    stats = eventToDispatchStats.get(eventType)
+    if stats is None:
+        with subscriberLock:
+            stats = eventToDispatchStats.setdefault(eventType, DispatchStats())
+    return stats
+
+
+## Call subscribeFunc with the arguments of an event published at
+# publishTime, reporting any exception, and measuring the latency if
+# needed.
+def _deliver(eventType, subscribeFunc, publishTime, args, kwargs):
+    startTime = time.perf_counter() if publishTime is not None else None
+    try:
+        subscribeFunc(*args, **kwargs)
+    except:
+        sys.stderr.write('Error in subscribed func %s.%s().  %s'
+                         % (subscribeFunc.__module__,
+                            subscribeFunc.__name__,
+                            traceback.format_exc()))
+    if publishTime is not None and _shouldMeasureLatency:
+        _getOrCreateDispatchStats(eventType).addDelivery(
+            startTime - publishTime, time.perf_counter() - publishTime)
+
+
+## A subscriber that is called on a worker thread of its own.  Calling it
+# queues the event, and returns immediately.
+class QueuedSubscriber:
+    def __init__(self, eventType, func, policy):
+        self.eventType = eventType
+        self.func = func
+        self.policy = policy
+        ## Events waiting to be delivered, as (publish time, args, kwargs).
+        # Only the latest is kept for DELIVER_LATEST.
+        maxlen = 1 if policy == DELIVER_LATEST else None
+        self.pending = collections.deque(maxlen=maxlen)
+        self.condition = threading.Condition()
+        self.shouldRun = True
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='Events-%s' % eventType)
+        self.thread.start()
+
+    def __call__(self, *args, **kwargs):
+        publishTime = time.perf_counter() if _shouldMeasureLatency else None
+        with self.condition:
+            if len(self.pending) == self.pending.maxlen:
+                if _shouldMeasureLatency:
+                    _getOrCreateDispatchStats(self.eventType).addCoalesced()
+            self.pending.append((publishTime, args, kwargs))
+            self.condition.notify()
+
+    ## Stop delivering events.  Events not yet delivered are discarded.
+    def stop(self):
+        with self.condition:
+            self.shouldRun = False
+            self.pending.clear()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.shouldRun and not self.pending:
+                    self.condition.wait()
+                if not self.shouldRun:
+                    return
+                publishTime, args, kwargs = self.pending.popleft()
+            _deliver(self.eventType, self.func, publishTime, args, kwargs)
+
+
 ## Pass the given event to all subscribers.
 def publish(eventType, *args, **kwargs):
-    for subscribeFunc in eventToSubscriberMap.get(eventType, []):
-        try:
+    # No need for the lock: subscribe and unsubscribe replace the tuple
+    # of subscribers rather than modify it.
+    subscribers = eventToSubscriberMap.get(eventType, ())
+    publishTime = time.perf_counter() if _shouldMeasureLatency else None
+    for subscribeFunc in subscribers:
+        if isinstance(subscribeFunc, QueuedSubscriber):
             subscribeFunc(*args, **kwargs)
-        except:
-            sys.stderr.write('Error in subscribed func %s.%s().  %s'
-                             % (subscribeFunc.__module__,
-                                subscribeFunc.__name__,
-                                traceback.format_exc()))
+        else:
+            _deliver(eventType, subscribeFunc, publishTime, args, kwargs)
 
 
     while True:
@@ -119,11 +265,16 @@ def publish(eventType, *args, **kwargs):
 
 
 ## Add a new function to the list of those to call when the event occurs.
-def subscribe(eventType, func):
+# \param policy How to deliver events to func: one of DELIVER_SYNC (the
+#        default), DELIVER_QUEUED and DELIVER_LATEST.
+def subscribe(eventType, func, policy=DELIVER_SYNC):
+    if policy not in DELIVERY_POLICIES:
+        raise ValueError("unknown delivery policy '%s'" % policy)
+    if policy != DELIVER_SYNC:
+        func = QueuedSubscriber(eventType, func, policy)
     with subscriberLock:
-        if eventType not in eventToSubscriberMap:
-            eventToSubscriberMap[eventType] = []
-        eventToSubscriberMap[eventType].append(func)
+        eventToSubscriberMap[eventType] = (eventToSubscriberMap.get(eventType, ())
+                                           + (func,))
 
 
 ## Add a new function to do a one-shot subscription.
@@ -137,10 +288,17 @@ def oneShotSubscribe(eventType, func):
 ## Remove a function from the list of subscribers.
 def unsubscribe(eventType, func):
     with subscriberLock:
-        curSubscribers = eventToSubscriberMap.get(eventType, [])
+        curSubscribers = eventToSubscriberMap.get(eventType, ())
         for i, subscriberFunc in enumerate(curSubscribers):
-            if func == subscriberFunc:
-                del curSubscribers[i]
+            if isinstance(subscriberFunc, QueuedSubscriber):
+                isMatch = func == subscriberFunc.func
+            else:
+                isMatch = func == subscriberFunc
+            if isMatch:
+                eventToSubscriberMap[eventType] = (curSubscribers[:i]
+                                                   + curSubscribers[i+1:])
+                if isinstance(subscriberFunc, QueuedSubscriber):
+                    subscriberFunc.stop()
                 return
 
 
@@ -50,28 +50,206 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
+import bisect
 import decimal
 
+import numpy
+
 ## This class represents the actions performed during an experiment.
 # Each action has a timestamp and the parameters for the action to be performed.
+#
+# Actions are stored in columns rather than as a list of tuples, so that
+# sorting, shifting and searching the table are done by numpy instead of
+# by Python loops: an array of integer tick times, in units of
+# 1/ticksPerMs milliseconds, an array of indices into the list of
+# handlers used in the table, and a list of parameters.  The times as
+# they were given are also kept in a list, so that reading an action back
+# gives the exact time it was added with; the ticks are only used for
+# ordering and searching.  Deleted actions (see clearBadEntries) have a
+# handler index of -1.
 class ActionTable:
     toggleTime = decimal.Decimal('.1')
+    ## Resolution of the tick times: nanoseconds.  Times are truncated to
+    # ticks, and actions closer in time than a tick are kept in the order
+    # they were added in when sorting.
+    ticksPerMs = 10 ** 6
 
     def __init__(self):
-        ## List of (time, handler, parameter) tuples indicating what actions
-        # must be taken at what times.
-        self.actions = []
+        ## Columns of the table.  The arrays are preallocated and grown
+        # as needed.  Building a table is mostly adding one action after
+        # another, and setting array items one at a time is slow, so new
+        # ticks and handler indices go to the pending lists first, and
+        # are only moved to the arrays by _flush when the arrays are
+        # needed.
+        self._ticks = numpy.zeros(64, dtype=numpy.int64)
+        self._handlerIndices = numpy.zeros(64, dtype=numpy.int32)
+        self._pendingTicks = []
+        self._pendingHandlerIndices = []
+        self._times = []
+        self._parameters = []
+        ## List of the distinct handlers in the table, in order of first
+        # use, and map of their ids to their index in that list.  Handlers
+        # are not necessarily hashable, hence the ids.
+        self._handlers = []
+        self._handlerToIndex = {}
+        ## Index of the rows of each handler, so that finding a handler's
+        # actions does not mean searching the whole table.  Lists, by
+        # handler index, of lists of the rows for that handler in table
+        # order, and of lists of the ticks of those rows.  addAction keeps
+        # these up to date; anything else that reorders, deletes or
+        # retimes rows sets them to None, and they are rebuilt when next
+        # needed.
+        self._handlerRows = []
+        self._handlerTicks = []
+        ## Set of handler indices whose ticks are not in ascending order
+        # in self._handlerTicks, and so cannot be bisected.
+        self._unorderedHandlers = set()
         ## Time of our first action.
         # \todo How do we handle the removal of actions rendering this invalid?
         # For now, we don't.
         self.firstActionTime = None
         ## Time of our last action.
         self.lastActionTime = None
-    
 
-    ## Insert an element into self.actions.
+
+    ## Convert a time in milliseconds to integer ticks.
+    def timeToTicks(self, time):
+        return int(time * self.ticksPerMs)
+
+
+    ## Add a handler to the table, and return its index.
+    def _addHandler(self, handler):
+        index = len(self._handlers)
+        self._handlers.append(handler)
+        self._handlerToIndex[id(handler)] = index
+        if self._handlerRows is not None:
+            self._handlerRows.append([])
+            self._handlerTicks.append([])
+        return index
+
+
+    ## Return the index of handler in self._handlers, adding it if needed.
+    def _getHandlerIndex(self, handler):
+        index = self._handlerToIndex.get(id(handler))
+        if index is None:
+            index = self._addHandler(handler)
+        return index
+
+
+    ## Move pending ticks and handler indices to their arrays, and return
+    # views of the valid part of those arrays.
+    def _flush(self):
+        n = len(self._times)
+        if self._pendingTicks:
+            start = n - len(self._pendingTicks)
+            if n > len(self._ticks):
+                capacity = max(n, 2 * len(self._ticks))
+                for name in ('_ticks', '_handlerIndices'):
+                    column = getattr(self, name)
+                    newColumn = numpy.empty(capacity, dtype=column.dtype)
+                    newColumn[:start] = column[:start]
+                    setattr(self, name, newColumn)
+            self._ticks[start:n] = self._pendingTicks
+            self._handlerIndices[start:n] = self._pendingHandlerIndices
+            self._pendingTicks = []
+            self._pendingHandlerIndices = []
+        return self._ticks[:n], self._handlerIndices[:n]
+
+
+    ## Mark the per-handler index as needing to be rebuilt.
+    def _invalidateHandlerIndex(self):
+        self._handlerRows = None
+        self._handlerTicks = None
+
+
+    ## Rebuild the per-handler index, if needed.
+    def _updateHandlerIndex(self):
+        if self._handlerRows is not None:
+            return
+        allTicks, handlerIndices = self._flush()
+        # A stable sort, so that each handler's rows stay in table order.
+        # Deleted rows, with a handler index of -1, sort first.
+        order = numpy.argsort(handlerIndices, kind='mergesort')
+        bounds = numpy.searchsorted(handlerIndices[order],
+                                    numpy.arange(len(self._handlers) + 1))
+        self._handlerRows = []
+        self._handlerTicks = []
+        self._unorderedHandlers = set()
+        for handlerIndex in range(len(self._handlers)):
+            rows = order[bounds[handlerIndex]:bounds[handlerIndex + 1]]
+            ticks = allTicks[rows]
+            if numpy.any(ticks[1:] < ticks[:-1]):
+                self._unorderedHandlers.add(handlerIndex)
+            self._handlerRows.append(rows.tolist())
+            self._handlerTicks.append(ticks.tolist())
+
+
+    ## Return the index of handler, the list of its rows in table order,
+    # and the list of their ticks.
+    def _getHandlerRows(self, handler):
+        handlerIndex = self._handlerToIndex.get(id(handler))
+        if handlerIndex is None:
+            return None, [], []
+        self._updateHandlerIndex()
+        return (handlerIndex, self._handlerRows[handlerIndex],
+                self._handlerTicks[handlerIndex])
+
+
+    ## Set the row at index to the given action, or mark it as deleted if
+    # action is None.
+    def _setRow(self, index, action):
+        self._invalidateHandlerIndex()
+        ticks, handlerIndices = self._flush()
+        if action is None:
+            handlerIndices[index] = -1
+            self._times[index] = None
+            self._parameters[index] = None
+            return
+        time, handler, parameter = action
+        ticks[index] = self.timeToTicks(time)
+        handlerIndices[index] = self._getHandlerIndex(handler)
+        self._times[index] = time
+        self._parameters[index] = parameter
+
+
+    ## Return the action at index as a (time, handler, parameter) tuple,
+    # or None if it has been deleted.
+    def _getRow(self, index, handlerIndices):
+        handlerIndex = handlerIndices[index]
+        if handlerIndex < 0:
+            return None
+        return (self._times[index], self._handlers[handlerIndex],
+                self._parameters[index])
+
+
+    ## Keep only the rows at the given array of indices, in that order.
+    def _selectRows(self, indices):
+        self._invalidateHandlerIndex()
+        ticks, handlerIndices = self._flush()
+        ticks[:len(indices)] = ticks[indices]
+        handlerIndices[:len(indices)] = handlerIndices[indices]
+        indices = indices.tolist()
+        self._times = [self._times[i] for i in indices]
+        self._parameters = [self._parameters[i] for i in indices]
+
+
+    ## Insert an element into the table.
     def addAction(self, time, handler, parameter):
-        self.actions.append((time, handler, parameter))
+        tick = int(time * self.ticksPerMs)
+        handlerIndex = self._handlerToIndex.get(id(handler))
+        if handlerIndex is None:
+            handlerIndex = self._addHandler(handler)
+        index = len(self._times)
+        self._pendingTicks.append(tick)
+        self._pendingHandlerIndices.append(handlerIndex)
+        self._times.append(time)
+        self._parameters.append(parameter)
+        if self._handlerRows is not None:
+            ticks = self._handlerTicks[handlerIndex]
+            if ticks and ticks[-1] > tick:
+                self._unorderedHandlers.add(handlerIndex)
+            ticks.append(tick)
+            self._handlerRows[handlerIndex].append(index)
         if self.firstActionTime is None or self.firstActionTime > time:
             self.firstActionTime = time
         if self.lastActionTime is None or self.lastActionTime < time:
@@ -88,20 +266,105 @@ class ActionTable:
 
     ## Retrieve the last time and action we performed with the specified
     # handler.
-    # NB assumes that self.actions has been sorted.
+    # NB assumes that the table has been sorted.
     def getLastActionFor(self, handler):
-        for time, altHandler, parameter in reversed(self.actions):
-            if altHandler is handler:
-                return time, parameter
-        return None, None
+        handlerIndex, rows, ticks = self._getHandlerRows(handler)
+        if not rows:
+            return None, None
+        return self._times[rows[-1]], self._parameters[rows[-1]]
+
+
+    ## Retrieve the time and action of the latest action for the specified
+    # handler that is before the specified time, i.e. the state the
+    # handler is in at that time.  Actions less than a tick before the
+    # time count as being at the time.  Of several actions at the same
+    # time, return the last one in table order.  Unlike getLastActionFor,
+    # this does not need the table to be sorted.
+    def getLastActionBefore(self, handler, time):
+        handlerIndex, rows, ticks = self._getHandlerRows(handler)
+        if not rows:
+            return None, None
+        tick = self.timeToTicks(time)
+        if handlerIndex not in self._unorderedHandlers:
+            position = bisect.bisect_left(ticks, tick) - 1
+            if position < 0:
+                return None, None
+        else:
+            ticks = numpy.array(ticks)
+            before = numpy.flatnonzero(ticks < tick)
+            if not len(before):
+                return None, None
+            # Latest of the earlier ticks, searching backwards so that the
+            # last in table order wins ties.
+            position = before[len(before) - 1
+                              - numpy.argmax(ticks[before][::-1])]
+        row = rows[position]
+        return self._times[row], self._parameters[row]
+
+
+    ## Return an array of the indices of the actions for the specified
+    # handler, in table order.
+    def getIndicesFor(self, handler):
+        handlerIndex, rows, ticks = self._getHandlerRows(handler)
+        return numpy.array(rows, dtype=numpy.intp)
+
+
+    ## Return the (start, stop) indices of the actions at or after
+    # startTime and before stopTime, so that table[start:stop] are those
+    # actions.
+    # NB assumes that the table has been sorted.
+    def getIndicesInRange(self, startTime, stopTime):
+        ticks, handlerIndices = self._flush()
+        return (int(numpy.searchsorted(ticks, self.timeToTicks(startTime))),
+                int(numpy.searchsorted(ticks, self.timeToTicks(stopTime))))
+
+
+    ## Return the columns of the table: arrays of the tick times and of
+    # the handler indices, and the list of handlers those index.  The
+    # arrays are views, and must not be modified.
+    def getColumns(self):
+        ticks, handlerIndices = self._flush()
+        return ticks, handlerIndices, self._handlers
+
+
+    ## Return a copy of the table, that can be changed without changing
+    # this one.  The parameters themselves are not copied.
+    def copy(self):
+        result = ActionTable()
+        ticks, handlerIndices = self._flush()
+        result._ticks = ticks.copy()
+        result._handlerIndices = handlerIndices.copy()
+        result._times = list(self._times)
+        result._parameters = list(self._parameters)
+        result._handlers = list(self._handlers)
+        result._handlerToIndex = dict(self._handlerToIndex)
+        result._invalidateHandlerIndex()
+        result.firstActionTime = self.firstActionTime
+        result.lastActionTime = self.lastActionTime
+        return result
+
+
+    ## Add offset to the parameters of all the actions for the specified
+    # handler, e.g. to move the positions of a Z stack.
+    def offsetParameters(self, handler, offset):
+        handlerIndex, rows, ticks = self._getHandlerRows(handler)
+        for row in rows:
+            self._parameters[row] = self._parameters[row] + offset
+
+
+    ## Return the list of the parameters of the actions.  This is not a
+    # copy, and must not be modified.
+    def getParameters(self):
+        return self._parameters
 
 
     ## Sort all the actions in the table by time.
     # \todo We should remove redundant entries in here (e.g. due to 
     # 0 stabilization time for stage movement). 
     def sort(self):
-        # First element in each action is the timestamp.
-        self.actions.sort(key=lambda a: a[0])
+        ticks, handlerIndices = self._flush()
+        # A stable sort, so that simultaneous actions keep their order.
+        self._selectRows(numpy.argsort(ticks, kind='mergesort'))
 
 
     ## Clear invalid entries from the list. Sometimes when the table is
@@ -109,22 +372,19 @@ class ActionTable:
     # the list; thus, the user sets it to None and then calls this function
     # afterwards.
     def clearBadEntries(self):
-        pairs = [item for item in enumerate(self.actions)]
-        for i, action in reversed(pairs):
-            if action is None:
-                del self.actions[i]
+        ticks, handlerIndices = self._flush()
+        self._selectRows(numpy.flatnonzero(handlerIndices >= 0))
 
 
     ## Go through the table and ensure all timepoints are positive.
     # NB assumes the table has been sorted.
     def enforcePositiveTimepoints(self):
-        delta = -self.actions[0][0]
+        delta = -self._times[0]
         if delta < 0:
             # First event is at a positive time, so we're good to go.
             return
-        for i in range(len(self.actions)):
-            self.actions[i] = (self.actions[i][0] + delta,
-                    self.actions[i][1], self.actions[i][2])
+        ticks, handlerIndices = self._flush()
+        self._shiftRows(handlerIndices >= 0, delta, -ticks[0])
         self.firstActionTime += delta
         self.lastActionTime += delta
 
@@ -132,49 +392,87 @@ class ActionTable:
     ## Move all actions after the specified time back by the given offset,
     # to make room for some new action.
     def shiftActionsBack(self, markTime, delta):
-        for i, (actionTime, handler, action) in enumerate(self.actions):
-            if actionTime >= markTime:
-                self.actions[i] = (actionTime + delta, handler, action)
+        ticks, handlerIndices = self._flush()
+        toShift = ((ticks >= self.timeToTicks(markTime))
+                   & (handlerIndices >= 0))
+        self._shiftRows(toShift, delta, self.timeToTicks(delta))
         if self.firstActionTime > markTime:
             self.firstActionTime += delta
         if self.lastActionTime > markTime:
             self.lastActionTime += delta
 
 
+    ## Add delta to the times, and deltaTicks to the ticks, of the rows
+    # selected by the boolean mask toShift.
+    def _shiftRows(self, toShift, delta, deltaTicks):
+        self._invalidateHandlerIndex()
+        ticks, handlerIndices = self._flush()
+        ticks[toShift] += deltaTicks
+        times = self._times
+        for i in numpy.flatnonzero(toShift).tolist():
+            times[i] += delta
+
+
     ## Return the time of the first and last action we have.
     # Use our cached values if allowed.
     def getFirstAndLastActionTimes(self, canUseCache = True):
         if canUseCache:
             return self.firstActionTime, self.lastActionTime
-        firstTime = lastTime = None
-        for actionTime, handler, action in self.actions:
-            if firstTime is None:
-                firstTime = lastTime = actionTime
-            firstTime = min(firstTime, actionTime)
-            lastTime = max(lastTime, actionTime)
-        return firstTime, lastTime
+        ticks, handlerIndices = self._flush()
+        valid = numpy.flatnonzero(handlerIndices >= 0)
+        if not len(valid):
+            return None, None
+        ticks = ticks[valid]
+        return (self._times[valid[numpy.argmin(ticks)]],
+                self._times[valid[numpy.argmax(ticks)]])
 
 
-    ## Access an element in the table.
+    ## Access an element in the table, or a list of elements for a slice.
     def __getitem__(self, index):
-        return self.actions[index]
+        ticks, handlerIndices = self._flush()
+        if isinstance(index, slice):
+            return [self._getRow(i, handlerIndices)
+                    for i in range(*index.indices(len(self)))]
+        return self._getRow(self._checkIndex(index), handlerIndices)
 
 
     ## Modify an item in the table
     def __setitem__(self, index, val):
-        self.actions[index] = val
+        self._setRow(self._checkIndex(index), val)
+
+
+    ## Return index as a non-negative index, or raise IndexError.
+    def _checkIndex(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("action table index out of range")
+        return index
 
 
     ## Get the length of the table.
     def __len__(self):
-        return len(self.actions)
+        return len(self._times)
+
+
+    def __iter__(self):
+        ticks, handlerIndices = self._flush()
+        for i in range(len(self)):
+            yield self._getRow(i, handlerIndices)
+
+
+    ## List of (time, handler, parameter) tuples, or None for deleted
+    # actions.  This is a copy; modify the table through its methods.
+    @property
+    def actions(self):
+        return list(self)
 
 
     ## Generate pretty text for our table, optionally only for the specified
     # handler(s)
     def prettyString(self, handlers = []):
         result = ''
-        for event in self.actions:
+        for event in self:
             if event is None:
                 result += '<Deleted event>\n'
             else:
@@ -188,4 +486,3 @@ class ActionTable:
     ## Cast to a string -- generate a textual description of our actions.
     def __repr__(self):
         return self.prettyString()
-
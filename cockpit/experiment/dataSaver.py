@@ -53,12 +53,13 @@
 
 from cockpit import depot
 from cockpit import events
+import cockpit.util.Mrc
 import cockpit.util.datadoc
 import cockpit.util.logger
-import cockpit.util.threads
 
 import numpy
 import queue
+import tempfile
 import threading
 import time
 
@@ -66,10 +67,32 @@ import time
 ## Unique ID for identifying saver instances
 uniqueID = 0
 
+## Ways of dealing with a new image when the images already waiting to be
+# saved use up the whole memory budget:
+## Wait for the save threads to catch up.  This blocks the thread that
+# published the image, usually the camera's.
+OVERFLOW_BLOCK = 'block'
+## Copy the image to a temporary memory-mapped file, so that it waits
+# on disk instead of in memory.
+OVERFLOW_SPILL = 'spill'
+## Discard the image, leaving its plane in the file blank, and count it.
+OVERFLOW_DROP = 'drop'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_SPILL, OVERFLOW_DROP]
+
 
 ## This class simply records all data received during an experiment and saves
 # it to disk in MRC format.
 class DataSaver:
+    ## Maximum size, in megabytes, of each file generated.  If the
+    # experiment data exceeds this, then a new file will be opened, and
+    # each file will have a suffix appended to it (e.g.  ".001", ".002",
+    # etc.). This is not a precise cap, since it only considers the amount
+    # of space allocated to image data -- not the header or extended
+    # header.
+    # The default of a googol megabytes ought to be enough to avoid
+    # splitting files if no cap is specified. :)
+    maxFilesize = 10**100
+
     ## \param cameras List of CameraHandler instances for the cameras that
     #         will be generating images
     # \param numReps How many times the experiment will be repeated.
@@ -86,9 +109,16 @@ class DataSaver:
     #        and there can be up to 10 of them.
     # \param cameraToExcitation Maps camera handlers to the excitation
     #        wavelength used to generate the images it will acquire.
+    # \param queueBudget Maximum number of bytes of image data to hold in
+    #        memory while waiting to be saved, or None for no limit.
+    # \param overflowPolicy One of OVERFLOW_POLICIES: what to do with new
+    #        images once queueBudget is used up.
     def __init__(self, cameras, numReps, cameraToImagesPerRep,
                  cameraToIgnoredImageIndices, runThread, savePath, pixelSizeZ,
-                 titles, cameraToExcitation):
+                 titles, cameraToExcitation, queueBudget=None,
+                 overflowPolicy=OVERFLOW_SPILL):
+        if overflowPolicy not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy '%s'" % overflowPolicy)
         self.cameras = cameras
         self.numReps = numReps
         self.cameraToImagesPerRep = cameraToImagesPerRep
@@ -103,16 +133,6 @@ class DataSaver:
         ## limitation of the cockpit interface.
         self.cameraToExcitation = cameraToExcitation
 
-        ## Maximum size, in megabytes, of each file generated.  If the
-        # experiment data exceeds this, then a new file will be opened, and
-        # each file will have a suffix appended to it (e.g.  ".001", ".002",
-        # etc.). This is not a precise cap, since it only considers the amount
-        # of space allocated to image data -- not the header or extended
-        # header.
-        # The default of a googol megabytes ought to be enough to avoid
-        # splitting files if no cap is specified. :)
-        self.maxFilesize = 10**100
-
         global uniqueID
         ## Unique ID for our instance
         self.uniqueID = uniqueID
@@ -149,8 +169,9 @@ class DataSaver:
                                                    * self.planeBytes
                                                    * len(self.cameras)
                                                    / 1024.0 / 1024.0)
-        # Sanity check.
-        self.maxRepsPerFile = max(self.maxRepsPerFile, 1)
+        # Sanity check, and an int so that file indices computed from it
+        # are too.
+        self.maxRepsPerFile = max(int(self.maxRepsPerFile), 1)
         ## Whether or not we need to split the data into multiple files.
         self.doNeedToSplitFiles = (self.maxRepsPerFile < self.numReps)
         # For simplicity's sake, we bring self.maxRepsPerFile down to
@@ -172,33 +193,25 @@ class DataSaver:
         # have stopped arriving.
         self.lastImageTime = time.time()
 
-        ## Filehandles we will write the data to.
-        self.filehandles = []
-        ## Filenames for same.
+        ## Filenames we will write the data to.
         self.filenames = []
         if self.doNeedToSplitFiles:
-            # We have multiple filehandles, each with a suffix.
+            # We have multiple files, each with a suffix.
             # A bit tricky here: we want a suffix that has only as many
             # digits as needed, e.g. not doing ".001" when you're only going to
             # use 2 files.
-            numFilehandles = int(numpy.ceil(float(self.numReps)
-                                            / self.maxRepsPerFile))
-            numDigits = int(numpy.ceil(numpy.log10(numFilehandles)))
+            numFiles = int(numpy.ceil(float(self.numReps)
+                                      / self.maxRepsPerFile))
+            numDigits = int(numpy.ceil(numpy.log10(numFiles)))
             # Generates e.g. "%05d" if we need 5 digits, or "%01d" if we only
             # need 1.
             formatString = "%0" + str(numDigits) + "d"
-            for i in range(numFilehandles):
-                filename = "%s.%s" % (savePath, formatString % i)
-                self.filehandles.append(open(filename, 'wb'))
-                self.filenames.append(filename)
+            for i in range(numFiles):
+                self.filenames.append("%s.%s" % (savePath, formatString % i))
         else:
-            # We have just a single filehandle with the save path as specified.
-            self.filehandles.append(open(savePath, 'wb'))
+            # We have just a single file with the save path as specified.
             self.filenames.append(savePath)
 
-        ## Lock on writing to each file.
-        self.fileLocks = [threading.Lock() for handle in self.filehandles]
-
         pixelSizeXY = depot.getHandlersOfType(depot.OBJECTIVE)[0].getPixelSize()
         lensID = depot.getHandlersOfType(depot.OBJECTIVE)[0].getLensID()
         #wavelength should always be on camera even if "0"
@@ -211,15 +224,13 @@ class DataSaver:
 
         ## MRC header objects for each file.
         self.headers = []
-        self.intMetadataBuffers = []
-        self.floatMetadataBuffers = []
-        for i in range(len(self.filehandles)):
+        for i in range(len(self.filenames)):
             # Calculate how many timepoints fit into this particular file
             # (potentially different for the final file).
             numTimepoints = self.maxRepsPerFile
-            if i == len(self.filehandles) - 1:
+            if i == len(self.filenames) - 1:
                 numTimepoints = self.numReps - (self.maxRepsPerFile
-                                                * (len(self.filehandles) - 1))
+                                                * (len(self.filenames) - 1))
             header = cockpit.util.datadoc.makeHeaderForShape(
                 (len(self.cameras), numTimepoints, self.maxImagesPerRep,
                     self.maxHeight, self.maxWidth),
@@ -240,7 +251,7 @@ class DataSaver:
                 # We have room for an extra title indicating where this file
                 # falls in the sequence.
                 tempTitles.append("File %d of %d; base timepoint %d" % (i + 1,
-                    len(self.filehandles), i * self.maxRepsPerFile))
+                    len(self.filenames), i * self.maxRepsPerFile))
             header.NumTitles = len(tempTitles)
             header.title[:len(tempTitles)] = tempTitles
             # Write the size of the extended header, in bytes.
@@ -252,44 +263,77 @@ class DataSaver:
 
             self.headers.append(header)
 
-            ## This will hold the metadata for one image plane at a
-            ## time and will be written into the extended header.  We
-            ## could create a new array each time for each plane but
-            ## these arrays are small and there will be many image
-            ## planes.  We do this to avoid memory fragmentation.
-            self.intMetadataBuffers.append(numpy.array([0] * numIntegers,
-                                                      dtype=numpy.int32))
-            floatMetadataBuffer = numpy.array([0.0] * numFloats,
-                                              dtype=numpy.float32)
-            floatMetadataBuffer[12] = 1.0 # intensity scaling
-            self.floatMetadataBuffers.append(floatMetadataBuffer)
-
-
-        # Write the headers, to get us started. We will re-write this at the
-        # end when we have more metadata to fill in (specifically, the min/max
-        # values for each wavelength).
-        for i, handle in enumerate(self.filehandles):
-            with self.fileLocks[i]:
-                cockpit.util.datadoc.writeMrcHeader(self.headers[i], handle)
+
+        ## Writers of each file.  They write the headers, to get us
+        # started, and again when closed, by which time we have more
+        # metadata to fill in (specifically, the min/max values for each
+        # wavelength).  Each camera's images are written by a thread of
+        # their own, so that a multi-camera experiment is not limited by
+        # a single thread doing every write; the writers write at
+        # explicit offsets, so those threads can write to the same file
+        # at the same time.
+        self.writers = [cockpit.util.Mrc.MrcWriter(filename, header)
+                        for filename, header in zip(self.filenames,
+                                                    self.headers)]
+
+        ## This will hold the metadata for one image plane at a time, per
+        ## camera, and will be written into the extended header.  We
+        ## could create a new array each time for each plane but these
+        ## arrays are small and there will be many image planes.  We do
+        ## this to avoid memory fragmentation.  The ints and floats are
+        ## kept in a single record so that they go to the file in a
+        ## single write.
+        self.metadataBuffers = []
+        ## Same reasoning for images that need padding, i.e., images
+        ## from cameras smaller than the largest camera.  Images that
+        ## already have the plane shape are written as they are, without
+        ## a copy.
+        self.paddedBuffers = []
+        for camera in self.cameras:
+            metadataBuffer = numpy.zeros(
+                1, dtype=cockpit.util.datadoc.makeExtendedHeaderDtype(
+                    numIntegers, numFloats))
+            metadataBuffer['float'][0, 12] = 1.0 # intensity scaling
+            self.metadataBuffers.append(metadataBuffer)
+            self.paddedBuffers.append(numpy.zeros((self.maxHeight,
+                                                   self.maxWidth),
+                                                  dtype=numpy.uint16))
 
         ## List of how many images we've received, on a per-camera basis.
         self.imagesReceived = [0] * len(self.cameras)
         ## List of how many images we've written, on a per-camera basis.
         self.imagesKept = [0] * len(self.cameras)
+        ## List of how many images we've discarded because the queue was
+        # full, on a per-camera basis.
+        self.imagesDropped = [0] * len(self.cameras)
         ## List of functions that receive image data and feed it into
         # self.imagesReceived.
         self.lambdas = []
-        ## List of (min, max) tuples, on a per-camera basis, tracking
-        # the dimmest and brightest pixels.
-        self.minMaxVals = []
+        ## IntensityStats of the images kept, on a per-file and then
+        # per-camera basis, for the headers.  Each is only updated by
+        # the save thread of its camera.
+        self.intensityStats = [[IntensityStats() for camera in self.cameras]
+                               for filename in self.filenames]
 
         ## True if we should stop collecting data.
         self.shouldAbort = False
         ## True if we are done collecting data.
         self.amDone = False
-        ## Queue of (camera index, image data, timestamp) tuples for images
-        # that need to be saved
-        self.imageQueue = queue.Queue()
+        ## Per-camera queues of (image data, timestamp, bytes, is spilled)
+        # tuples for images that need to be saved.  Image data is None for
+        # dropped images.  None on a queue tells its thread to stop.
+        self.imageQueues = [queue.Queue() for camera in self.cameras]
+        ## What to do with images that do not fit in the memory budget.
+        self.overflowPolicy = overflowPolicy
+        ## Memory used by queued images, shared between all cameras.
+        self.queueBudget = QueueBudget(queueBudget)
+        ## Where images go when they do not fit in the memory budget.
+        self.spillFile = None
+        if overflowPolicy == OVERFLOW_SPILL:
+            self.spillFile = SpillFile()
+        ## Lock on setting self.firstTimestamp, which happens on whichever
+        # camera thread delivers the first image.
+        self.timestampLock = threading.Lock()
 
         # Use dye name if available, otherwise use camera name.
         names = [camera.dye or camera.name for camera in self.cameras]
@@ -297,24 +341,31 @@ class DataSaver:
         for camera in self.cameras:
             totals.append(self.cameraToImagesKeptPerRep[camera] * self.numReps)
         ## Thread that handles updating the UI.
-        self.statusThread = StatusUpdateThread(names, totals)
-
-        # Start the data-saving thread.
-        self.saveData()
+        self.statusThread = StatusUpdateThread(names, totals,
+                                               self.imageQueues,
+                                               self.queueBudget,
+                                               self.imagesDropped)
+
+        ## Threads writing the images of each camera to disk.
+        self.saveThreads = []
+        for i, name in enumerate(names):
+            thread = threading.Thread(target=self.saveData, args=(i,),
+                                      name="DataSaver-save-%s" % name)
+            # Ensure the thread will exit when the program does.
+            thread.daemon = True
+            thread.start()
+            self.saveThreads.append(thread)
 
 
     ## Subscribe to the new-camera-image events for the cameras we care about.
     # Save the functions we generate for handling the subscriptions, so we can
-    # unsubscribe later. Initialize self.minMaxVals. Start our status-update
-    # thread.
+    # unsubscribe later. Start our status-update thread.
     def startCollecting(self):
         for camera in self.cameras:
             def func(data, timestamp, camera=camera):
                 return self.onImage(self.cameraToIndex[camera], data, timestamp)
             self.lambdas.append(func)
             events.subscribe('new image %s' % camera.name, func)
-
-            self.minMaxVals.append((float('inf'), float('-inf')))
         events.subscribe('user abort', self.onAbort)
         self.statusThread.start()
 
@@ -326,7 +377,7 @@ class DataSaver:
 
 
     ## Wait for the runThread to finish, then wait a bit longer in case some
-    # images are laggardly, before we close our filehandles.
+    # images are laggardly, before we close our files.
     def executeAndSave(self):
         # Joining the thread doesn't actually work until it has started,
         # hence the delay here.
@@ -336,7 +387,7 @@ class DataSaver:
         # Wait until it's been a bit without getting any more images in, or
         # until we have all the images we expected to get for each camera.
         while (time.time() - self.lastImageTime < .5
-               or not self.imageQueue.empty()):
+               or not all(q.empty() for q in self.imageQueues)):
             amDone = True
             for camera in self.cameras:
                 total = self.imagesKept[self.cameraToIndex[camera]]
@@ -352,27 +403,59 @@ class DataSaver:
         self.amDone = True
 
         self.cleanup()
+        # Let the save threads finish whatever they are writing.
+        for imageQueue in self.imageQueues:
+            imageQueue.put(None)
+        for thread in self.saveThreads:
+            thread.join()
+
+        cockpit.util.logger.log.info(
+            "DataSaver queue peaked at %d images (%.1f MB); %d images"
+            " spilled to disk; %s images dropped per camera",
+            self.queueBudget.peakImages,
+            self.queueBudget.peakBytes / 1024.0 / 1024.0,
+            self.spillFile.numSpilled if self.spillFile else 0,
+            self.imagesDropped)
+        self.updateHeaders()
+        for camera, stats in zip(self.cameras, self.getCameraStats()):
+            cockpit.util.logger.log.info(
+                "%s: min %d, 1%% %d, median %d, 99%% %d, max %d",
+                camera.name, stats.min, stats.getPercentile(1),
+                stats.getPercentile(50), stats.getPercentile(99), stats.max)
+        # Rewrite the headers, now that we know what the min/max values are.
+        self.closeFiles()
+
 
-        # Determine min/max vals for each wavelength.
-        for header in self.headers:
-            for i in range(len(self.cameras)):
-                # HACK: camera 1 is supposed to get min/max/median. However,
-                # computing the median of a large dataset takes a very long
-                # time (30s for a 2GB file on a fairly powerful computer),
-                # so we just store 0.
-                minVal, maxVal = self.minMaxVals[i]
+    ## Set the min/max vals for each wavelength, and the median for the
+    # first, from the statistics of the images in each file.
+    def updateHeaders(self):
+        for header, fileStats in zip(self.headers, self.intensityStats):
+            for i, stats in enumerate(fileStats):
                 if i == 0:
-                    setattr(header, 'mmm1', (minVal, maxVal, 0))
+                    setattr(header, 'mmm1', (stats.min, stats.max,
+                                             stats.getPercentile(50)))
                 else:
-                    setattr(header, 'mm%d' % (i + 1), (minVal, maxVal))
-        # Rewrite the headers, now that we know what the min/max values are.
-        # Of course, these won't be precisely accurate for every file.
-        # \todo Track min/max values on a per-file basis.
-        # Then, close the filehandle.
-        for i, handle in enumerate(self.filehandles):
-            with self.fileLocks[i]:
-                cockpit.util.datadoc.writeMrcHeader(self.headers[i], handle)
-                handle.close()
+                    setattr(header, 'mm%d' % (i + 1), (stats.min, stats.max))
+
+
+    ## Return IntensityStats for all the images kept from each camera,
+    # across files.
+    def getCameraStats(self):
+        result = []
+        for i in range(len(self.cameras)):
+            stats = IntensityStats()
+            for fileStats in self.intensityStats:
+                stats.update(fileStats[i])
+            result.append(stats)
+        return result
+
+
+    ## Write the final headers and close the files.
+    def closeFiles(self):
+        for writer in self.writers:
+            writer.close()
+        if self.spillFile is not None:
+            self.spillFile.close()
 
 
     ## Clean up once saving is completed.
@@ -383,27 +466,55 @@ class DataSaver:
         events.unsubscribe('user abort', self.onAbort)
 
 
-    ## Receive new data, and add it to the queue.
+    ## Receive new data, and add it to the queue for its camera.  If the
+    # queued images already use up our memory budget, deal with it
+    # according to self.overflowPolicy.
     def onImage(self, cameraIndex, imageData, timestamp):
-        self.imageQueue.put((cameraIndex, imageData, timestamp))
-
-
-    ## Continually poll our imageQueue and save data to the file.
-    @cockpit.util.threads.callInNewThread
-    def saveData(self):
+        with self.timestampLock:
+            if self.firstTimestamp is None:
+                self.firstTimestamp = timestamp
+        numBytes = imageData.nbytes
+        isSpilled = False
+        shouldBlock = self.overflowPolicy == OVERFLOW_BLOCK
+        if not self.queueBudget.reserve(numBytes, shouldBlock,
+                                        lambda: self.shouldAbort):
+            if self.overflowPolicy == OVERFLOW_SPILL:
+                imageData = self.spillFile.spill(imageData)
+                isSpilled = True
+            else:
+                # Still queue the image as a placeholder, so that the
+                # images that follow end up in their right planes.
+                imageData = None
+                self.imagesDropped[cameraIndex] += 1
+            numBytes = 0
+        self.imageQueues[cameraIndex].put((imageData, timestamp, numBytes,
+                                           isSpilled))
+
+
+    ## Continually poll the imageQueue of one camera and save its data to
+    # the file.  Each queue is drained in order by a single thread, so
+    # the images of a camera are written in the order they arrived.
+    def saveData(self, cameraIndex):
+        imageQueue = self.imageQueues[cameraIndex]
         while not self.amDone:
             if self.shouldAbort:
                 # Do nothing.
                 return
-            cameraIndex, imageData, timestamp = self.imageQueue.get()
-            if self.firstTimestamp is None:
-                self.firstTimestamp = timestamp
+            item = imageQueue.get()
+            if item is None:
+                return
+            imageData, timestamp, numBytes, isSpilled = item
             # Store the timestamp as a rebased 32-bit float; we can't use
             # 64-bit due to the file format restriction, and if we don't
             # rebase then the numbers are big enough that we lose decimal
             # precision.
             timestamp = timestamp - self.firstTimestamp
-            self.writeImage(cameraIndex, imageData, timestamp)
+            try:
+                self.writeImage(cameraIndex, imageData, timestamp)
+            finally:
+                self.queueBudget.release(numBytes)
+                if isSpilled:
+                    self.spillFile.release()
 
 
     ## Write a single image to the file.
@@ -432,84 +543,83 @@ class DataSaver:
         planeIndex = (int(timepoint * self.maxImagesPerRep * numCameras)
                       + (zIndex * numCameras) + cameraIndex)
 
-        ## Offsets for the plane metadata in the extended header, and
-        ## for the plane data in the image section.  1024 is the
-        ## length of the base header.
-        metadataOffset = 1024 + (planeIndex * self.extendedBytes)
-        dataOffset = (1024 + int(self.headers[fileIndex].next)
-                      + (planeIndex * self.planeBytes))
-
+        if imageData is None:
+            # The image was dropped for lack of memory; write a blank
+            # plane so that the file is complete.
+            imageData = self.paddedBuffers[cameraIndex]
+            imageData[:] = 0
+            isDropped = True
+        else:
+            isDropped = False
         height, width = imageData.shape
-
-        # Pad with zeros. I wouldn't normally think this would be
-        # necessary, but we get "invalid argument" errors when writing
-        # to the filehandle if we don't.
-        # \todo Figure out why this is necessary.
-        paddedBuffer = numpy.zeros((self.maxHeight, self.maxWidth),
-                                   dtype=numpy.uint16)
-        paddedBuffer[:height, :width] = imageData
-
-        imageMin = imageData.min()
-        imageMax = imageData.max()
+        imageMin, imageMax, imageMean = getImageStats(imageData)
+        if not isDropped:
+            self.intensityStats[fileIndex][cameraIndex].addImage(
+                imageData, imageMin, imageMax)
 
         ex_wavelength = self.cameraToExcitation[camera]
         em_wavelength = camera.wavelength
 
-        with self.fileLocks[fileIndex]:
-            handle = self.filehandles[fileIndex]
-
-            ## The extended header has the following structure per
-            ## plane (see issue #290):
-            ##
-            ##     8 32bit signed integers whose meaning we don't
-            ##     know.  Often are all set to zero.
-            ##
-            ##     Followed by 32 32bit floats.  We only what the
-            ##     first 14 are:
-            ##
-            ##     photosensor reading (typically in mV)
-            ##     elapsed time (seconds since experiment began)
-            ##     x stage coordinates
-            ##     y stage coordinates
-            ##     z stage coordinates
-            ##     minimum intensity
-            ##     maximum intensity
-            ##     mean intensity
-            ##     exposure time (seconds)
-            ##     neutral density (fraction of 1 or percentage)
-            ##     excitation wavelength
-            ##     emission wavelength
-            ##     intensity scaling (usually 1)
-            ##     energy conversion factor (usually 1)
-            ##
-            ## Experience from inspecting actual dv files from API
-            ## systems, tells us that we can leave most of them at
-            ## zero.
-            intMetadataBuffer = self.intMetadataBuffers[fileIndex]
-            floatMetadataBuffer = self.floatMetadataBuffers[fileIndex]
-            floatMetadataBuffer[1] = timestamp
-            floatMetadataBuffer[5] = imageMin
-            floatMetadataBuffer[6] = imageMax
-            # TODO floatMetadataBuffer[8] could be exposure time in seconds
-            floatMetadataBuffer[10] = ex_wavelength
-            floatMetadataBuffer[11] = em_wavelength
-
-            try:
-                handle.seek(metadataOffset)
-                handle.write(intMetadataBuffer)
-                handle.write(floatMetadataBuffer)
-                handle.seek(dataOffset)
-                handle.write(paddedBuffer)
-            except Exception as e:
-                print ("Error writing image:",e)
-                raise e
-
-            self.imagesKept[cameraIndex] += 1
-            self.lastImageTime = time.time()
-
-            curMin, curMax = self.minMaxVals[cameraIndex]
-            self.minMaxVals[cameraIndex] = (min(curMin, imageMin),
-                                            max(curMax, imageMax))
+        ## The extended header has the following structure per
+        ## plane (see issue #290):
+        ##
+        ##     8 32bit signed integers whose meaning we don't
+        ##     know.  Often are all set to zero.
+        ##
+        ##     Followed by 32 32bit floats.  We only what the
+        ##     first 14 are:
+        ##
+        ##     photosensor reading (typically in mV)
+        ##     elapsed time (seconds since experiment began)
+        ##     x stage coordinates
+        ##     y stage coordinates
+        ##     z stage coordinates
+        ##     minimum intensity
+        ##     maximum intensity
+        ##     mean intensity
+        ##     exposure time (seconds)
+        ##     neutral density (fraction of 1 or percentage)
+        ##     excitation wavelength
+        ##     emission wavelength
+        ##     intensity scaling (usually 1)
+        ##     energy conversion factor (usually 1)
+        ##
+        ## Experience from inspecting actual dv files from API
+        ## systems, tells us that we can leave most of them at
+        ## zero.
+        metadataBuffer = self.metadataBuffers[cameraIndex]
+        floatMetadataBuffer = metadataBuffer['float'][0]
+        floatMetadataBuffer[1] = timestamp
+        floatMetadataBuffer[5] = imageMin
+        floatMetadataBuffer[6] = imageMax
+        floatMetadataBuffer[7] = imageMean
+        # TODO floatMetadataBuffer[8] could be exposure time in seconds
+        floatMetadataBuffer[10] = ex_wavelength
+        floatMetadataBuffer[11] = em_wavelength
+
+        # Images of the full plane size are written straight from the
+        # camera's buffer.  Anything else is padded with zeros, as
+        # every plane in the file has the same size.
+        if (imageData.shape == (self.maxHeight, self.maxWidth)
+                and imageData.dtype == numpy.uint16
+                and imageData.flags.c_contiguous):
+            planeBuffer = imageData
+        else:
+            planeBuffer = self.paddedBuffers[cameraIndex]
+            planeBuffer[:height, :width] = imageData
+            # Clear whatever a previous, larger, image left behind.
+            planeBuffer[height:, :] = 0
+            planeBuffer[:height, width:] = 0
+
+        try:
+            self.writers[fileIndex].writeSec(planeIndex, planeBuffer,
+                                             metadataBuffer)
+        except Exception as e:
+            print ("Error writing image:",e)
+            raise e
+
+        self.imagesKept[cameraIndex] += 1
+        self.lastImageTime = time.time()
 
         # Update the status text. But first, check for abort/experiment
         # completion, since we may actually be done now and we don't want
@@ -525,10 +635,188 @@ class DataSaver:
 
 
 
+## Return the (min, max, mean) of an image.  Integer images are summed
+# with an integer accumulator, which avoids the conversion of every pixel
+# to floating point that numpy.mean does.
+def getImageStats(imageData):
+    if imageData.dtype.kind == 'u':
+        total = int(imageData.sum(dtype=numpy.uint64))
+    elif imageData.dtype.kind == 'i':
+        total = int(imageData.sum(dtype=numpy.int64))
+    else:
+        total = float(imageData.sum(dtype=numpy.float64))
+    return (imageData.min(), imageData.max(),
+            total / max(imageData.size, 1))
+
+
+
+## Intensity statistics of a set of images, accumulated one image at a
+# time so that the header of a file can be written without reading its
+# data back.  Min and max are exact.  Percentiles come from a histogram
+# with one bin per 16-bit value, filled from a regular subsample of each
+# image, which keeps the cost per image well below that of the min/max.
+class IntensityStats:
+    ## Number of pixels to sample from each image.
+    SAMPLE_SIZE = 2 ** 16
+
+    def __init__(self):
+        self.min = 0
+        self.max = 0
+        ## Number of images added.
+        self.numImages = 0
+        ## Number of sampled pixels with each value.
+        self.counts = numpy.zeros(2 ** 16, dtype=numpy.int64)
+
+
+    ## Add an image whose min and max are already known.
+    def addImage(self, imageData, imageMin, imageMax):
+        if self.numImages:
+            self.min = min(self.min, imageMin)
+            self.max = max(self.max, imageMax)
+        else:
+            self.min = imageMin
+            self.max = imageMax
+        self.numImages += 1
+        step = max(1, int(numpy.sqrt(imageData.size / self.SAMPLE_SIZE)))
+        sample = imageData[::step, ::step]
+        if sample.dtype != numpy.uint16:
+            # Counted as they will be stored in the file.
+            sample = sample.astype(numpy.uint16)
+        self.counts += numpy.bincount(sample.ravel(), minlength=2 ** 16)
+
+
+    ## Add the images of another IntensityStats.
+    def update(self, other):
+        if not other.numImages:
+            return
+        if self.numImages:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        else:
+            self.min = other.min
+            self.max = other.max
+        self.numImages += other.numImages
+        self.counts += other.counts
+
+
+    ## Return the value below which the given percentage of pixels fall,
+    # or 0 if there are no images.
+    def getPercentile(self, percent):
+        total = self.counts.sum()
+        if not total:
+            return 0
+        cumulative = numpy.cumsum(self.counts)
+        return int(numpy.searchsorted(cumulative,
+                                      max(1, total * percent / 100.0)))
+
+
+
+## Keeps account of the memory used by images waiting to be saved, and of
+# the most that was ever used, so that hardware can be sized from real
+# numbers.
+class QueueBudget:
+    ## \param maxBytes Maximum number of bytes to allow, or None for no
+    #        limit.
+    def __init__(self, maxBytes=None):
+        self.maxBytes = maxBytes
+        ## Bytes and number of images currently reserved.
+        self.numBytes = 0
+        self.numImages = 0
+        ## Most bytes and images that were reserved at the same time.
+        self.peakBytes = 0
+        self.peakImages = 0
+        ## Condition on changes of the above.
+        self.condition = threading.Condition()
+
+
+    ## Reserve memory for an image.  Return True if it fits in the budget.
+    # A single image is always allowed, even if it is larger than the
+    # whole budget, so that an undersized budget cannot stall saving.
+    # \param shouldBlock If True, wait for space to become available
+    #        instead of returning False.
+    # \param shouldGiveUp Function that returns True if we should stop
+    #        waiting, e.g. because the experiment was aborted.
+    def reserve(self, numBytes, shouldBlock=False,
+                shouldGiveUp=lambda: False):
+        with self.condition:
+            while (self.maxBytes is not None and self.numImages
+                   and self.numBytes + numBytes > self.maxBytes):
+                if not shouldBlock or shouldGiveUp():
+                    return False
+                self.condition.wait(.1)
+            self.numBytes += numBytes
+            self.numImages += 1
+            self.peakBytes = max(self.peakBytes, self.numBytes)
+            self.peakImages = max(self.peakImages, self.numImages)
+            return True
+
+
+    ## Release memory of an image that has been saved.  Images that did
+    # not fit in the budget were not charged for, and release 0 bytes.
+    def release(self, numBytes):
+        if not numBytes:
+            return
+        with self.condition:
+            self.numBytes -= numBytes
+            self.numImages -= 1
+            self.condition.notify_all()
+
+
+
+## Temporary file for images that do not fit in the memory budget.  Each
+# spilled image is copied to the end of the file and handed back as a
+# memory-mapped array, which the OS can page out.  The file is reused from
+# the start whenever all the images spilled into it have been saved.
+class SpillFile:
+    def __init__(self):
+        self.handle = tempfile.TemporaryFile()
+        ## Offset at which the next image will be stored.
+        self.offset = 0
+        ## Number of spilled images that have not been saved yet.
+        self.numPending = 0
+        ## Total number of images spilled.
+        self.numSpilled = 0
+        ## Lock around the above.
+        self.lock = threading.Lock()
+
+
+    ## Copy the image into the file and return a memory-mapped copy.
+    def spill(self, imageData):
+        with self.lock:
+            spilled = numpy.memmap(self.handle, dtype=imageData.dtype,
+                                   mode='r+', offset=self.offset,
+                                   shape=imageData.shape)
+            self.offset += imageData.nbytes
+            self.numPending += 1
+            self.numSpilled += 1
+        spilled[:] = imageData
+        return spilled
+
+
+    ## A spilled image has been saved.
+    def release(self):
+        with self.lock:
+            self.numPending -= 1
+            if not self.numPending:
+                self.offset = 0
+
+
+    def close(self):
+        self.handle.close()
+
+
+
 ## This thread handles telling the saving status light to update twice per
 # second.
 class StatusUpdateThread(threading.Thread):
-    def __init__(self, cameraNames, totals):
+    ## \param cameraNames List of names of the cameras.
+    # \param totals List of total images expected per camera.
+    # \param imageQueues List of per-camera queues of images waiting to be
+    #        written, so that we can report when saving falls behind.
+    # \param queueBudget QueueBudget of the images in imageQueues.
+    # \param imagesDropped List of images dropped per camera.
+    def __init__(self, cameraNames, totals, imageQueues, queueBudget,
+                 imagesDropped):
         threading.Thread.__init__(self)
         ## List of names of the cameras.
         self.cameraNames = cameraNames
@@ -538,6 +826,12 @@ class StatusUpdateThread(threading.Thread):
         self.imageCountLock = threading.Lock()
         ## List of total images expected per camera.
         self.totals = totals
+        ## List of queues of images waiting to be written, per camera.
+        self.imageQueues = imageQueues
+        ## Memory used by the images in those queues.
+        self.queueBudget = queueBudget
+        ## List of images dropped, per camera.
+        self.imagesDropped = imagesDropped
         ## Set to True to end the thread.
         self.shouldStop = False
         self.name = "DataSaver-status"
@@ -545,14 +839,18 @@ class StatusUpdateThread(threading.Thread):
 
     def run(self):
         prevCounts = list(self.imagesReceived)
+        prevBacklog = self.getBacklog()
         self.updateText()
         while not self.shouldStop:
-            if prevCounts != self.imagesReceived:
-                # Have received new images since the last update;
-                # update the display.
+            if (prevCounts != self.imagesReceived
+                    or prevBacklog != self.getBacklog()):
+                # Have received new images, or the backlog of images to
+                # write has changed, since the last update; update the
+                # display.
                 with self.imageCountLock:
                     self.updateText()
                     prevCounts = list(self.imagesReceived)
+                    prevBacklog = self.getBacklog()
             else:
                 # No images; wait a bit.
                 time.sleep(.1)
@@ -561,13 +859,31 @@ class StatusUpdateThread(threading.Thread):
                 (170, 170, 170))
 
 
-    ## Push a new text to the status light.
+    ## Return the number of images waiting to be written, and dropped,
+    # per camera.
+    def getBacklog(self):
+        return ([imageQueue.qsize() for imageQueue in self.imageQueues]
+                + list(self.imagesDropped))
+
+
+    ## Push a new text to the status light.  If saving is falling behind
+    # the cameras, include the number of images waiting to be written.
     def updateText(self):
         statusText = ''
         for i, name in enumerate(self.cameraNames):
             curCount = self.imagesReceived[i]
             maxCount = self.totals[i]
-            statusText += '%s: %d/%d\n' % (name, curCount, maxCount)
+            statusText += '%s: %d/%d' % (name, curCount, maxCount)
+            backlog = self.imageQueues[i].qsize()
+            if backlog:
+                statusText += ' (%d queued)' % backlog
+            if self.imagesDropped[i]:
+                statusText += ' (%d dropped)' % self.imagesDropped[i]
+            statusText += '\n'
+        if self.queueBudget.peakImages > 1:
+            statusText += 'Queue: %.0f MB, peak %.0f MB\n' % (
+                self.queueBudget.numBytes / 1024.0 / 1024.0,
+                self.queueBudget.peakBytes / 1024.0 / 1024.0)
         events.publish('update status light', 'image count', statusText,
                 (255, 255, 0))
 
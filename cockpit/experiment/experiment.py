@@ -57,9 +57,11 @@ from cockpit import events
 from cockpit.gui import guiUtils
 
 import cockpit.handlers.camera
+import cockpit.handlers.executor
 import cockpit.interfaces.stageMover
 import cockpit.util.logger
 
+import collections
 import decimal
 import gc
 import os
@@ -77,6 +79,46 @@ lastExperiment = None
 # multiple files.
 generatedFilenames = []
 
+## Cache of generated ActionTables, so that rerunning an experiment with
+# the same parameters, e.g. at each site of a screen, does not generate
+# its table again.  Maps keys from Experiment.getActionTableKey to
+# CachedActionTable instances, least recently used first.
+actionTableCache = collections.OrderedDict()
+## Maximum number of tables to keep in actionTableCache.
+MAX_CACHED_ACTION_TABLES = 8
+
+## An ActionTable as generated by Experiment.generateActions and sorted,
+# with the Z position it was generated at and the state that generating
+# it set on the experiment.
+CachedActionTable = collections.namedtuple('CachedActionTable',
+        ['table', 'zStart', 'cameraToImageCount',
+         'cameraToIgnoredImageIndices', 'cameraToIsReady',
+         'lightToExposureTime'])
+
+def clearActionTableCache():
+    """Forget all cached ActionTables.
+    """
+    actionTableCache.clear()
+
+
+## Return a hashable version of value, for use in the keys of
+# actionTableCache.  Containers are converted to tuples and frozensets.
+# Other objects, e.g. handlers, are used as they are, except that analog
+# lines come with their indexed positions, since generateActions may use
+# those.  Raise TypeError if value contains something that cannot be
+# hashed.
+def _makeKey(value):
+    if isinstance(value, dict):
+        return frozenset((_makeKey(k), _makeKey(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_makeKey(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(_makeKey(v) for v in value)
+    elif isinstance(value, cockpit.handlers.executor.AnalogLineHandler):
+        return (value, _makeKey(value.positions))
+    hash(value)
+    return value
+
 def isRunning():
     """Is an experiment running?
     """
@@ -91,6 +133,20 @@ def isRunning():
 # You should make a subclass of this class to implement a specific experiment
 # type.
 class Experiment:
+    ## Whether the ActionTables of this experiment can be cached and
+    # replayed at other Z positions.  Only true for experiments whose
+    # generateActions moves the zPositioner relative to self.zStart, and
+    # that depends on nothing but the parameters in getActionTableKey.
+    canCacheActions = False
+    ## Attributes that are not parameters of the experiment, because they
+    # are set while running it or do not affect its ActionTable.  They are
+    # left out of the keys of cached ActionTables.
+    _nonParameterAttributes = {'table', 'zStart', 'altBottom',
+                               'initialAltitude', 'shouldAbort', '_run_thread',
+                               'savePath', 'metadata', 'cameraToImageCount',
+                               'cameraToIgnoredImageIndices',
+                               'lightToExposureTime'}
+
     ## This constructor accepts certain parameters that will be shared
     # by all experiment types.
     # \param numReps Number of repetitions of the experiment to perform.
@@ -254,12 +310,15 @@ class Experiment:
                     cameraToExcitation[camera] = max(cameraToExcitation[camera],
                                                      max_wavelength)
 
+            savingConfig = wx.GetApp().Config['saving']
             saver = dataSaver.DataSaver(self.cameras, self.numReps,
                                         self.cameraToImageCount,
                                         self.cameraToIgnoredImageIndices,
                                         self._run_thread, self.savePath,
                                         self.sliceHeight, self.generateTitles(),
-                                        cameraToExcitation)
+                                        cameraToExcitation,
+                                        savingConfig.getint('queue-budget'),
+                                        savingConfig.get('queue-overflow'))
             saver.startCollecting()
             saveThread = threading.Thread(target=saver.executeAndSave,
                                           name="Experiment-execute-save")
@@ -272,15 +331,71 @@ class Experiment:
         cleanup_thread.start()
         return True
 
-    ## Create an ActionTable by calling self.generateActions, and give our
+    ## Create an ActionTable by calling self.generateActions, or by reusing
+    # one from an earlier run with the same parameters, and give our
     # Devices a chance to sign off on it.
     def createValidActionTable(self):
-        self.table = self.generateActions()
-        self.table.sort()
+        key = self.getActionTableKey()
+        cached = actionTableCache.get(key) if key is not None else None
+        if cached is not None:
+            actionTableCache.move_to_end(key)
+            self.replayActionTable(cached)
+        else:
+            self.table = self.generateActions()
+            self.table.sort()
+            if key is not None:
+                actionTableCache[key] = CachedActionTable(
+                    self.table.copy(), self.zStart,
+                    dict(self.cameraToImageCount),
+                    {c: set(i) for c, i in self.cameraToIgnoredImageIndices.items()},
+                    dict(self.cameraToIsReady),
+                    {l: set(t) for l, t in self.lightToExposureTime.items()})
+                while len(actionTableCache) > MAX_CACHED_ACTION_TABLES:
+                    actionTableCache.popitem(last=False)
+        # Devices may set themselves up for the table when they examine
+        # it, so they do so even when the table was cached.
         self.examineActions()
         self.table.sort()
         self.table.enforcePositiveTimepoints()
 
+    ## Return a key that identifies the ActionTable that generateActions
+    # would make, or None if it should not be cached.  The key covers the
+    # experiment class, its parameters, and the configuration of the
+    # cameras and Z positioner that the table depends on, but not the
+    # position of the Z stack.
+    def getActionTableKey(self):
+        if not self.canCacheActions:
+            return None
+        parameters = {name: value for name, value in vars(self).items()
+                      if name not in self._nonParameterAttributes}
+        cameraConfig = [(camera, camera.getExposureMode(),
+                         camera.getExposureTime(isExact = True),
+                         camera.getMinExposureTime(isExact = True))
+                        for camera in self.cameras]
+        zConfig = None
+        if self.zPositioner is not None:
+            zConfig = (self.zPositioner.getMovementTime(0, self.sliceHeight),
+                       self.zPositioner.getMovementTime(self.zHeight, 0))
+        try:
+            return _makeKey((type(self), parameters, cameraConfig, zConfig))
+        except TypeError:
+            # Some parameter cannot be hashed.
+            return None
+
+    ## Use a cached ActionTable, moved from the Z position it was generated
+    # at to ours, and restore the state that generating it set.
+    def replayActionTable(self, cached):
+        self.table = cached.table.copy()
+        if self.zPositioner is not None and self.zStart != cached.zStart:
+            self.table.offsetParameters(self.zPositioner,
+                                        self.zStart - cached.zStart)
+        self.cameraToImageCount = dict(cached.cameraToImageCount)
+        self.cameraToIgnoredImageIndices = {
+            c: set(i) for c, i in cached.cameraToIgnoredImageIndices.items()}
+        self.cameraToIsReady = dict(cached.cameraToIsReady)
+        self.lightToExposureTime = {
+            l: set(t) for l, t in cached.lightToExposureTime.items()}
+
     ## Perform any necessary sanity checks to ensure that the environment is
     # set up properly. Raise an exception if anything is wrong.
     def sanityCheckEnvironment(self):
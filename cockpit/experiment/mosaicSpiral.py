@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from . import actionTable
+from . import experiment
+
+import decimal
+
+
+## This class takes an image at each of a list of XY positions, as one
+# hardware-timed ActionTable.  The mosaic uses it to image a stretch of
+# its spiral when the XY stage can be driven by an executor.  It is not
+# offered in the experiment dialogs, so it is not registered.
+class MosaicSpiralExperiment(experiment.Experiment):
+    ## \param xPositioner StagePositioner handler to move in X.
+    # \param yPositioner StagePositioner handler to move in Y.
+    # \param startPosition (x, y) position of the two positioners when
+    #        the experiment starts, from which the first move is made.
+    # \param positions List of (x, y) positions of the two positioners,
+    #        in the order to image them.
+    # Other parameters are as for Experiment; there is no Z stack, so
+    # zPositioner should be None.
+    def __init__(self, xPositioner, yPositioner, startPosition, positions,
+                 *args, **kwargs):
+        kwargs['otherHandlers'] = (list(kwargs.get('otherHandlers', []))
+                                   + [xPositioner, yPositioner])
+        super(MosaicSpiralExperiment, self).__init__(*args, **kwargs)
+        self.xPositioner = xPositioner
+        self.yPositioner = yPositioner
+        self.startPosition = tuple(startPosition)
+        self.positions = list(positions)
+
+
+    ## Move to each position in turn, wait for the stage to settle, then
+    # take an image.
+    def generateActions(self):
+        table = actionTable.ActionTable()
+        curTime = 0
+        prevPosition = self.startPosition
+        for x, y in self.positions:
+            motionTime, stabilizationTime = 0, 0
+            # Both axes move at once, so wait for the slower one.
+            for positioner, start, end in [
+                    (self.xPositioner, prevPosition[0], x),
+                    (self.yPositioner, prevPosition[1], y)]:
+                motion, stabilization = positioner.getMovementTime(start, end)
+                motionTime = max(motionTime, motion)
+                stabilizationTime = max(stabilizationTime, stabilization)
+            curTime += motionTime
+            table.addAction(curTime, self.xPositioner, x)
+            table.addAction(curTime, self.yPositioner, y)
+            curTime += stabilizationTime
+            prevPosition = (x, y)
+
+            for cameras, lightTimePairs in self.exposureSettings:
+                curTime = self.expose(curTime, cameras, lightTimePairs, table)
+                # Advance the time very slightly so that all exposures
+                # are strictly ordered.
+                curTime += decimal.Decimal('1e-10')
+            # Hold the stage still during the exposure.
+            table.addAction(curTime, self.xPositioner, x)
+            table.addAction(curTime, self.yPositioner, y)
+        return table
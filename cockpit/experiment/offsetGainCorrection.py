@@ -57,6 +57,7 @@ from cockpit import events
 from . import experiment
 from cockpit.gui import guiUtils
 import cockpit.handlers.camera
+import cockpit.util.Mrc
 import cockpit.util.datadoc
 import cockpit.util.threads
 import cockpit.util.userConfig
@@ -209,10 +210,8 @@ class OffsetGainCorrectionExperiment(experiment.Experiment):
                 XYSize = objective.getPixelSize(), ZSize = 0, 
                 wavelengths = wavelengths)
 
-        filehandle = open(self.savePath, 'wb')
-        cockpit.util.datadoc.writeMrcHeader(header, filehandle)
-        filehandle.write(results)
-        filehandle.close()
+        with cockpit.util.Mrc.MrcWriter(self.savePath, header) as writer:
+            writer.writeSecs(0, [results])
 
         self.cleanup()
         
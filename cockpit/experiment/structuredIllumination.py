@@ -159,6 +159,10 @@ def reorder_z_dim(data, order_packed, z_lengths, z_order, z_wanted):
 
 ## This class handles SI experiments.
 class SIExperiment(experiment.Experiment):
+    ## Z positions are relative to zStart, so tables can be replayed at
+    # other positions.
+    canCacheActions = True
+
     ## \param numAngles How many angles to perform -- sometimes we only want
     # to do 1 angle, for example.
     # \param collectionOrder Key from COLLECTION_ORDERS that indicates what
@@ -205,6 +209,16 @@ class SIExperiment(experiment.Experiment):
         self.handlerToBleachCompensation = bleachCompensations
 
 
+    ## The time to move back to zStart at the end of the table is worked
+    # out from zStart itself, so is part of the key.
+    def getActionTableKey(self):
+        key = experiment.Experiment.getActionTableKey(self)
+        if key is None:
+            return None
+        return (key, self.zPositioner.getMovementTime(self.zHeight,
+                                                      self.zStart))
+
+
     ## Generate a sequence of (angle, phase, Z) positions for SI experiments,
     # based on the order the user specified.
     def genSIPositions(self):
@@ -431,19 +445,11 @@ class SIExperiment(experiment.Experiment):
             z_lengths = cockpit.util.Mrc.adjusted_data_shape(nz_in_data,
                                                              header_z_lengths)
 
-        ## Read the extended header again separately.  It our case,
-        ## this is a struct made of int32 and float32, one per plane.
-        ## Its order also needs to be corrected.  We just fake a dtype
-        ## with the right number of bytes per plane for the extended
-        ## header.  We fake the struct by using multiple u1 per
-        ## element.
-        ext_header_stride = 4 * (doc.imageHeader.NumIntegers
-                                 + doc.imageHeader.NumFloats)
-        ext_header_dtype = ",".join(['u1']*ext_header_stride)
-        with open(self.savePath, "rb") as fh:
-            fh.seek(1024) # skip base header
-            ext_header = numpy.fromfile(fh, count=doc.getNPlanes(),
-                                        dtype=ext_header_dtype)
+        ## The extended header, as a view with a struct of int32 and
+        ## float32 per plane, in the order the planes are in the file.
+        ## Its order also needs to be corrected.
+        ext_header = cockpit.util.datadoc.getExtendedHeaderArray(
+            doc.image.Mrc.e, doc.imageHeader)
         assert doc.imageHeader.next == ext_header.nbytes, \
             "next value from datadoc differs from computed length"
         assert order_in[-2:] == ('y', 'x'), \
@@ -467,27 +473,23 @@ class SIExperiment(experiment.Experiment):
 
         ## Save to a new file, reusing the original base header since
         ## we don't actually changed anything there.
-        tmp_fh = tempfile.NamedTemporaryFile(delete=False)
-        cockpit.util.datadoc.writeMrcHeader(doc.imageHeader, tmp_fh)
-        ## Make sure the data is actually ordered for writing,
-        ## otherwise at this point the arrays might be making use of
-        ## views.
-        ext_header = numpy.ascontiguousarray(ext_header)
-        img_data = numpy.ascontiguousarray(img_data)
-        tmp_fh.write(ext_header)
-        tmp_fh.write(img_data)
-        tmp_fh.close()
+        tmp_fd, tmp_path = tempfile.mkstemp()
+        os.close(tmp_fd)
+        with cockpit.util.Mrc.MrcWriter(tmp_path, doc.imageHeader) as writer:
+            writer.writeExtHeader(0, ext_header)
+            writer.writeSecs(0, [img_data])
 
         ## We are going to swap the files now, so destroy the old
         ## datadoc which memmaps the old file or we won't be able to
         ## overwrite.
         del doc
         del img_data
+        del ext_header
 
         ## Windows needs to have the file removed first.
         if os.name == "nt":
             os.remove(self.savePath)
-        shutil.move(tmp_fh.name, self.savePath)
+        shutil.move(tmp_path, self.savePath)
         return
 
 
@@ -62,6 +62,10 @@ EXPERIMENT_NAME = 'Z-stack'
 
 ## This class handles classic Z-stack experiments.
 class ZStackExperiment(experiment.Experiment):
+    ## Z positions are relative to zStart, so tables can be replayed at
+    # other positions.
+    canCacheActions = True
+
     ## Create the ActionTable needed to run the experiment. We simply move to 
     # each Z-slice in turn, take an image, then move to the next.
     def generateActions(self):
@@ -194,7 +194,11 @@ class ViewPanel(wx.Panel):
         self.canvas.resetView()
 
         # Subscribe to new image events only after canvas is prepared.
-        events.subscribe("new image %s" % self.curCamera.name, self.onImage)
+        # Only the latest image is displayed, so we don't need to hold up
+        # the camera, nor see images that arrive faster than we can
+        # display them.
+        events.subscribe("new image %s" % self.curCamera.name, self.onImage,
+                         events.DELIVER_LATEST)
 
     ## React to the drawer changing, by updating our labels and colors.
     @cockpit.util.threads.callInMainThread
@@ -207,7 +211,11 @@ class ViewPanel(wx.Panel):
 
     ## Receive a new image and send it to our canvas.
     def onImage(self, data, *args):
-        self.canvas.setImage(data)
+        canvas = self.canvas
+        if canvas is None:
+            # Image was already queued when the view was disabled.
+            return
+        canvas.setImage(data)
         self.imagePos = None
 
 
@@ -63,6 +63,7 @@ from collections.abc import Iterable
 
 
 from cockpit.util import ftgl
+import ctypes
 import numpy
 from OpenGL.GL import *
 import numpy as np
@@ -123,10 +124,11 @@ class BaseGL():
 class Image(BaseGL):
     """ An class for rendering grayscale images from image data.
 
-    GL textures are generated once. GL stores textures as floats with a range of
-    0 to 1. We use the data.min and data.max of the incoming data to fill this
-    range to prevent loss of detail due to quantisation when rendering low dynamic
-    range images.
+    GL textures are allocated once for each image geometry, and frames are
+    uploaded to them as they are, through a pair of pixel buffer objects
+    that are used in turn.  The textures hold the raw data, and the fragment
+    shader maps the clipping points to black and white, so changing them
+    does not need the data to be uploaded again.
     """
     # Vertex shader glsl source
     _VS = """
@@ -145,25 +147,43 @@ class Image(BaseGL):
     _FS = """
     #version 120
     uniform sampler2D tex;
-    uniform float scale;
-    uniform float offset;
+    uniform float dataScale;
+    uniform float vmin;
+    uniform float vrange;
     uniform bool show_clip;
 
     void main()
     {
-        vec4 lum = clamp(offset + texture2D(tex, gl_TexCoord[0].st) / scale, 0., 1.);
+        float value = texture2D(tex, gl_TexCoord[0].st).r * dataScale;
+        float lum = clamp((value - vmin) / vrange, 0., 1.);
         if (show_clip) {
-            gl_FragColor = vec4(0., 0., lum.r == 0, 1.) + vec4(1., lum.r < 1., 1., 1.) * lum.r;
+            gl_FragColor = vec4(0., 0., lum == 0., 1.) + vec4(1., lum < 1., 1., 1.) * lum;
         } else {
-            gl_FragColor = vec4(lum.r, lum.r, lum.r, 1.);
+            gl_FragColor = vec4(lum, lum, lum, 1.);
         }
     }
     """
+    # Maps dtypes that are uploaded as they are to their texture internal
+    # format, GL type, and the value that GL normalises them by.  Other
+    # data is converted to float32.
+    _dtypeToGl = {
+        np.uint8: (GL_R8, GL_UNSIGNED_BYTE, 2**8 - 1),
+        np.uint16: (GL_R16, GL_UNSIGNED_SHORT, 2**16 - 1),
+        np.float32: (GL_R32F, GL_FLOAT, 1),
+    }
+
     def __init__(self):
         # Maximum texture edge size
         self._maxTexEdge = glGetInteger(GL_MAX_TEXTURE_SIZE)
         # Textures used to display this image.
         self._textures = []
+        # (nx, ny, tx, ty, internal format) the textures were allocated
+        # with, or None if they have not been.
+        self._texGeometry = None
+        # Pixel buffer objects used to upload data, and the index of the
+        # one to use next.
+        self._pbos = []
+        self._pboIndex = 0
         # New data flag
         self._update = False
         # Geometry as number of textures along each axis.
@@ -172,6 +192,8 @@ class Image(BaseGL):
         self.clipHighlight = False
         # Data
         self._data = None
+        # Multiplier from texture values to data values.
+        self._dataScale = 1
         # Minimum and maximum data value - used for setting greyscale range.
         self.dptp = 1
         self.dmin = 0
@@ -179,26 +201,20 @@ class Image(BaseGL):
         self.vmax = 1
         self.vmin = 0
 
-    @property
-    def scale(self):
-        return (self.vmax - self.vmin) / (self.dptp)
-
-    @property
-    def offset(self):
-        return - (self.vmin - self.dmin) / ((self.dptp * self.scale) or 1)
-
     def __del__(self):
-        """Clean up textures."""
+        """Clean up textures and buffers."""
         try:
             # On exit, textures may have already been cleaned up.
             glDeleteTextures(len(self._textures), self._textures)
+            if self._pbos:
+                glDeleteBuffers(len(self._pbos), self._pbos)
         except:
             pass
 
     def autoscale(self):
         """Fit grayscale to range covered by data."""
-        self.vmin = float(self._data.min())
-        self.vmax = float(self._data.max())
+        self.vmin = float(self.dmin)
+        self.vmax = float(self.dmin + self.dptp)
 
     def getDisplayRange(self):
         return (self.vmin, self.vmax)
@@ -208,60 +224,102 @@ class Image(BaseGL):
         self.vmin = float(vmin)
         self.vmax = float(vmax)
 
-    def setData(self, data):
+    def setData(self, data, dataRange=None):
+        """Set the data to display.
+
+        dataRange is the (min, max) of the data, if already known, e.g.
+        from the histogram.  Data types that textures cannot hold are
+        converted here, so that it is done by the caller's thread rather
+        than the main thread."""
+        if np.iscomplexobj(data):
+            data = data.real
+        if data.dtype.type not in self._dtypeToGl:
+            data = data.astype(np.float32)
+        data = np.ascontiguousarray(data)
+        if dataRange is None:
+            dataRange = (data.min(), data.max())
+        self.dmin = dataRange[0]
+        self.dptp = dataRange[1] - dataRange[0]
         self._data = data
         self._update = True
 
     def toggleClipHighlight(self, event=None):
         self.clipHighlight = not self.clipHighlight
 
+    def _allocateTextures(self, nx, ny, tx, ty, internalFormat):
+        """Make nx * ny textures of tx by ty pixels."""
+        ntex = nx * ny
+        if ntex > len(self._textures):
+            textures = glGenTextures(ntex - len(self._textures))
+            if isinstance(textures, Iterable):
+                self._textures.extend(textures)
+            else:
+                self._textures.append(textures)
+        elif ntex < len(self._textures):
+            glDeleteTextures(len(self._textures) - ntex, self._textures[ntex:])
+            del self._textures[ntex:]
+        for tex in self._textures:
+            glBindTexture(GL_TEXTURE_2D, tex)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE);
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE);
+            glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, tx, ty, 0,
+                         GL_RED, GL_FLOAT, None)
+        self._texGeometry = (nx, ny, tx, ty, internalFormat)
+
+    def _fillPBO(self, data):
+        """Copy data into the next PBO, and leave it bound."""
+        if not self._pbos:
+            self._pbos = list(glGenBuffers(2))
+        pbo = self._pbos[self._pboIndex]
+        self._pboIndex = (self._pboIndex + 1) % len(self._pbos)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+        # Orphan the old data store, so that we need not wait for any
+        # upload from it to finish.
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, data.nbytes, None, GL_STREAM_DRAW)
+        address = glMapBuffer(GL_PIXEL_UNPACK_BUFFER, GL_WRITE_ONLY)
+        ctypes.memmove(address, data.ctypes.data, data.nbytes)
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+
     def _createTextures(self):
-        """Convert data to textures.
+        """Upload data to textures.
 
         Needs GL context to be set prior to call, and should only
         be called in the main thread."""
         if self._data is None:
             return
         data = self._data
-        glPixelStorei(GL_UNPACK_SWAP_BYTES, False)
-        # Ensure the right number of textures available.
+        internalFormat, glType, self._dataScale = self._dtypeToGl[data.dtype.type]
         nx = int(np.ceil(data.shape[1] / self._maxTexEdge))
         ny = int(np.ceil(data.shape[0] / self._maxTexEdge))
         self.shape = (nx, ny)
-        ntex = nx * ny
-        if ntex > len(self._textures):
-            textures = glGenTextures(ntex - len(self._textures))
-            if isinstance(textures, Iterable):
-                self._textures.extend(textures)
-            else:
-                self._textures.append(textures)
-        elif ntex < len(self._textures):
-            glDeleteTextures(len(self._textures) - ntex)
-        if ntex == 1:
+        if nx * ny == 1:
             # Data will fit into a single texture.
-            # Do we need to round these up to a power of 2?
             ty, tx = data.shape
         else:
             # Need to use multiple textures to store data.
             tx = ty = self._maxTexEdge
-        self.dptp = data.ptp()
-        self.dmin = data.min()
-        if self.dptp < 1e-6:
-            self.dptp = 1
+        if self._texGeometry != (nx, ny, tx, ty, internalFormat):
+            self._allocateTextures(nx, ny, tx, ty, internalFormat)
+        self._fillPBO(data)
+        # Each texture is read from its part of the whole image.
+        glPixelStorei(GL_UNPACK_SWAP_BYTES, not data.dtype.isnative)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glPixelStorei(GL_UNPACK_ROW_LENGTH, data.shape[1])
         for i, tex in enumerate(self._textures):
             xoff = tx * (i % nx)
             yoff = ty * (i // nx)
-            subdata = (data[yoff:min(data.shape[0], yoff+ty),
-                           xoff:min(data.shape[1], xoff+tx)].astype(np.float32) - self.dmin) / self.dptp
+            width = min(data.shape[1] - xoff, tx)
+            height = min(data.shape[0] - yoff, ty)
+            offset = (yoff * data.shape[1] + xoff) * data.itemsize
             glBindTexture(GL_TEXTURE_2D, tex)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE);
-            glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, tx, ty, 0,
-                         GL_RED, GL_FLOAT, None)
-            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, subdata.shape[1], subdata.shape[0],
-                            GL_RED, GL_FLOAT, subdata)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height,
+                            GL_RED, glType, ctypes.c_void_p(offset))
+        glPixelStorei(GL_UNPACK_ROW_LENGTH, 0)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+        glPixelStorei(GL_UNPACK_SWAP_BYTES, False)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
         self._update = False
 
     def draw(self, pan=(0,0), zoom=1):
@@ -292,8 +350,10 @@ class Image(BaseGL):
         # Update shader parameters
         glUniform2f(glGetUniformLocation(shader, "pan"), pan[0], pan[1])
         glUniform1i(glGetUniformLocation(shader, "tex"), 0)
-        glUniform1f(glGetUniformLocation(shader, "scale"), self.scale)
-        glUniform1f(glGetUniformLocation(shader, "offset"), self.offset)
+        glUniform1f(glGetUniformLocation(shader, "dataScale"), self._dataScale)
+        glUniform1f(glGetUniformLocation(shader, "vmin"), self.vmin)
+        glUniform1f(glGetUniformLocation(shader, "vrange"),
+                    (self.vmax - self.vmin) or 1)
         glUniform1f(glGetUniformLocation(shader, "zoom"), zoom)
         glUniform1i(glGetUniformLocation(shader, "show_clip"), self.clipHighlight)
         # Render
@@ -331,6 +391,14 @@ class Image(BaseGL):
 
 
 class Histogram(BaseGL):
+    ## Number of bins displayed.
+    nbins = 64
+    ## Number of shifted bin sets averaged, to avoid binning artefacts.
+    nshifts = 4
+    ## Images with more pixels than this are subsampled, taking every
+    # n'th pixel along each axis.
+    maxSamples = 2**20
+
     def __init__(self):
         self.bins = None
         self.counts = None
@@ -338,6 +406,9 @@ class Histogram(BaseGL):
         self.ubound = None
         self.lthresh = None
         self.uthresh = None
+        ## Minimum and maximum values of the data.
+        self.dataMin = None
+        self.dataMax = None
 
 
     def data2gl(self, val):
@@ -354,22 +425,54 @@ class Histogram(BaseGL):
         #   start points 0, h/m, 2h/m, ..., (m-1)h/m
         # 1 < m < 64
         # sum to average
+        #
+        # Every shifted bin edge lies on a fine grid of spacing h/m, so
+        # the data is counted once on that grid and the m histograms are
+        # summed from its cumulative counts.
+        nbins, m = self.nbins, self.nshifts
+        stride = int(np.ceil(np.sqrt(data.size / self.maxSamples))) or 1
+        sample = data[::stride, ::stride] if stride > 1 else data
+        isSmallUint = (np.issubdtype(data.dtype, np.unsignedinteger)
+                       and data.dtype.itemsize <= 2)
+        if isSmallUint:
+            # Count each raw value; the rest works on these counts.
+            valueCounts = np.bincount(sample.ravel())
+            present = np.flatnonzero(valueCounts)
+        if isSmallUint and stride == 1:
+            self.dataMin, self.dataMax = int(present[0]), int(present[-1])
+        else:
+            self.dataMin, self.dataMax = data.min(), data.max()
         if self.lbound is None:
-            self.lbound = data.min()
+            self.lbound = self.dataMin
         if self.ubound is None:
-            self.ubound = data.max()
+            self.ubound = self.dataMax
         if self.lthresh is None:
             self.lthresh = self.lbound
         if self.uthresh is None:
             self.uthresh = self.ubound
-        nbins = 64
-        m = 4
-        self.bins = np.linspace(data.min(), data.max(), nbins)
-        self.counts = np.zeros(nbins)
-        h = self.bins[1] - self.bins[0]
-        for i in range(m):
-            these = np.bincount(np.digitize(data.flat, self.bins + i*h/m, right=True), minlength=nbins)
-            self.counts += these[0:nbins]
+        self.bins = np.linspace(self.dataMin, self.dataMax, nbins)
+        fineWidth = (self.bins[1] - self.bins[0]) / m
+        numFine = (nbins - 1) * m + 1
+        if isSmallUint:
+            values = np.arange(present[0], present[-1] + 1)
+            weights = valueCounts[present[0]:]
+        else:
+            values = sample.ravel()
+            weights = None
+        if fineWidth:
+            # Values on a bin edge belong to the bin below it.
+            fine = np.ceil((values - self.dataMin) / fineWidth)
+            fine = np.clip(fine, 0, numFine - 1).astype(np.intp)
+        else:
+            fine = np.zeros(len(values), dtype=np.intp)
+        cumulative = np.cumsum(np.bincount(fine, weights, numFine))
+        # Shifted histogram i has bin k covering fine indices
+        # ((k - 1) * m + i, k * m + i].
+        upper = np.arange(nbins)[:, np.newaxis] * m + np.arange(m)
+        lower = upper - m
+        below = lambda index: np.where(index < 0, 0,
+                                       cumulative[np.clip(index, 0, numFine - 1)])
+        self.counts = (below(upper) - below(lower)).sum(axis=1).astype(float)
 
     def draw(self):
         if self.counts is None:
@@ -379,12 +482,16 @@ class Histogram(BaseGL):
         self.ubound = max(self.bins.max()+binw, self.uthresh+binw)
         w = self.ubound - self.lbound
         glUseProgram(self.getShader())
-        v = []
-        for (x, y) in zip(self.bins, self.counts):
-            x0 = self.data2gl(x)
-            x1 = self.data2gl(x + binw)
-            h = -1 + 2 * y / (self.counts.max() or 1)
-            v.extend( [(x0, -1), (x0, h), (x1, h), (x1, -1)] )
+        x0 = self.data2gl(self.bins)
+        x1 = self.data2gl(self.bins + binw)
+        h = -1 + 2 * self.counts / (self.counts.max() or 1)
+        # One quad per bin.
+        v = np.empty((len(self.bins), 4, 2))
+        v[:, :2, 0] = x0[:, np.newaxis]
+        v[:, 2:, 0] = x1[:, np.newaxis]
+        v[:, (0, 3), 1] = -1
+        v[:, 1:3, 1] = h[:, np.newaxis]
+        v = v.reshape(-1, 2)
         glEnableClientState(GL_VERTEX_ARRAY)
         glVertexPointerf(v)
         glColor(.8, .8, .8, 1)
@@ -560,7 +667,8 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
             if self.showFFT:
                 self.image.setData(np.log(np.fft.fftshift(np.fft.fft2(self.imageData))))
             else:
-                self.image.setData(newImage)
+                self.image.setData(newImage, (self.histogram.dataMin,
+                                              self.histogram.dataMax))
             if shouldResetView:
                 self.resetView()
             if isFirstImage:
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import scipy.ndimage
+import scipy.spatial
+
+## This module finds isolated, round beads in mosaic tiles.  It has no
+# GUI or hardware dependencies, so that findBeadsInComposite can be run
+# in worker processes.
+
+## Size in pixels of the regions beads are examined in.  A bead must be
+# the only signal within a quarter of this of its centroid, as it must
+# be the only one in a region with its centroid in the middle half.
+REGION_SIZE = 300
+## Pixels brighter than the median plus this many standard deviations
+# are signal.
+THRESHOLD_STDS = 15
+## Minimum ratio of a bead's area to the area of the smallest circle,
+# centred on its centroid, that holds all of its pixels.
+MIN_CIRCULARITY = .6
+## Minimum distance in microns between bead sites.
+MIN_SITE_DISTANCE = 40
+## Beads are focused by looking this many microns above and below them,
+FOCUS_RANGE = 1
+## in steps of this many microns.
+FOCUS_STEP = .1
+
+
+## Find beads in the central tile of a composite image, as made by
+# MosaicCanvas.getCompositeTileData: the tile with its neighbours around
+# it, so three tiles wide and high.
+#
+# The composite is thresholded and labelled once, and every component is
+# measured at the same time.  A component is a bead if its centroid is
+# in the central tile, it is round enough, and no other component has
+# pixels in the square that reaches regionSize / 4 from its centroid.
+#
+# Returns an (N, 4) array of the beads' (x, y, size, intensity), where
+# x and y are the centroid in pixels relative to the central tile, size
+# is the number of pixels in the bead, and intensity is their mean value.
+def findBeadsInComposite(data, regionSize = REGION_SIZE,
+                         thresholdStds = THRESHOLD_STDS,
+                         minCircularity = MIN_CIRCULARITY):
+    result = numpy.zeros((0, 4))
+    threshold = numpy.median(data) + numpy.std(data) * thresholdStds
+    labeled, numComponents = scipy.ndimage.label(data > threshold)
+    if not numComponents:
+        return result
+    yVals, xVals = numpy.nonzero(labeled)
+    labels = labeled[yVals, xVals]
+    # Per-component sums, indexed by label; label 0 is the background.
+    counts = numpy.bincount(labels, minlength = numComponents + 1)
+    counts[0] = 1
+    xCenters = numpy.bincount(labels, xVals, numComponents + 1) / counts
+    yCenters = numpy.bincount(labels, yVals, numComponents + 1) / counts
+    intensities = numpy.bincount(labels, data[yVals, xVals],
+                                 numComponents + 1) / counts
+    distSquared = ((xVals - xCenters[labels]) ** 2 +
+                   (yVals - yCenters[labels]) ** 2)
+    maxDistSquared = numpy.zeros(numComponents + 1)
+    numpy.maximum.at(maxDistSquared, labels, distSquared)
+    # Single pixels have no radius; treat them as filling a circle.
+    circleAreas = numpy.maximum(numpy.pi * maxDistSquared, 1)
+
+    height, width = data.shape[0] // 3, data.shape[1] // 3
+    isCandidate = ((counts / circleAreas >= minCircularity) &
+                   (xCenters >= width) & (xCenters < 2 * width) &
+                   (yCenters >= height) & (yCenters < 2 * height))
+    isCandidate[0] = False
+
+    beads = []
+    halfSize = regionSize // 4
+    for label in numpy.flatnonzero(isCandidate):
+        x, y = int(xCenters[label]), int(yCenters[label])
+        region = labeled[max(0, y - halfSize):y + halfSize,
+                         max(0, x - halfSize):x + halfSize]
+        if numpy.any((region != 0) & (region != label)):
+            # Another bead, or other signal, is nearby.
+            continue
+        beads.append((xCenters[label] - width, yCenters[label] - height,
+                      counts[label], intensities[label]))
+    if beads:
+        result = numpy.array(beads)
+    return result
+
+
+## Given an (N, D) array of positions, return the indices of the ones to
+# keep so that none are within minDistance of each other.  Earlier
+# positions win.
+def removeCrowdedSites(positions, minDistance = MIN_SITE_DISTANCE):
+    positions = numpy.asarray(positions)
+    if not len(positions):
+        return numpy.zeros(0, dtype = int)
+    tree = scipy.spatial.cKDTree(positions)
+    isRejected = numpy.zeros(len(positions), dtype = bool)
+    keep = []
+    # Go through the positions in order, rejecting the neighbours of
+    # each one that is kept.
+    neighbours = tree.query_ball_point(positions, minDistance)
+    for i in range(len(positions)):
+        if isRejected[i]:
+            continue
+        keep.append(i)
+        isRejected[neighbours[i]] = True
+    return numpy.array(keep, dtype = int)
+
+
+## Given arrays of the sizes and intensities of bead sites, return a
+# boolean array of the ones to keep.  Sites are rejected if they are:
+# - too large (probably conjoined or overlapping beads)
+# - too bright (ditto)
+# - too dim (bad signal:noise ratio)
+# - too small (Could just be autoflourescing dust or something)
+# Part of the trick here is that many beads may be slightly out of
+# focus, so these constraints can't actually be all that tight.
+def filterSites(sizes, intensities):
+    sizes = numpy.asarray(sizes, dtype = float)
+    intensities = numpy.asarray(intensities, dtype = float)
+    if not len(sizes):
+        return numpy.zeros(0, dtype = bool)
+    sizeMedian = numpy.median(sizes)
+    sizeStd = numpy.std(sizes)
+    intenMedian = numpy.median(intensities)
+    intenStd = numpy.std(intensities)
+    return ((sizes >= sizeMedian - sizeStd * .5) &
+            (sizes <= sizeMedian + sizeStd * 2) &
+            (numpy.abs(intensities - intenMedian) <= intenStd * 5))
+
+
+## Return how well focused the bead in the image is: the brightest pixel
+# after a 3x3 median filter, so that hot pixels, which are single bright
+# pixels, do not count.
+def getFocusScore(image):
+    return scipy.ndimage.median_filter(image, size = 3).max()
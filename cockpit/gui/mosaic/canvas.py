@@ -59,11 +59,16 @@ import wx.glcanvas
 
 from cockpit import depot
 from cockpit import events
-from .tile import Tile, MegaTile
-import cockpit.util.datadoc
+from .tile import Tile, MegaTile, TileGrid, textureCache, spanHistograms
+from .tileStore import TileStore
+from . import mosaicFile
 import cockpit.util.logger
 import cockpit.util.threads
+import collections
+import concurrent.futures
 import itertools
+import math
+import os
 import queue
 import time
 import numpy as np
@@ -71,6 +76,10 @@ import numpy as np
 ## Zoom level at which we switch from rendering megatiles to rendering tiles.
 ZOOM_SWITCHOVER = 1
 BUFFER_LENGTH = 32
+## Number of threads reading tile data when loading a mosaic.
+LOAD_THREADS = 4
+## Maximum number of tiles to read ahead when loading a mosaic.
+MAX_PREFETCH_TILES = 1024
 
 ## This class handles drawing the mosaic. Mosaics consist of collections of 
 # images from the cameras.
@@ -78,13 +87,38 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     ## Tiles and context are shared amongst all instances, since all
     # offer views of the same data.
     # The first instance creates the context.
-    ## List of MegaTiles. These will be created in self.initGL.
+    ## List of MegaTiles, of all levels. These will be created in
+    # self.initGL.
     megaTiles = []
+    ## Spatial index of the MegaTiles of each level of the pyramid.
+    pyramid = []
+    ## MegaTiles that have their texture allocated, least recently
+    # displayed first.
+    allocatedMegaTiles = collections.OrderedDict()
+    ## Generator from iterUnbuiltMegaTiles of the megatiles to render in
+    # idle time, or None if there are none.
+    megaTileBuilder = None
+    ## Megatiles last displayed, which keep their textures while others
+    # are rendered in idle time.
+    shownMegaTiles = []
+    ## Maximum number of bytes of video memory to use for megatile
+    # textures.  Megatiles that are out of view are discarded to stay
+    # within it, and rendered again when they come back into view.  This
+    # is set from the config by the first instance.
+    megaTileBudget = 2**30
     ## List of Tiles. These are created as we receive new images from
     # our parent.
     tiles = []
-    ## Set of tiles that need to be rerendered in the next onPaint call.
-    tilesToRefresh = set()
+    ## Spatial index of the tiles, used to find those in a region.
+    tileGrid = TileGrid()
+    ## TileStore holding the image data of the tiles. This will be created
+    # by the first instance.
+    tileStore = None
+    ## Directory to autosave new tiles to, or None to not autosave.
+    autosaveDir = None
+    ## MosaicWriter of the autosave file. This will be created when the
+    # first tile is autosaved.
+    autosaveWriter = None
     ## WX rendering context
     context = None
 
@@ -115,6 +149,12 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             MosaicCanvas.context = wx.glcanvas.GLContext(self)
             # Hook up onIdle - only one instance needs to process new tiles.
             self.Bind(wx.EVT_IDLE, self.onIdle)
+            config = wx.GetApp().Config['mosaic']
+            MosaicCanvas.tileStore = TileStore(config.get('store-dir') or None)
+            MosaicCanvas.autosaveDir = config.get('autosave-dir') or None
+            textureCache.setBudget(config.getint('texture-budget') * 2**20)
+            MosaicCanvas.megaTileBudget = (config.getint('megatile-budget')
+                                           * 2**20)
 
         ## Error that occurred when rendering. If this happens, we prevent
         # further rendering to avoid error spew.
@@ -135,6 +175,10 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     # MegaTiles.
     def initGL(self):
         glClearColor(1, 1, 1, 0)
+        self.haveInitedGL = True
+        if self.megaTiles:
+            # Another instance already created them.
+            return
 
         # Non-zero objective offsets require expansion of area covered
         # by megatiles.
@@ -173,23 +217,172 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
         xMax += max(0, xOffLim[1]) + MegaTile.micronSize
         yMin += min(0, yOffLim[0]) - 2*MegaTile.micronSize
         yMax += max(0, yOffLim[1]) + 2*MegaTile.micronSize
-        for x in np.arange(xMin, xMax, MegaTile.micronSize):
-            for y in np.arange(yMin, yMax, MegaTile.micronSize):
-                self.megaTiles.append(MegaTile((-x, y)))
-        self.haveInitedGL = True
+        xs = [-x for x in np.arange(xMin, xMax, MegaTile.micronSize)]
+        ys = np.arange(yMin, yMax, MegaTile.micronSize)
+        left = min(xs)
+        right = max(xs) + MegaTile.micronSize
+        bottom = min(ys)
+        top = max(ys) + MegaTile.micronSize
+        # Each level of the pyramid covers the same area with half as
+        # many megatiles along each axis as the previous level, up to a
+        # single megatile.
+        level = 0
+        while True:
+            step = MegaTile.micronSize * 2 ** level
+            if level:
+                xs = np.arange(left, right, step)
+                ys = np.arange(bottom, top, step)
+            grid = TileGrid(step)
+            for x in xs:
+                for y in ys:
+                    megaTile = MegaTile((x, y), level)
+                    self.megaTiles.append(megaTile)
+                    grid.add(megaTile)
+            self.pyramid.append(grid)
+            if len(xs) <= 1 and len(ys) <= 1:
+                break
+            level += 1
+        # Account for any tiles that arrived before the megatiles.
+        for megaTile, tiles in self.getMegaTilesFor(self.tiles).items():
+            megaTile.numTiles += len(tiles)
+        MosaicCanvas.megaTileBuilder = self.iterUnbuiltMegaTiles()
 
 
-    ## Because tiles have been changed, we must now rerender all of
-    # our megatiles. Don't do this often, and definitely not when
-    # other threads need attention.
+    ## Because tiles have been changed, we must now rerender some of
+    # our megatiles. We discard their textures, and they are rendered
+    # again in idle time, or when next displayed.
     # \param tiles Which tiles to rerender. Default to rerendering all.
     def rerenderMegatiles(self, tiles = None):
         self.SetCurrent(self.context)
         if tiles is None:
-            tiles = self.megaTiles
+            tiles = list(self.allocatedMegaTiles)
+        for tile in tiles:
+            self.discardMegaTile(tile)
+        MosaicCanvas.megaTileBuilder = self.iterUnbuiltMegaTiles()
+
+
+    ## Return a dict mapping each megatile, of every level, that intersects
+    # any of the given tiles to the list of those tiles, in the given order.
+    def getMegaTilesFor(self, tiles):
+        megaTileToTiles = {}
         for tile in tiles:
-            tile.recreateTexture()
-            tile.prerenderTiles(self.tiles, self)
+            for grid in self.pyramid:
+                for megaTile in grid.getIntersecting(tile.box):
+                    megaTileToTiles.setdefault(megaTile, []).append(tile)
+        return megaTileToTiles
+
+
+    ## Return the level of the pyramid to display at our current zoom: the
+    # coarsest level that still has at least one texture pixel per screen
+    # pixel.
+    def getPyramidLevel(self):
+        # Level 0 has MegaTile.pixelSize / MegaTile.micronSize pixels per
+        # micron, and each level up has half as many.
+        level = math.floor(math.log2(MegaTile.pixelSize
+                                     / (MegaTile.micronSize * self.scale)))
+        return min(max(level, 0), len(self.pyramid) - 1)
+
+
+    ## Return the megatiles, with tiles, of the level below the given
+    # megatile that it is rendered from.  There are at most four.
+    def getChildMegaTiles(self, megaTile):
+        # Shrink the box so as to skip neighbours that only touch it.
+        (x1, y1), (x2, y2) = megaTile.box
+        margin = megaTile.micronSize / 4
+        children = self.pyramid[megaTile.level - 1].getIntersecting(
+                ((x1 + margin, y1 + margin), (x2 - margin, y2 - margin)))
+        return [child for child in children if child.numTiles]
+
+
+    ## Render the given megatile, which has no texture yet.  Only level 0
+    # of the pyramid is rendered from the tiles.  Higher levels are
+    # rendered from the megatiles below them, which are rendered first if
+    # needed, so that no megatile ever renders more than four textures
+    # other than at level 0.
+    # \param keep Megatiles whose textures must be kept meanwhile.
+    def buildMegaTile(self, megaTile, keep = ()):
+        if megaTile.level == 0:
+            sources = self.tileGrid.getIntersecting(megaTile.box)
+        else:
+            sources = self.getChildMegaTiles(megaTile)
+            keep = list(keep) + sources
+            for child in sources:
+                if child in self.allocatedMegaTiles:
+                    self.allocatedMegaTiles.move_to_end(child)
+                else:
+                    self.buildMegaTile(child, keep)
+                    # Free the textures that the child was rendered from.
+                    self.discardOldMegaTiles(keep)
+        megaTile.prerenderTiles(sources, self)
+        if megaTile.haveAllocatedMemory:
+            self.allocatedMegaTiles[megaTile] = True
+
+
+    ## Generate the megatiles with tiles that have no texture, from the
+    # given ones down, each after the megatiles below it that it is
+    # rendered from.  Defaults to the whole pyramid.
+    def iterUnbuiltMegaTiles(self, megaTiles = None):
+        if megaTiles is None:
+            megaTiles = [megaTile for megaTile in self.megaTiles
+                         if megaTile.level == len(self.pyramid) - 1]
+        for megaTile in megaTiles:
+            if (megaTile.numTiles
+                    and megaTile not in self.allocatedMegaTiles):
+                if megaTile.level:
+                    yield from self.iterUnbuiltMegaTiles(
+                            self.getChildMegaTiles(megaTile))
+                yield megaTile
+
+
+    ## Render megatiles from MosaicCanvas.megaTileBuilder for up to 50ms.
+    # Return True if there are more to render.
+    def buildMegaTilesInIdle(self):
+        self.SetCurrent(self.context)
+        t = time.time()
+        for megaTile in self.megaTileBuilder:
+            if (megaTile.numTiles
+                    and megaTile not in self.allocatedMegaTiles):
+                self.buildMegaTile(megaTile, self.shownMegaTiles)
+                self.discardOldMegaTiles([megaTile] + self.shownMegaTiles)
+            if time.time() - t >= 0.05:
+                return True
+        MosaicCanvas.megaTileBuilder = None
+        return False
+
+
+    ## Free the texture of the given megatile.
+    def discardMegaTile(self, megaTile):
+        megaTile.wipe()
+        self.allocatedMegaTiles.pop(megaTile, None)
+
+
+    ## Discard the least recently displayed megatiles, other than the given
+    # ones, until we are within megaTileBudget.
+    def discardOldMegaTiles(self, keep):
+        textureBytes = MegaTile.pixelSize ** 2 * MegaTile.bytesPerPixel
+        maxTextures = max(self.megaTileBudget // textureBytes, len(keep))
+        keep = set(keep)
+        for megaTile in list(self.allocatedMegaTiles):
+            if len(self.allocatedMegaTiles) <= maxTextures:
+                break
+            if megaTile not in keep:
+                self.discardMegaTile(megaTile)
+
+
+    ## Return the megatiles to display in the given view box, rendering
+    # any that are not yet rendered.
+    def prepareMegaTiles(self, viewBox):
+        megaTiles = [megaTile for megaTile
+                     in self.pyramid[self.getPyramidLevel()].getIntersecting(viewBox)
+                     if megaTile.numTiles]
+        for megaTile in megaTiles:
+            if megaTile not in self.allocatedMegaTiles:
+                self.buildMegaTile(megaTile, megaTiles)
+            else:
+                self.allocatedMegaTiles.move_to_end(megaTile)
+        self.discardOldMegaTiles(megaTiles)
+        MosaicCanvas.shownMegaTiles = megaTiles
+        return megaTiles
 
 
     ## Delete all tiles and textures, including the megatiles.
@@ -201,18 +394,10 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     ## Get all tiles that intersect the specified box, pulling from the provided
     # list, or from all tiles if no list is provided.
     def getTilesIntersecting(self, start, end, allowedTiles = None):
-        if allowedTiles is None:
-            allowedTiles = self.tiles
-        x1 = min(start[0], end[0])
-        x2 = max(start[0], end[0])
-        y1 = min(start[1], end[1])
-        y2 = max(start[1], end[1])
-        start = (x1, y1)
-        end = (x2, y2)
-        tiles = []
-        for tile in allowedTiles:
-            if tile.intersectsBox((start, end)):
-                tiles.append(tile)
+        tiles = self.tileGrid.getIntersecting((start, end))
+        if allowedTiles is not None:
+            allowedTiles = set(allowedTiles)
+            tiles = [tile for tile in tiles if tile in allowedTiles]
         return tiles
 
 
@@ -243,11 +428,11 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             xMax = min(end[0], altTile.pos[0] + altTile.size[0])
             yMin = max(start[1], altTile.pos[1])
             yMax = min(end[1], altTile.pos[1] + altTile.size[1])
-            xPixels = (xMax - xMin) // pixelSize[0]
-            yPixels = (yMax - yMin) // pixelSize[1]
+            xPixels = int((xMax - xMin) // pixelSize[0])
+            yPixels = int((yMax - yMin) // pixelSize[1])
             # Get the offset into altTile, and thus the relevant pixel data.
-            altX = (xMin - altTile.pos[0]) / pixelSize[0]
-            altY = (yMin - altTile.pos[1]) / pixelSize[1]
+            altX = int((xMin - altTile.pos[0]) / pixelSize[0])
+            altY = int((yMin - altTile.pos[1]) / pixelSize[1])
             subRegion = altTile.textureData[altX:altX + xPixels, altY:altY + yPixels]
             if 0 in subRegion.shape:
                 # The intersection is tangential; unlikely but can happen. 
@@ -261,9 +446,12 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             # while accounting for the difference in aspect ratio.
             tX = rY * (float(tileShape[0]) / tileShape[1])
             tY = rX * (float(tileShape[1]) / tileShape[0])
-            rX, rY = tX, tY
+            rX, rY = int(tX), int(tY)
             target = result[rX:rX + xPixels, rY:rY + yPixels]
-            target[:] = subRegion
+            # Rounding can leave the two a pixel apart in size.
+            rows = min(target.shape[0], subRegion.shape[0])
+            columns = min(target.shape[1], subRegion.shape[1])
+            target[:rows, :columns] = subRegion[:rows, :columns]
 
         return result
 
@@ -280,61 +468,112 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     def deleteTilesList(self, tilesToDelete):
         for tile in tilesToDelete:
             tile.wipe()
-            del self.tiles[self.tiles.index(tile)]
+            self.tileGrid.remove(tile)
+        deleted = set(tilesToDelete)
+        # Modify the list in place, since it is shared by all instances.
+        self.tiles[:] = [tile for tile in self.tiles if tile not in deleted]
+        if not self.tiles:
+            # Reclaim the disk space.
+            self.tileStore.clear()
         self.SetCurrent(self.context)
 
         # Rerender all megatiles that are now invalid.
-        dirtied = []
-        for megaTile in self.megaTiles:
-            for tile in tilesToDelete:
-                if megaTile.intersectsBox(tile.box):
-                    dirtied.append(megaTile)
-                    break
-        self.rerenderMegatiles(dirtied)
+        dirtied = self.getMegaTilesFor(tilesToDelete)
+        for megaTile, tiles in dirtied.items():
+            megaTile.numTiles -= len(tiles)
+        self.rerenderMegatiles(list(dirtied))
         self.Refresh()
         events.publish('mosaic update')
 
 
     def onIdle(self, event):
         if self.pendingImages.empty():# or not self.IsShownOnScreen():
+            # Render the pyramid over the tiles we have, a bit at a time,
+            # rather than all at once when first zoomed out.
+            if (self.megaTileBuilder is not None
+                    and self.buildMegaTilesInIdle()):
+                event.RequestMore()
             return
         # Draw as many images as possible in 50ms.
         t = time.time()
         newTiles = []
-        self.SetCurrent(self.context)
         while not self.pendingImages.empty() and (time.time()-t < 0.05):
             data, pos, size, scalings, layer = self.pendingImages.get()
             newTiles.append(Tile(data, pos, size, scalings, layer))
-        self.tiles.extend(newTiles)
-        for megaTile in self.megaTiles:
-            megaTile.prerenderTiles(newTiles, self)
+        self.addTiles(newTiles)
+        if not self.pendingImages.empty():
+            event.RequestMore()
 
-        self.tilesToRefresh.update(newTiles)
+
+    ## Add a list of Tiles to the mosaic.
+    @cockpit.util.threads.callInMainThread
+    def addTiles(self, newTiles):
+        self.SetCurrent(self.context)
+        self.tiles.extend(newTiles)
+        for tile in newTiles:
+            self.tileGrid.add(tile)
+        # Megatiles that are already rendered are updated now; the others
+        # will be rendered in idle time, or when displayed.
+        for megaTile, tiles in self.getMegaTilesFor(newTiles).items():
+            megaTile.numTiles += len(tiles)
+            if megaTile in self.allocatedMegaTiles:
+                megaTile.prerenderTiles(tiles, self)
+        MosaicCanvas.megaTileBuilder = self.iterUnbuiltMegaTiles()
 
         self.Refresh()
         events.publish('mosaic update')
-        if not self.pendingImages.empty():
-            event.RequestMore()
 
 
-    ## Add a new image to the mosaic.
+    ## Add a new image to the mosaic.  The image data is copied to our
+    # TileStore straight away, so the caller may reuse it.
     #@cockpit.util.threads.callInMainThread
     def addImage(self, data, pos, size, scalings=(None, None), layer=0):
+        data = self.tileStore.add(data)
+        if self.autosaveDir:
+            self.autosaveImage(data, pos, size, scalings, layer)
         self.pendingImages.put((data, pos, size, scalings, layer))
 
 
-    ## Rescale the tiles.
+    ## Append a new image to the autosave file, creating the file if needed.
+    def autosaveImage(self, data, pos, size, scalings, layer):
+        if MosaicCanvas.autosaveWriter is None:
+            path = os.path.join(self.autosaveDir,
+                                time.strftime('mosaic-%Y%m%d-%H%M%S')
+                                + mosaicFile.EXTENSION)
+            MosaicCanvas.autosaveWriter = mosaicFile.MosaicWriter(path)
+        minVal, maxVal = scalings
+        if minVal is None:
+            minVal = data.min()
+        if maxVal is None:
+            maxVal = data.max()
+        try:
+            MosaicCanvas.autosaveWriter.addTile(data, pos, size,
+                                                (minVal, maxVal), layer)
+        except Exception as e:
+            cockpit.util.logger.log.error("Failed to autosave mosaic tile: %s", e)
+
+
+    ## Rescale the tiles.  Tiles are windowed as they are drawn, so this
+    # only changes their histogram scales; nothing is uploaded or
+    # rerendered.
     # \param minMax A (blackpoint, whitepoint) tuple, or None to rescale
-    # each tile individually.
+    # each tile individually.  Megatiles then span the scales of the
+    # tiles in them.
     @cockpit.util.threads.callInMainThread
     def rescale(self, minMax = None):
         if minMax is None:
             # Tiles will treat this as "use our own data".
-            minMax = (None, None)
-        for tile in self.tiles:
-            tile.scaleHistogram(*minMax)
-        self.tilesToRefresh.update(self.tiles)
-        self.rerenderMegatiles()
+            for tile in self.tiles:
+                tile.scaleHistogram()
+            for megaTile in self.allocatedMegaTiles:
+                tiles = self.tileGrid.getIntersecting(megaTile.box)
+                if tiles:
+                    megaTile.scaleHistogram(*spanHistograms(tiles))
+        else:
+            for tile in self.tiles:
+                tile.scaleHistogram(*minMax)
+            for megaTile in self.megaTiles:
+                megaTile.scaleHistogram(*minMax)
         self.Refresh()
 
 
@@ -351,6 +590,15 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             if not self.haveInitedGL:
                 self.initGL()
 
+            ## Paint the megatiles if we're zoomed out, or the
+            # normal tiles if we're zoomed in.  Megatiles are rendered
+            # first, as that changes the viewport.
+            viewBox = self.getViewBox()
+            if self.scale < ZOOM_SWITCHOVER:
+                tilesToRender = self.prepareMegaTiles(viewBox)
+            else:
+                tilesToRender = self.tileGrid.getIntersecting(viewBox)
+
             width, height = self.GetClientSize()
 
             glViewport(0, 0, width, height)
@@ -359,26 +607,15 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             glOrtho(-.375, width - .375, -.375, height - .375, 1, -1)
             glMatrixMode(GL_MODELVIEW)
 
-            for tile in self.tilesToRefresh:
-                tile.refresh()
-            self.tilesToRefresh = set()
-
             glMatrixMode(GL_MODELVIEW)
             glLoadIdentity()
             glTranslated(self.dx, self.dy, 0)
             glScaled(self.scale, self.scale, 1)
 
             glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-            ## Paint the megatiles if we're zoomed out, or the
-            # normal tiles if we're zoomed in.
             glEnable(GL_TEXTURE_2D)
-            viewBox = self.getViewBox()
-            if self.scale < ZOOM_SWITCHOVER:
-                for megaTile in self.megaTiles:
-                    megaTile.render(viewBox)
-            else:
-                for tile in self.tiles:
-                    tile.render(viewBox)
+            for tile in tilesToRender:
+                tile.render(viewBox)
             glDisable(GL_TEXTURE_2D)
 
             if self.overlayCallback is not None:
@@ -452,123 +689,73 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
 
 
     ## Given a path to a file, save the mosaic to that file and an adjacent
-    # file. The first is a text file that describes the layout of the tiles;
-    # the second is an MRC file that holds the actual image data.
+    # file. The first is the index of the tiles, which describes their
+    # layout; the second holds the actual image data.  See mosaicFile.
+    # The tiles are written one at a time, so saving needs little memory.
+    # Afterwards, the tiles read their data from the saved file.
     def saveTiles(self, savePath):
+        if not savePath.endswith(mosaicFile.EXTENSION):
+            savePath += mosaicFile.EXTENSION
+        tiles = list(self.tiles)
         statusDialog = wx.ProgressDialog(parent = self.GetParent(),
                 title = "Saving...",
                 message = "Saving mosaic image data...", 
-                maximum = len(self.tiles))
-        handle = open(savePath, 'w')
-        mrcPath = savePath + '.mrc'
-        if '.txt' in savePath:
-            mrcPath = savePath.replace('.txt', '.mrc')
-        handle.write("%s\n" % mrcPath)
-        width = 0
-        height = 0
-        for tile in self.tiles:
-            width = max(width, tile.textureData.shape[0])
-            height = max(height, tile.textureData.shape[1])
-            # We do this by a series of extensions since some of these lists
-            # may be Numpy arrays, which don't do array extension when you
-            # "add" them.
-            values = []
-            values.extend(tile.pos)
-            values.extend(tile.size)
-            values.extend(tile.textureData.shape)
-            values.extend(tile.histogramScale)
-            values.append(tile.layer)
-            values = map(str, values)
-            handle.write(','.join(values) + '\n')
-        handle.close()
-
-        # Now we have the max image extent in X and Y, we can pile everything
-        # into a single array for saving as an MRC file. Images smaller than
-        # the max will be padded with zeros.
-        imageData = numpy.zeros((1, 1, len(self.tiles), width, height),
-                dtype = numpy.uint16)
-        for i, tile in enumerate(self.tiles):
-            imageData[0, 0, i, :tile.textureData.shape[0], :tile.textureData.shape[1]] = tile.textureData
-        header = cockpit.util.datadoc.makeHeaderFor(imageData)
-
-        handle = open(mrcPath, 'wb')
-        cockpit.util.datadoc.writeMrcHeader(header, handle)
-        for i, image in enumerate(imageData[:,:]):
-            handle.write(image)
-            statusDialog.Update(i)
-        handle.close()
-        statusDialog.Destroy()
-
-
-    ## Load a text file describing a set of tiles, as well as the tile image
-    # data. This is made a bit trickier by the fact that we want to display
-    # a progress dialog that updates as new images are added, but addImage()
-    # must run in the main thread while we run in a different one ...
-    # although maybe not since MAP added a queue and a thread to process
-    # new tiles.
+                maximum = max(len(tiles), 1))
+        try:
+            mosaicFile.saveMosaic(savePath, tiles, statusDialog.Update)
+        finally:
+            statusDialog.Destroy()
+
+
+    ## Load a mosaic file, or a .txt file describing a set of tiles in the
+    # older format, along with the tile image data.  The image data is
+    # memory-mapped, not read, so this is quick even for large mosaics.
+    # Tiles are added nearest to the current view first, and the data of
+    # those in view is read ahead in parallel.
     @cockpit.util.threads.callInNewThread
     def loadTiles(self, filePath):
-        with open(filePath, 'r') as handle:
-            mrcPath = handle.readline().strip()
-            tileStats = []
-            for line in handle:
-                # X position, Y position, Z position, 
-                # X micron size, Y micron size,
-                # X pixel size, Y pixel size, blackpoint, whitepoint, layer.
-                # We'll have to convert the pixel sizes and layer to
-                # ints later.
-                tileStats.append(list(map(float, line.strip().split(','))))
-        numInitialTiles = len(self.tiles)
         try:
-            doc = cockpit.util.datadoc.DataDoc(mrcPath)
+            if filePath.endswith('.txt'):
+                records = mosaicFile.readLegacyMosaic(filePath)
+            else:
+                records = mosaicFile.readMosaic(filePath)
         except Exception as e:
             wx.MessageDialog(self.GetParent(), 
-                    message = "I was unable to load the MRC file at\n%s\nholding the tile data. The error message was:\n\n%s\n\nPlease verify that the file path is correct and the file is valid." % (mrcPath, e),
+                    message = "I was unable to load the mosaic at\n%s\nThe error message was:\n\n%s\n\nPlease verify that the file path is correct and the file is valid." % (filePath, e),
                     style = wx.ICON_INFORMATION | wx.OK).ShowModal()
+            cockpit.util.logger.log.error(traceback.format_exc())
             return
-        # NOTE: this dialog is not safe to Update, since the update calls must
-        # be referred to the main thread (via wx.CallAfter) and may arrive
-        # in an unpredictable order. Due to the unpredictable order, the call
-        # to Destroy (which must also happen in the main thread via CallAfter)
-        # may arrive before all of the Update calls are processed, resulting
-        # in a segfault.
-        statusDialog = wx.ProgressDialog(parent = self.GetParent(),
-                title = "Loading...",
-                message = "Loading mosaic image data...")
-        statusDialog.Show()
-        if doc.imageArray.shape[2] > len(tileStats):
-            # More images in the file than we have stats for.
-            cockpit.util.logger.log.warning("Loading mosaic with %d images; only have positioning information for %d." % (doc.imageArray.shape[2], len(tileStats)))
-        maxImages = min(doc.imageArray.shape[2], len(tileStats))
-        for i in range(maxImages):
-            image = doc.imageArray[0, 0, i]
-            stats = tileStats[i]
+
+        (x1, y1), (x2, y2) = self.getViewBox()
+        centerX, centerY = (x1 + x2) / 2, (y1 + y2) / 2
+        def getDistance(record):
+            return ((record.pos[0] + record.size[0] / 2 - centerX) ** 2
+                    + (record.pos[1] + record.size[1] / 2 - centerY) ** 2)
+        records.sort(key = getDistance)
+
+        # Tiles have no texture until they are rendered, so they can be
+        # made here rather than in the main thread.
+        tiles = []
+        for i, record in enumerate(records):
             try:
-                data = image[:int(stats[5]), :int(stats[6])]
-                self.addImage(data, stats[:3], stats[3:5], stats[7:9], 
-                            int(stats[9]))
+                tiles.append(Tile(record.data, record.pos, record.size,
+                                  record.histogramScale, record.layer))
             except Exception as e:
                 wx.MessageDialog(self.GetParent(),
-                        "Failed to load line %d of file %s: %s.\n\nPlease see the logs for more details." % (i, filePath, e),
+                        "Failed to load tile %d of file %s: %s.\n\nPlease see the logs for more details." % (i, filePath, e),
                         style = wx.ICON_INFORMATION | wx.OK).ShowModal()
                 cockpit.util.logger.log.error(traceback.format_exc())
-                statusDialog.Destroy()
                 return
-        # Wait until we've loaded all tiles or we go a full second without
-        # any new tiles arriving.
-        numExpectedTiles = len(self.tiles) + len(tileStats)
-        lastUpdatedTime = time.time()
-        curCount = len(self.tiles)
-        while len(self.tiles) != numExpectedTiles:
-            count = len(self.tiles)
-            if count != curCount:
-                lastUpdatedTime = time.time()
-                curCount = count
-            if time.time() - lastUpdatedTime > 1:
-                break
-            time.sleep(.1)
-        wx.CallAfter(statusDialog.Destroy)
-        events.publish('mosaic update')
+        self.addTiles(tiles)
+
+        # Read ahead the data of the tiles in view, so that it is in
+        # memory by the time they are rendered.
+        viewTiles = [tile for tile in tiles
+                     if tile.intersectsBox(((x1, y1), (x2, y2)))]
+        with concurrent.futures.ThreadPoolExecutor(LOAD_THREADS) as pool:
+            for result in pool.map(lambda tile: tile.textureData.max(),
+                                   viewTiles[:MAX_PREFETCH_TILES]):
+                pass
                
 
     ## Return our list of Tiles.
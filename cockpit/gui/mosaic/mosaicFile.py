@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import os
+import tempfile
+import threading
+
+import numpy
+
+import cockpit.util.datadoc
+import cockpit.util.logger
+
+## This module reads and writes mosaic files.  A mosaic is saved as two
+# files: an index, with extension .mosaic, and the image data of the
+# tiles, usually in a file of the same name with .tiles appended.
+#
+# The index is a text file with one JSON object per line.  The first
+# line is a header, which names the data file, in the same directory as
+# the index.  Every other line describes one tile: where its
+# data is in the data file, its dtype and shape, its position and size
+# in microns, its histogram scaling, and its layer.  The data file holds
+# the tiles' pixels, one after the other.
+#
+# Both files are only ever appended to, and each tile's data is written
+# before its index line, so a mosaic can be saved while it is acquired
+# and a file cut short by a crash can still be read.
+
+## Value of the "format" key in the index header.
+FORMAT_NAME = 'cockpit-mosaic'
+## Version 1 has no name of the data file in the header.
+FORMAT_VERSION = 2
+## Extension of mosaic index files.
+EXTENSION = '.mosaic'
+## Suffix of the data file, appended to the index file path.
+DATA_SUFFIX = '.tiles'
+## Tile data starts at multiples of this many bytes.
+ALIGNMENT = 64
+
+
+## A tile read from a mosaic file.  data is a numpy array, usually
+# memory-mapped.
+TileRecord = collections.namedtuple('TileRecord',
+                                    ['data', 'pos', 'size', 'histogramScale',
+                                     'layer'])
+
+
+## Writes tiles to a mosaic file, one at a time.  Tiles are on disk as
+# soon as addTile returns.
+class MosaicWriter:
+    ## \param path Path to the index file.
+    # \param dataPath Path to the data file, in the same directory as the
+    #        index.  Defaults to path with DATA_SUFFIX appended.
+    def __init__(self, path, dataPath = None):
+        if dataPath is None:
+            dataPath = path + DATA_SUFFIX
+        self.path = path
+        self.dataPath = dataPath
+        self.dataHandle = open(dataPath, 'wb')
+        self.indexHandle = open(path, 'w')
+        ## Offset at which the next image will be written.
+        self.offset = 0
+        ## Number of tiles written.
+        self.numTiles = 0
+        ## Lock around the above.
+        self.lock = threading.Lock()
+        header = {'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                  'data': os.path.basename(dataPath)}
+        self.indexHandle.write(json.dumps(header) + '\n')
+        self.indexHandle.flush()
+
+
+    ## Write the image at the end of the data file, and return a
+    # (offset, dtype, shape) description of it.
+    def _writeImage(self, data):
+        data = numpy.ascontiguousarray(data)
+        padding = -self.offset % ALIGNMENT
+        if padding:
+            self.dataHandle.write(bytes(padding))
+            self.offset += padding
+        offset = self.offset
+        self.dataHandle.write(data.data)
+        self.offset += data.nbytes
+        return (offset, data.dtype.str, list(data.shape))
+
+
+    ## Add a tile to the file.
+    # \param data 2D array of the tile's pixels.
+    # \param pos (X, Y, Z) position of the tile, in microns.
+    # \param size (width, height) of the tile, in microns.
+    # \param histogramScale (blackpoint, whitepoint) of the tile.
+    # \param layer Layer of the tile.
+    def addTile(self, data, pos, size, histogramScale, layer):
+        with self.lock:
+            offset, dtype, shape = self._writeImage(data)
+            # Make sure the data is on disk before the index refers to it.
+            self.dataHandle.flush()
+            entry = {'offset': offset, 'dtype': dtype, 'shape': shape,
+                     'pos': [float(p) for p in pos],
+                     'size': [float(s) for s in size],
+                     'scale': [float(s) for s in histogramScale],
+                     'layer': int(layer)}
+            self.indexHandle.write(json.dumps(entry) + '\n')
+            self.indexHandle.flush()
+            self.numTiles += 1
+
+
+    def close(self):
+        with self.lock:
+            self.dataHandle.close()
+            self.indexHandle.close()
+
+
+
+## Return the header of the mosaic file at path, given the lines of the
+# file.
+def _readHeader(path, lines):
+    if not lines:
+        raise ValueError("%s is empty" % path)
+    header = json.loads(lines[0])
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError("%s is not a mosaic file" % path)
+    if header.get('version', 0) > FORMAT_VERSION:
+        raise ValueError("%s is from a newer version of Cockpit" % path)
+    return header
+
+
+## Return the path to the data file of a mosaic file with the given
+# header.
+def _getDataPath(path, header):
+    if 'data' not in header:
+        return path + DATA_SUFFIX
+    return os.path.join(os.path.dirname(path), header['data'])
+
+
+## Return the path to the data file of the mosaic file at path.
+def getDataPath(path):
+    with open(path, 'r') as handle:
+        lines = [handle.readline()]
+    return _getDataPath(path, _readHeader(path, lines))
+
+
+## Return a list of TileRecords of the tiles in the given mosaic file.
+# The tile data is memory-mapped, so nothing is read until it is used.
+def readMosaic(path):
+    with open(path, 'r') as handle:
+        lines = handle.readlines()
+    header = _readHeader(path, lines)
+    dataPath = _getDataPath(path, header)
+    dataSize = os.path.getsize(dataPath)
+    tileData = None
+    if dataSize:
+        # Plain ndarray views of the map are much quicker to make than
+        # memmap ones, and still keep the map open.
+        tileData = numpy.memmap(dataPath, dtype = numpy.uint8,
+                                mode = 'r').view(numpy.ndarray)
+
+    def getImage(offset, dtype, shape):
+        dtype = numpy.dtype(dtype)
+        numBytes = dtype.itemsize
+        for length in shape:
+            numBytes *= length
+        if offset + numBytes > dataSize:
+            raise EOFError()
+        return tileData[offset:offset + numBytes].view(dtype).reshape(shape)
+
+    records = []
+    for line in lines[1:]:
+        if not line.endswith('\n'):
+            # The last line was cut short.
+            break
+        entry = json.loads(line)
+        try:
+            data = getImage(entry['offset'], entry['dtype'], entry['shape'])
+        except EOFError:
+            # The data was cut short.
+            break
+        records.append(TileRecord(data, tuple(entry['pos']),
+                                  tuple(entry['size']), tuple(entry['scale']),
+                                  entry['layer']))
+    return records
+
+
+## Save tiles, which have the attributes of Tile (textureData, pos,
+# size, histogramScale and layer), to a mosaic file at path, replacing
+# any mosaic there.  progressCallback, if given, is called with the
+# index of each tile once it is saved.
+#
+# The tiles may have been loaded from the mosaic being replaced, and
+# still map its data file.  Windows does not allow a mapped file to be
+# replaced or removed, so the data is written to a file of a new name,
+# the index is written next to the old one and moved over it, and then
+# the tiles' textureData is switched to the new data, which unmaps the
+# old data file so that it can be removed.
+def saveMosaic(path, tiles, progressCallback = None):
+    oldDataPath = None
+    if os.path.exists(path):
+        try:
+            oldDataPath = getDataPath(path)
+        except ValueError:
+            # Not a mosaic we can read; it is replaced all the same.
+            pass
+    dataPath = path + DATA_SUFFIX
+    if os.path.exists(dataPath):
+        handle, dataPath = tempfile.mkstemp(
+                prefix = os.path.basename(path) + '.', suffix = DATA_SUFFIX,
+                dir = os.path.dirname(os.path.abspath(path)))
+        os.close(handle)
+    tempPath = path + '.partial'
+    writer = MosaicWriter(tempPath, dataPath = dataPath)
+    isComplete = False
+    try:
+        for i, tile in enumerate(tiles):
+            writer.addTile(tile.textureData, tile.pos, tile.size,
+                           tile.histogramScale, tile.layer)
+            if progressCallback is not None:
+                progressCallback(i)
+        isComplete = True
+    finally:
+        writer.close()
+        if not isComplete:
+            os.remove(tempPath)
+            os.remove(dataPath)
+    # The index is never mapped, so it can be replaced.
+    os.replace(tempPath, path)
+
+    for tile, record in zip(tiles, readMosaic(path)):
+        tile.textureData = record.data
+    if oldDataPath is not None and os.path.exists(oldDataPath):
+        try:
+            os.remove(oldDataPath)
+        except OSError as e:
+            cockpit.util.logger.log.warning(
+                    "Unable to remove old mosaic data %s: %s", oldDataPath, e)
+
+
+## Return a list of TileRecords of the tiles in a mosaic saved in the
+# older format: a text file with a line per tile, and an MRC file with
+# the image data.
+def readLegacyMosaic(path):
+    with open(path, 'r') as handle:
+        mrcPath = handle.readline().strip()
+        tileStats = []
+        for line in handle:
+            # X position, Y position, Z position,
+            # X micron size, Y micron size,
+            # X pixel size, Y pixel size, blackpoint, whitepoint, layer.
+            # We'll have to convert the pixel sizes and layer to
+            # ints later.
+            tileStats.append(list(map(float, line.strip().split(','))))
+    doc = cockpit.util.datadoc.DataDoc(mrcPath)
+    if doc.imageArray.shape[2] > len(tileStats):
+        # More images in the file than we have stats for.
+        cockpit.util.logger.log.warning("Loading mosaic with %d images; only have positioning information for %d." % (doc.imageArray.shape[2], len(tileStats)))
+    maxImages = min(doc.imageArray.shape[2], len(tileStats))
+    records = []
+    for i in range(maxImages):
+        stats = tileStats[i]
+        data = doc.imageArray[0, 0, i, :int(stats[5]), :int(stats[6])]
+        records.append(TileRecord(data, tuple(stats[:3]), tuple(stats[3:5]),
+                                  tuple(stats[7:9]), int(stats[9])))
+    return records
@@ -50,6 +50,8 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
+import collections
+import math
 import numpy
 from OpenGL.GL import *
 from OpenGL import GLUT
@@ -68,26 +70,167 @@ def getTexSize(width, height):
     return tuple(result)
 
 
-## Maps numpy datatypes to OpenGL datatypes
-dtypeToGlTypeMap = {
-    numpy.uint8: GL_UNSIGNED_BYTE,
-    numpy.uint16: GL_UNSIGNED_SHORT,
-    numpy.int16: GL_SHORT,
-    numpy.float32: GL_FLOAT,
-    numpy.float64: GL_FLOAT,
-    numpy.int32: GL_FLOAT,
-    numpy.uint32: GL_FLOAT,
-    numpy.complex64: GL_FLOAT,
-    numpy.complex128: GL_FLOAT,
+## Maps numpy datatypes that are uploaded to textures as they are to
+# the internal format of the texture, their OpenGL datatype, and the value
+# that OpenGL divides them by.  Data of other types is converted to
+# float32 first.
+dtypeToGlTexture = {
+    numpy.uint8: (GL_R8, GL_UNSIGNED_BYTE, 2**8 - 1),
+    numpy.uint16: (GL_R16, GL_UNSIGNED_SHORT, 2**16 - 1),
+    numpy.float32: (GL_R32F, GL_FLOAT, 1),
 }
 
-## This class handles a single tile in the mosaic.
+## Largest intensity that MegaTiles can hold.  Their textures hold 16-bit
+# normalised intensities, which is enough for camera data at half the
+# video memory of float textures; intensities outside 0 to this are
+# clamped.
+MEGATILE_MAX_INTENSITY = 2**16 - 1
+
+## Shaders used to draw tiles.  Tile textures hold raw pixel intensities,
+# and the fragment shader maps the tile's histogram scale to black and
+# white, so rescaling tiles only changes uniforms.
+#
+# MegaTiles hold intensities too, divided by rawScale, rendered from
+# their tiles with isRaw set, and mark where they have any in their green
+# channel.
+TILE_VERTEX_SHADER = """#version 120
+void main() {
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+    gl_Position = ftransform();
+}
+"""
+TILE_FRAGMENT_SHADER = """#version 120
+uniform sampler2D tex;
+uniform float dataScale;
+uniform float blackpoint;
+uniform float whitepoint;
+uniform float rawScale;
+uniform bool hasCoverage;
+uniform bool isRaw;
+
+void main() {
+    vec4 texel = texture2D(tex, gl_TexCoord[0].st);
+    float value = texel.r * dataScale;
+    float coverage = hasCoverage ? texel.g : 1.;
+    if (isRaw) {
+        gl_FragColor = vec4(value / rawScale, coverage, 0., 1.);
+    } else {
+        if (coverage < .5) {
+            // Leave the background showing where there are no tiles.
+            discard;
+        }
+        float lum = clamp((value - blackpoint) / (whitepoint - blackpoint),
+                          0., 1.);
+        gl_FragColor = vec4(lum, lum, lum, 1.);
+    }
+}
+"""
+## Names of the uniforms of the tile shader.
+TILE_SHADER_UNIFORMS = ('tex', 'dataScale', 'blackpoint', 'whitepoint',
+                        'rawScale', 'hasCoverage', 'isRaw')
+## (program, uniform name to location dict) tuple of the tile shader, once
+# it has been compiled.
+tileShader = None
+
+
+def _compileShader(shaderType, source):
+    shader = glCreateShader(shaderType)
+    glShaderSource(shader, source)
+    glCompileShader(shader)
+    if not glGetShaderiv(shader, GL_COMPILE_STATUS):
+        raise RuntimeError(glGetShaderInfoLog(shader))
+    return shader
+
+
+## Return the shader program that draws tiles, and a dict mapping the
+# names of its uniforms to their locations.  The program is compiled the
+# first time, so there must be a current OpenGL context.
+def getTileShader():
+    global tileShader
+    if tileShader is None:
+        program = glCreateProgram()
+        glAttachShader(program, _compileShader(GL_VERTEX_SHADER,
+                                               TILE_VERTEX_SHADER))
+        glAttachShader(program, _compileShader(GL_FRAGMENT_SHADER,
+                                               TILE_FRAGMENT_SHADER))
+        glLinkProgram(program)
+        uniforms = {name: glGetUniformLocation(program, name)
+                    for name in TILE_SHADER_UNIFORMS}
+        tileShader = (program, uniforms)
+    return tileShader
+
+## Default for the maximum number of bytes of video memory to use for
+# tile textures.
+TEXTURE_BUDGET = 2**29
+
+## Keeps track of the tiles that have a texture in video memory, and
+# frees the textures of the least recently used tiles when they use more
+# than the budget.  Tiles load their texture again when next rendered.
+class TextureCache:
+    ## \param budget Maximum number of bytes of textures.
+    def __init__(self, budget = TEXTURE_BUDGET):
+        self.budget = budget
+        ## Maps tiles with textures, least recently used first, to the
+        # size of their texture in bytes.
+        self.tileToBytes = collections.OrderedDict()
+        ## Total size of the textures.
+        self.numBytes = 0
+
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.evict()
+
+
+    ## Mark the given tile's texture as most recently used, adding it if
+    # needed, and make room for it.
+    def touch(self, tile):
+        if tile in self.tileToBytes:
+            self.tileToBytes.move_to_end(tile)
+            return
+        height, width = tile.textureData.shape
+        # Textures have power of two sizes.
+        texWidth, texHeight = getTexSize(width, height)
+        numBytes = texWidth * texHeight * tile.bytesPerPixel
+        self.tileToBytes[tile] = numBytes
+        self.numBytes += numBytes
+        self.evict()
+
+
+    ## The given tile no longer has a texture.
+    def discard(self, tile):
+        numBytes = self.tileToBytes.pop(tile, None)
+        if numBytes is not None:
+            self.numBytes -= numBytes
+
+
+    ## Free the least recently used textures until we are within budget,
+    # but always keep the most recently used one.
+    def evict(self):
+        while self.numBytes > self.budget and len(self.tileToBytes) > 1:
+            tile, numBytes = self.tileToBytes.popitem(last = False)
+            self.numBytes -= numBytes
+            tile.wipe()
+
+
+## Textures of all Tiles.
+textureCache = TextureCache()
+
+
+## This class handles a single tile in the mosaic.  Its texture is only
+# loaded into video memory when it is rendered, and is freed again by
+# the textureCache.
 class Tile:
+    ## Format of our texture.
+    textureFormat = GL_RED
+    ## Whether our texture's green channel marks where it has data.
+    hasCoverage = False
+
     def __init__(self, textureData, pos, size,
-            histogramScale, layer, isShown = True,
-            shouldDelayAllocation = False):
+            histogramScale, layer, isShown = True):
 
-        ## Array of pixel brightnesses
+        ## Array of pixel brightnesses.  This may be a memory-mapped
+        # array from a TileStore.
         self.textureData = textureData
         ## XYZ position tuple, in microns. NB the Z portion is ignored
         # for rendering purposes and is mostly just kept around so we know
@@ -101,17 +244,34 @@ class Tile:
         ## Grouping this tile belongs to, used to toggle display
         self.layer = layer
 
-        ## OpenGL texture ID
-        self.texture = glGenTextures(1)
+        ## OpenGL texture ID, or None if we have no texture.
+        self.texture = None
+        ## Multiplier from values in our texture to pixel intensities,
+        # since OpenGL normalises integer data.
+        self.dataScale = 1
         self.scaleHistogram(histogramScale[0], histogramScale[1])
-        # Indicate refresh required after scaling histogram.
-        self.shouldRefresh = False
-        if not shouldDelayAllocation:
-            self.bindTexture()
-            self.refresh()
 
 
+    ## Internal format of our texture, which holds our data as it is
+    # uploaded: as normalised integers, or as floats.
+    @property
+    def internalFormat(self):
+        return dtypeToGlTexture.get(self.textureData.dtype.type,
+                                    dtypeToGlTexture[numpy.float32])[0]
+
+
+    ## Bytes per pixel of our texture.
+    @property
+    def bytesPerPixel(self):
+        if self.textureData.dtype.type in dtypeToGlTexture:
+            return self.textureData.dtype.itemsize
+        return numpy.dtype(numpy.float32).itemsize
+
+
+    ## Create our texture, if needed, and allocate its memory.
     def bindTexture(self):
+        if self.texture is None:
+            self.texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.texture)
         glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_MIN_FILTER,GL_LINEAR)
         glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_MAG_FILTER,GL_NEAREST)
@@ -120,84 +280,61 @@ class Tile:
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
 
-        img = self.textureData
-
-        pic_ny, pic_nx = img.shape
+        pic_ny, pic_nx = self.textureData.shape
         tex_nx,tex_ny = getTexSize(pic_nx,pic_ny)
-
-        imgType = img.dtype.type
-        if imgType not in dtypeToGlTypeMap:
-            raise ValueError("Unsupported data mode %s" % str(imgType))
-        glTexImage2D(GL_TEXTURE_2D,0,  GL_RGB, tex_nx,tex_ny, 0, 
-                     GL_LUMINANCE, dtypeToGlTypeMap[imgType], None)
+        glTexImage2D(GL_TEXTURE_2D, 0, self.internalFormat, tex_nx, tex_ny, 0,
+                     self.textureFormat, GL_FLOAT, None)
 
 
+    ## Upload our image data to our texture.  This is only needed when the
+    # texture is created, since the data is windowed as it is drawn.
     def refresh(self):
+        if self.texture is None:
+            # Our data will be uploaded when our texture is created.
+            return
         img = self.textureData
-        mi,ma = self.histogramScale
         pic_ny, pic_nx = img.shape
-        if img.dtype.type in (numpy.float64, numpy.int32, numpy.uint32):
-            data = img.astype(numpy.float32)
-            imgString = data.tostring()
-            imgType = numpy.float32
+        if img.dtype.type in dtypeToGlTexture:
+            glType, self.dataScale = dtypeToGlTexture[img.dtype.type][1:]
         else:
-            imgString = img.tostring()
-            imgType = img.dtype.type
-            
-        # maxUShort: value that represents "maximum color" - i.e. white
-        if img.dtype.type == numpy.uint16:
-            maxUShort = (1<<16) -1
-        elif img.dtype.type == numpy.int16:
-            maxUShort = (1<<15) -1
-        elif img.dtype.type == numpy.uint8:
-            maxUShort = (1<<8) -1
-        else:
-            maxUShort = 1
+            if numpy.iscomplexobj(img):
+                img = img.real
+            img = img.astype(numpy.float32)
+            glType, self.dataScale = GL_FLOAT, 1
+        img = numpy.ascontiguousarray(img)
 
-        mmrange =  float(ma)-float(mi)
-        fBias =  -float(mi) / mmrange
-        f  =  maxUShort / mmrange
-        
         glBindTexture(GL_TEXTURE_2D, self.texture)
-        glPixelTransferf(GL_RED_SCALE,   f)
-        glPixelTransferf(GL_GREEN_SCALE, f)
-        glPixelTransferf(GL_BLUE_SCALE,  f)
-        
-        glPixelTransferf(GL_RED_BIAS,   fBias)
-        glPixelTransferf(GL_GREEN_BIAS, fBias)
-        glPixelTransferf(GL_BLUE_BIAS,  fBias)
-        
-        glPixelTransferi(GL_MAP_COLOR, False)
-        
-        if img.dtype.type in (numpy.float64, numpy.int32, numpy.uint32,
-                numpy.complex64, numpy.complex128):
-            itSize = 4
-            glPixelStorei(GL_UNPACK_SWAP_BYTES, False) # create native float32 copy - see below
-        else:
-            itSize = img.itemsize
-            glPixelStorei(GL_UNPACK_SWAP_BYTES, not img.dtype.isnative)
-
-        glPixelStorei(GL_UNPACK_ALIGNMENT, itSize)
-
-        if imgType not in dtypeToGlTypeMap:
-            raise ValueError("Unsupported data mode %s" % str(imgType))
-        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, pic_nx, pic_ny,  
-                     GL_LUMINANCE, dtypeToGlTypeMap[imgType], imgString)
+        glPixelStorei(GL_UNPACK_SWAP_BYTES, not img.dtype.isnative)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, img.itemsize)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, pic_nx, pic_ny,
+                        GL_RED, glType, img)
+        glPixelStorei(GL_UNPACK_SWAP_BYTES, False)
 
 
     ## Free up memory we were using.
     def wipe(self):
-        glDeleteTextures([self.texture])
+        if self.texture is not None:
+            glDeleteTextures([self.texture])
+            self.texture = None
+        textureCache.discard(self)
 
 
     ## Wipe our texture and recreate it, presumably because it has
     # changed somehow.
     def recreateTexture(self):
         self.wipe()
-        self.texture = glGenTextures(1)
         self.bindTexture()
 
 
+    ## Make sure our texture is in video memory, and mark it as recently
+    # used.
+    def loadTexture(self):
+        if self.texture is None:
+            self.bindTexture()
+            self.refresh()
+        textureCache.touch(self)
+
+
     ## Return true iff our area intersects the given
     # (bottomLeft, topRight) tuple.
     def intersectsBox(self, viewBox):
@@ -212,15 +349,23 @@ class Tile:
         return True
 
 
-    ## Draw the tile, if it intersects the given view box
-    def render(self, viewBox):
+    ## Draw the tile, if it intersects the given view box.
+    # \param isRaw If True, draw our intensities instead of their colours,
+    #        as when rendering to a MegaTile.
+    def render(self, viewBox, isRaw = False):
         if not self.intersectsBox(viewBox):
             return
-        if self.shouldRefresh:
-            self.refresh()
-            self.shouldRefresh = False
-        
-        glColor3f(1, 1, 1)
+        self.loadTexture()
+
+        program, uniforms = getTileShader()
+        glUseProgram(program)
+        glUniform1i(uniforms['tex'], 0)
+        glUniform1f(uniforms['dataScale'], self.dataScale)
+        glUniform1f(uniforms['blackpoint'], self.histogramScale[0])
+        glUniform1f(uniforms['whitepoint'], self.histogramScale[1])
+        glUniform1f(uniforms['rawScale'], MEGATILE_MAX_INTENSITY)
+        glUniform1i(uniforms['hasCoverage'], self.hasCoverage)
+        glUniform1i(uniforms['isRaw'], isRaw)
 
         img = self.textureData
         pic_ny, pic_nx = img.shape
@@ -241,6 +386,7 @@ class Tile:
         glTexCoord2f(0, 0)
         glVertex2f(x, y + self.size[1])
         glEnd()
+        glUseProgram(0)
 
 
     ## Set our histogramScale tuple to (min, max), or base those off of 
@@ -257,7 +403,6 @@ class Tile:
         ## Used to scale the brightness of the overall tile, like the
         # histogram controls used for the camera views.
         self.histogramScale = (minVal, maxVal)
-        self.shouldRefresh = True
 
 
     ## Return the (xSize, ySize) tuple of a single pixel of texture data in GL
@@ -266,6 +411,113 @@ class Tile:
         return (self.size[0] / self.textureData.shape[0], 
                 self.size[1] / self.textureData.shape[1])
 
+## Spatial index of tiles, or of anything else with a Tile-like box, on a
+# uniform grid.  Each tile is listed in every grid cell its box overlaps,
+# so finding the tiles in a region only has to look at the tiles in the
+# cells that the region overlaps, instead of at every tile.
+class TileGrid:
+    ## \param cellSize Length in microns of the edges of the grid cells.
+    #        If None, it is set from the first tile added, which works
+    #        best when tiles are all of similar size.
+    def __init__(self, cellSize = None):
+        self.cellSize = cellSize
+        ## Maps (column, row) indices to lists of tiles in that cell.
+        self.cellToTiles = {}
+        ## Maps tiles to (order, cells) tuples, where order is used to return
+        # tiles in the order they were added, and cells are the indices of
+        # the cells they are listed in.
+        self.tileToEntry = {}
+        ## Order of the next tile added.
+        self.nextOrder = 0
+
+
+    def __len__(self):
+        return len(self.tileToEntry)
+
+
+    def __contains__(self, tile):
+        return tile in self.tileToEntry
+
+
+    ## Return the (xMin, xMax, yMin, yMax) indices, inclusive, of the cells
+    # that the given (bottomLeft, topRight) box overlaps.
+    def getCellRange(self, box):
+        (x1, y1), (x2, y2) = box
+        return (math.floor(min(x1, x2) / self.cellSize),
+                math.floor(max(x1, x2) / self.cellSize),
+                math.floor(min(y1, y2) / self.cellSize),
+                math.floor(max(y1, y2) / self.cellSize))
+
+
+    ## Return the indices of the cells that the given
+    # (bottomLeft, topRight) box overlaps.
+    def getCells(self, box):
+        xMin, xMax, yMin, yMax = self.getCellRange(box)
+        return [(i, j) for i in range(xMin, xMax + 1)
+                for j in range(yMin, yMax + 1)]
+
+
+    def add(self, tile):
+        if self.cellSize is None:
+            (x1, y1), (x2, y2) = tile.box
+            self.cellSize = max(abs(x2 - x1), abs(y2 - y1)) or 1
+        cells = self.getCells(tile.box)
+        for cell in cells:
+            self.cellToTiles.setdefault(cell, []).append(tile)
+        self.tileToEntry[tile] = (self.nextOrder, cells)
+        self.nextOrder += 1
+
+
+    def remove(self, tile):
+        order, cells = self.tileToEntry.pop(tile)
+        for cell in cells:
+            cellTiles = self.cellToTiles[cell]
+            cellTiles.remove(tile)
+            if not cellTiles:
+                del self.cellToTiles[cell]
+
+
+    def clear(self):
+        self.cellToTiles = {}
+        self.tileToEntry = {}
+
+
+    ## Return the tiles that intersect the given (bottomLeft, topRight)
+    # box, in the order they were added.  The test is the same as
+    # Tile.intersectsBox, so tiles that only touch the box are included.
+    def getIntersecting(self, box):
+        if not self.tileToEntry:
+            return []
+        (x1, y1), (x2, y2) = box
+        left, right = min(x1, x2), max(x1, x2)
+        bottom, top = min(y1, y2), max(y1, y2)
+        cells = self.cellToTiles
+        xMin, xMax, yMin, yMax = self.getCellRange(box)
+        if (xMax - xMin + 1) * (yMax - yMin + 1) > len(cells):
+            # Fewer cells hold tiles than the box overlaps, e.g. when
+            # zoomed out, so don't bother looking at all the empty ones.
+            gridCells = cells.keys()
+        else:
+            gridCells = ((i, j) for i in range(xMin, xMax + 1)
+                         for j in range(yMin, yMax + 1))
+        candidates = set()
+        for cell in gridCells:
+            cellTiles = cells.get(cell)
+            if cellTiles:
+                candidates.update(cellTiles)
+        result = []
+        for tile in candidates:
+            (tileLeft, tileBottom), (tileRight, tileTop) = tile.box
+            if (tileLeft > right or tileRight < left
+                    or tileTop < bottom or tileBottom > top):
+                continue
+            result.append(tile)
+        tileToEntry = self.tileToEntry
+        result.sort(key = lambda tile: tileToEntry[tile][0])
+        return result
+
+
+
 ## Framebuffer to use when prerendering. Set to None initially since
 # we have to wait for OpenGL to get set up in our window before we can
 # use it.
@@ -277,15 +529,34 @@ def clearFramebuffer():
         glDeleteFramebuffers([megaTileFramebuffer])
         megaTileFramebuffer = None
 
+
+## Return a (blackpoint, whitepoint) tuple that spans the histogram
+# scales of all of the given tiles.
+def spanHistograms(tiles):
+    blackpoints, whitepoints = zip(*(tile.histogramScale for tile in tiles))
+    return (min(blackpoints), max(whitepoints))
+
+
 ## This class handles pre-rendering of normal-sized Tile instances
 # at a reduced level of detail, which allows us to keep the program
 # responsive even when thousands of tiles are in view.
+#
+# MegaTiles form a pyramid: at each level up, a MegaTile covers twice the
+# width and height of the previous level with the same number of pixels.
+#
+# MegaTiles hold the raw intensities of the tiles rendered to them, and
+# are drawn with a single histogram scale that spans those of the tiles.
 class MegaTile(Tile):
+    ## Internal format and format of our texture, and its bytes per pixel.
+    internalFormat = GL_RG16
+    textureFormat = GL_RG
+    bytesPerPixel = 4
+    hasCoverage = True
     ## Length in pixels of one edge of a MegaTile's texture.
     pixelSize = None
-    ## Length in microns of one edge of a MegaTile's texture.
+    ## Length in microns of one edge of a level 0 MegaTile's texture.
     micronSize = None
-    ## An array of ones, used to initialize the MegaTile textures.
+    ## An array the size of MegaTile textures.  Only its shape is used.
     _emptyTileData = None
 
     ## Instantiate the megatile. The main difference here is that
@@ -295,15 +566,24 @@ class MegaTile(Tile):
     #
     # At this time, if megaTileFramebuffer has not been created
     # yet, create it.
-    def __init__(self, pos):
+    # \param level Level in the pyramid, where 0 has the full resolution.
+    def __init__(self, pos, level = 0):
+        ## Level in the pyramid.
+        self.level = level
+        ## Length in microns of one edge of our texture.
+        self.micronSize = self.micronSize * 2 ** level
         Tile.__init__(self, self._emptyTileData, pos,
                  (self.micronSize, self.micronSize),
-                 (0, 1), 'megatiles',
-                 shouldDelayAllocation = True)
+                 (0, 1), 'megatiles')
         ## Counts the number of tiles we've rendered to ourselves.
         self.numRenderedTiles = 0
+        ## Number of tiles in the mosaic that overlap our area, whether or
+        # not we have rendered them yet.
+        self.numTiles = 0
         ## Whether or not we've allocated memory for our texture yet.
         self.haveAllocatedMemory = False
+        # OpenGL normalises our intensities to 0 to 1.
+        self.dataScale = MEGATILE_MAX_INTENSITY
         
         global megaTileFramebuffer
         if megaTileFramebuffer is None:
@@ -320,10 +600,11 @@ class MegaTile(Tile):
             return
         cls.pixelSize = edge
         cls.micronSize = edge * 1
-        cls._emptyTileData = numpy.ones( (edge, edge), dtype=numpy.float32)
+        cls._emptyTileData = numpy.zeros((edge, edge), dtype=numpy.float32)
 
     ## Go through the provided list of Tiles, find the ones that overlap
-    # our area, and prerender them to our texture
+    # our area, and prerender them to our texture.  The tiles may also be
+    # MegaTiles from lower levels of the pyramid.
     def prerenderTiles(self, tiles, viewer):
         if not tiles:
             return
@@ -342,6 +623,11 @@ class MegaTile(Tile):
                 self.bindTexture()
                 self.refresh()
                 self.haveAllocatedMemory = True
+            # Widen our window to show the new tiles as well as the old.
+            scaledTiles = list(newTiles)
+            if self.numRenderedTiles:
+                scaledTiles.append(self)
+            self.scaleHistogram(*spanHistograms(scaledTiles))
             self.numRenderedTiles += len(newTiles)
             glBindFramebuffer(GL_DRAW_FRAMEBUFFER, megaTileFramebuffer)
             glFramebufferTexture2D(GL_DRAW_FRAMEBUFFER,
@@ -359,12 +645,24 @@ class MegaTile(Tile):
 
             glEnable(GL_TEXTURE_2D)
             for tile in newTiles:
-                tile.render(viewBox)
+                tile.render(viewBox, isRaw = True)
 
             glPopMatrix()            
             glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
 
 
+    ## Clear our texture, marking it as having no tiles.  This is done on
+    # the GPU instead of uploading an empty image.
+    def refresh(self):
+        if self.texture is None:
+            return
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, megaTileFramebuffer)
+        glFramebufferTexture2D(GL_DRAW_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                               GL_TEXTURE_2D, self.texture, 0)
+        glClearBufferfv(GL_COLOR, 0, numpy.zeros(4, dtype = numpy.float32))
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+
+
     ## Prevent trying to delete our texture if we haven't made it yet.
     def wipe(self):
         if self.haveAllocatedMemory:
@@ -373,6 +671,12 @@ class MegaTile(Tile):
             self.numRenderedTiles = 0
             
 
+    ## Our texture is managed by the MosaicCanvas, and only allocated once
+    # we have something to display.
+    def loadTexture(self):
+        pass
+
+
     ## Prevent allocating a new texture if we haven't drawn anything yet.
     def recreateTexture(self):
         if self.haveAllocatedMemory:
@@ -380,8 +684,8 @@ class MegaTile(Tile):
             self.refresh()
 
 
-    def render(self, viewBox):
+    def render(self, viewBox, isRaw = False):
         if not self.numRenderedTiles:
             # We're empty, so no need to render.
             return
-        Tile.render(self, viewBox)
+        Tile.render(self, viewBox, isRaw)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import tempfile
+import threading
+
+import numpy
+
+## This module holds the image data of mosaic tiles on disk, so that the
+# mosaic is not limited by the amount of RAM.
+
+## Size in bytes of each of the files the tiles are stored in.
+SEGMENT_SIZE = 2**28
+## Tiles start at multiples of this many bytes.
+ALIGNMENT = 64
+
+
+## Stores tile image data in temporary files, and hands back memory-mapped
+# copies of it.  The operating system then keeps as much of the data in
+# memory as there is room for, and reads the rest from disk as needed.
+#
+# The data is stored in segments, each a temporary file, instead of one
+# memory map per tile, because the number of memory maps per process is
+# limited.  Space is only reclaimed when the store is cleared.
+class TileStore:
+    ## \param directory Directory for the temporary files, or None for
+    #        the default temporary directory.
+    # \param segmentSize Size in bytes of each temporary file.  Tiles
+    #        larger than this get a file of their own.
+    def __init__(self, directory = None, segmentSize = SEGMENT_SIZE):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        ## List of (file handle, memory map) tuples.
+        self.segments = []
+        ## Offset at which the next tile will be stored, in the last segment.
+        self.offset = 0
+        ## Total number of bytes of tile data stored.
+        self.numBytes = 0
+        ## Lock around the above.
+        self.lock = threading.Lock()
+
+
+    ## Add a new segment of at least the given size.
+    def _addSegment(self, size):
+        size = max(size, self.segmentSize)
+        handle = tempfile.TemporaryFile(dir = self.directory)
+        segment = numpy.memmap(handle, dtype = numpy.uint8, mode = 'w+',
+                               shape = (size,))
+        self.segments.append((handle, segment))
+        self.offset = 0
+
+
+    ## Copy the image into the store and return a read-only,
+    # memory-mapped copy.
+    def add(self, imageData):
+        imageData = numpy.asanyarray(imageData)
+        nbytes = imageData.nbytes
+        with self.lock:
+            if (not self.segments
+                    or self.offset + nbytes > len(self.segments[-1][1])):
+                self._addSegment(nbytes)
+            segment = self.segments[-1][1]
+            offset = self.offset
+            self.offset += -(-nbytes // ALIGNMENT) * ALIGNMENT
+            self.numBytes += nbytes
+        stored = segment[offset:offset + nbytes].view(imageData.dtype)
+        stored = stored.reshape(imageData.shape)
+        stored[...] = imageData
+        stored.flags.writeable = False
+        return stored
+
+
+    ## Forget all stored tiles.  Copies already handed out remain valid
+    # until they are no longer used.
+    def clear(self):
+        with self.lock:
+            for handle, segment in self.segments:
+                handle.close()
+            self.segments = []
+            self.offset = 0
+            self.numBytes = 0
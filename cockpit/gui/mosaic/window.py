@@ -52,19 +52,24 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
-import collections
+import concurrent.futures
+import decimal
+import itertools
 from cockpit.util import ftgl
 import numpy
 from OpenGL.GL import *
 import os
-import scipy.ndimage.measurements
 import threading
 import time
+import traceback
 import wx
 
+from . import beads
 from . import canvas
 from cockpit import depot
 from cockpit import events
+import cockpit.experiment.mosaicSpiral
+import cockpit.experiment.zStack
 import cockpit.gui
 import cockpit.gui.camera.window
 import cockpit.gui.dialogs.gridSitesDialog
@@ -74,6 +79,8 @@ import cockpit.gui.keyboard
 from cockpit.gui.primitive import Primitive
 import cockpit.interfaces.stageMover
 import cockpit.util.files
+import cockpit.util.logger
+import cockpit.util.processes
 import cockpit.util.threads
 import cockpit.util.userConfig
 import math
@@ -89,13 +96,13 @@ SIDEBAR_WIDTH = 150
 
 ## Timeout for mosaic new image events
 CAMERA_TIMEOUT = 1
+## Number of tiles to image in each ActionTable, when running the mosaic
+# spiral as hardware-timed experiments.
+SPIRAL_TILES_PER_TABLE = 64
 ##how good a circle to draw
 CIRCLE_SEGMENTS = 32
 PI = 3.141592654
 
-## Simple structure for marking potential beads.
-BeadSite = collections.namedtuple('BeadSite', ['pos', 'size', 'intensity'])
-
 from functools import wraps
 
 
@@ -351,6 +358,14 @@ class MosaicWindow(wx.Frame, MosaicCommon):
         self.offset=(0,0)
         ## Event object to control run state of mosaicLoop.
         self.shouldContinue = threading.Event()
+        ## Adds the images taken by mosaicLoop to the canvas, in order, so
+        # that the loop can get on with taking the next one.
+        self.tileIngester = concurrent.futures.ThreadPoolExecutor(
+                max_workers = 1)
+        ## Time at which the mosaic was last started, and number of tiles
+        # taken since then.
+        self.mosaicStartTime = None
+        self.numMosaicTiles = 0
 
         ## Camera used for making a mosaic
         self.camera = None
@@ -413,11 +428,13 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                  "a camera's scaling to use instead."),
                 ('Save mosaic', self.saveMosaic, None,
                  "Save the mosaic to disk, so it can be recovered later. " +
-                 "This will generate two files: a .txt file and a .mrc " +
-                 "file. Load the .txt file to recover the mosaic."),
+                 "This will generate two files: a .mosaic file and a " +
+                 ".mosaic.tiles file. Load the .mosaic file to recover " +
+                 "the mosaic."),
                 ('Load mosaic', self.loadMosaic, None,
                  "Load a mosaic file that was previously saved. Make " +
-                 "certain you load the .txt file, not the .mrc file."),
+                 "certain you load the .mosaic file, or the .txt file " +
+                 "of mosaics saved by older versions."),
                 ('Calculate focal plane', self.setFocalPlane, self.clearFocalPlane,
                  "Calculate the focal plane of the sample, assuming that " +
                  "the currently-selected sites are all in focus, and that " +
@@ -686,13 +703,21 @@ class MosaicWindow(wx.Frame, MosaicCommon):
     ## Move the stage in a spiral pattern, stopping to take images at regular
     # intervals, to generate a stitched-together high-level view of the stage
     # contents.
+    # Tiles are taken one at a time, but the move to the next tile starts
+    # as soon as the exposure ends, so that the stage moves and settles
+    # while the image is read out, and the images are added to the canvas
+    # in the background.  If so configured, whole stretches of the spiral
+    # are instead run as hardware-timed experiments.
     def mosaicLoop(self):
         from sys import stderr
         stepper = self.mosaicStepper()
         target = None
+        spiralPositioners = None
+        isSpiralStart = False
         while True:
             if not self.shouldContinue.is_set():
                 ## Enter idle state.
+                self.reportMosaicThroughput(isFinished = True)
                 # Update button label in main thread.
                 events.publish("mosaic stop")
                 wx.CallAfter(self.nameToButton['Run mosaic'].SetLabel, 'Run mosaic')
@@ -707,6 +732,8 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 # Set reconfigure flag: cameras or objective may have changed.
                 self.shouldReconfigure = True
                 events.publish("mosaic start")
+                self.mosaicStartTime = time.time()
+                self.numMosaicTiles = 0
                 # Catch case that stage has moved but user wants to continue mosaic.
                 if not self.shouldRestart and target is not None:
                     self.goTo(target, True)
@@ -718,6 +745,9 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 centerX = pos[0] - self.offset[0]
                 centerY = pos[1] + self.offset[1]
                 self.shouldRestart = False
+                # The stepper starts one step away from the centre, which
+                # the software loop images before its first move.
+                isSpiralStart = True
 
             if self.shouldReconfigure:
                 #  Check that camera is valid
@@ -736,52 +766,198 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 width *= objective.getPixelSize()
                 height *= objective.getPixelSize()
                 self.offset = objective.getOffset()
+                spiralPositioners = self.getSpiralPositioners()
                 # Successfully reconfigured: clear the flag.
                 self.shouldReconfigure = False
 
             pos = cockpit.interfaces.stageMover.getPosition()
             curZ = pos[2] - self.offset[2]
+            if self.mosaicStartTime is None:
+                # Started by toggleMosaic without pausing first.
+                self.mosaicStartTime = time.time()
+                self.numMosaicTiles = 0
+
+            # Work out where to go next in shifted coords, so that we can
+            # head there as soon as the image is taken.
+            if spiralPositioners is not None:
+                targets = []
+                if isSpiralStart:
+                    targets.append(tuple(pos[:2]))
+                    isSpiralStart = False
+                for dx, dy in itertools.islice(
+                        stepper, SPIRAL_TILES_PER_TABLE - len(targets)):
+                    targets.append((centerX + self.offset[0] + dx * width,
+                                    centerY - self.offset[1] + dy * height))
+                try:
+                    self.runMosaicSpiral(spiralPositioners, targets, camera,
+                                         curZ, width, height)
+                except Exception as e:
+                    self.shouldContinue.clear()
+                    stderr.write("Mosaic stopping - problem running spiral: %s\n" % str(e))
+                    continue
+                target = targets[-1]
+                continue
+
+            dx, dy = next(stepper)
+            target = (centerX + self.offset[0] + dx * width,
+                      centerY - self.offset[1] + dy * height)
+            moveErrors = []
+            def exposeThenMove():
+                cockpit.interfaces.imager.takeImage(shouldBlock=True)
+                # The stage can move once the exposure is over, while
+                # the camera reads out and transfers the image.
+                time.sleep(camera.getExposureTime() / 1000)
+                try:
+                    self.goTo(target)
+                except Exception as e:
+                    moveErrors.append(e)
             # Take an image. Use timeout to prevent getting stuck here.
             try:
                 data, timestamp = events.executeAndWaitForOrTimeout(
                     events.NEW_IMAGE % camera.name,
-                    cockpit.interfaces.imager.takeImage,
-                    camera.getExposureTime()/1000 + CAMERA_TIMEOUT,
-                    shouldBlock=True)
+                    exposeThenMove,
+                    camera.getExposureTime()/1000 + CAMERA_TIMEOUT)
             except Exception as e:
                 # Go to idle state.
                 self.shouldContinue.clear()
                 stderr.write("Mosaic stopping - problem taking image: %s\n" % str(e))
                 continue
 
-            # Get the scaling for the camera we're using, since they may
-            # have changed.
+            # Paint the tile at the stage position at which image was captured.
             try:
-                minVal, maxVal = cockpit.gui.camera.window.getCameraScaling(camera)
+                self.addMosaicTile(data, pos[:2], curZ, width, height, camera)
             except Exception as e:
                 # Go to idle state.
                 self.shouldContinue.clear()
                 stderr.write("Mosaic stopping - problem in getCameraScaling: %s\n" % str(e))
                 continue
-
-            # Paint the tile at the stage position at which image was captured.
-            self.canvas.addImage(data,
-                                 ( -pos[0] + self.offset[0] - width / 2,
-                                    pos[1] - self.offset[1] - height / 2,
-                                    curZ,),
-                                 (width, height), scalings=(minVal, maxVal))
-            # Move to the next position in shifted coords.
-            dx, dy = next(stepper)
-            target = (centerX + self.offset[0] + dx * width,
-                      centerY - self.offset[1] + dy * height)
+            if moveErrors:
+                self.shouldContinue.clear()
+                stderr.write("Mosaic stopping - problem in target calculation: %s\n" % str(moveErrors[0]))
+                continue
             try:
-                self.goTo(target, True)
+                cockpit.interfaces.stageMover.waitForStop(timeout = 30)
             except Exception as e:
                 self.shouldContinue.clear()
-                stderr.write("Mosaic stopping - problem in target calculation: %s\n" % str(e))
+                stderr.write("Mosaic stopping - problem moving stage: %s\n" % str(e))
                 continue
 
 
+    ## Hand an image taken at the given (X, Y) stage position to the
+    # canvas, as a new tile, and update the mosaic's throughput.
+    def addMosaicTile(self, data, stagePos, curZ, width, height, camera):
+        # Get the scaling for the camera we're using, since they may
+        # have changed.
+        minVal, maxVal = cockpit.gui.camera.window.getCameraScaling(camera)
+        tilePos = (-stagePos[0] + self.offset[0] - width / 2,
+                   stagePos[1] - self.offset[1] - height / 2,
+                   curZ)
+        self.tileIngester.submit(self.ingestTile, data, tilePos,
+                                 (width, height), (minVal, maxVal))
+        self.numMosaicTiles += 1
+        self.reportMosaicThroughput()
+
+
+    ## Add an image to the canvas.  Runs on the tileIngester thread.
+    def ingestTile(self, data, pos, size, scalings):
+        try:
+            self.canvas.addImage(data, pos, size, scalings = scalings)
+        except Exception as e:
+            cockpit.util.logger.log.error("Failed to add mosaic tile at %s: %s",
+                                          pos, e)
+
+
+    ## Show how many tiles the mosaic has taken, and how quickly, on the
+    # status lights.  Once the mosaic is finished, log it and clear the
+    # light.
+    def reportMosaicThroughput(self, isFinished = False):
+        if self.mosaicStartTime is None:
+            return
+        duration = time.time() - self.mosaicStartTime
+        tilesPerMinute = 0
+        if duration > 0:
+            tilesPerMinute = self.numMosaicTiles * 60 / duration
+        if isFinished:
+            if self.numMosaicTiles:
+                cockpit.util.logger.log.info(
+                        "Mosaic took %d tiles in %.1fs (%.1f tiles/minute)",
+                        self.numMosaicTiles, duration, tilesPerMinute)
+            events.publish(events.UPDATE_STATUS_LIGHT, 'image count', '',
+                           (170, 170, 170))
+            self.mosaicStartTime = None
+        else:
+            events.publish(events.UPDATE_STATUS_LIGHT, 'image count',
+                           'Mosaic: %d tiles\n%.1f tiles/minute'
+                           % (self.numMosaicTiles, tilesPerMinute),
+                           (255, 255, 0))
+
+
+    ## Return the (X, Y) StagePositioners to run the mosaic spiral with as
+    # hardware-timed experiments, or None if it should be run one tile
+    # at a time.  The positioners are the coarse ones that goTo moves.
+    def getSpiralPositioners(self):
+        if not wx.GetApp().Config['mosaic'].getboolean('hardware-spiral'):
+            return None
+        if self.focalPlaneParams:
+            # The experiment would not follow the focal plane in Z.
+            return None
+        handlers = cockpit.interfaces.stageMover.mover.axisToHandlers
+        positioners = (handlers[0][0], handlers[1][0])
+        for positioner in positioners:
+            if not positioner.getIsEligibleForExperiments():
+                return None
+        return positioners
+
+
+    ## Image the mosaic at each of the given (X, Y) stage positions, as
+    # one hardware-timed experiment, adding tiles as the images arrive.
+    def runMosaicSpiral(self, positioners, targets, camera, curZ,
+                        width, height):
+        xPositioner, yPositioner = positioners
+        # The experiment moves only the coarse positioners, so take away
+        # the positions of the others.
+        xOffset = (cockpit.interfaces.stageMover.getPositionForAxis(0)
+                   - xPositioner.getPosition())
+        yOffset = (cockpit.interfaces.stageMover.getPositionForAxis(1)
+                   - yPositioner.getPosition())
+        positions = [(x - xOffset, y - yOffset) for x, y in targets]
+        lights = [light for light in depot.getHandlersOfType(depot.LIGHT_TOGGLE)
+                  if light.getIsEnabled()]
+        exposureSettings = [([camera],
+                             [(light, decimal.Decimal(str(light.getExposureTime())))
+                              for light in lights])]
+        spiral = cockpit.experiment.mosaicSpiral.MosaicSpiralExperiment(
+                xPositioner, yPositioner,
+                (xPositioner.getPosition(), yPositioner.getPosition()),
+                positions,
+                numReps = 1, repDuration = 0, zPositioner = None,
+                altBottom = curZ + self.offset[2], zHeight = 0,
+                sliceHeight = 0, cameras = [camera], lights = lights,
+                exposureSettings = exposureSettings)
+        # Number of images received, and of tiles made from them.
+        counts = [0, 0]
+        def onImage(data, timestamp):
+            index = counts[0]
+            counts[0] += 1
+            if index in spiral.cameraToIgnoredImageIndices[camera]:
+                return
+            if counts[1] < len(targets):
+                self.addMosaicTile(data, targets[counts[1]], curZ,
+                                   width, height, camera)
+                counts[1] += 1
+        isComplete = threading.Event()
+        events.subscribe(events.NEW_IMAGE % camera.name, onImage)
+        events.oneShotSubscribe(events.EXPERIMENT_COMPLETE, isComplete.set)
+        try:
+            if not spiral.run():
+                raise RuntimeError("the experiment did not start")
+            isComplete.wait()
+        finally:
+            events.unsubscribe(events.NEW_IMAGE % camera.name, onImage)
+        if spiral.shouldAbort:
+            self.shouldContinue.clear()
+
+
     ## Display dialogue box to set tile overlap.
     def setTileOverlap(self):
         value = cockpit.gui.dialogs.getNumberDialog.getNumberFromUser(
@@ -1135,10 +1311,11 @@ class MosaicWindow(wx.Frame, MosaicCommon):
         self.canvas.rescale(cockpit.gui.camera.window.getCameraScaling(camera))
 
 
-    ## Save the mosaic to disk. We generate a text file describing the
-    # locations of the mosaic tiles, and an MRC file of the tiles themselves.
+    ## Save the mosaic to disk. We generate an index file describing the
+    # locations of the mosaic tiles, and a file of the tiles themselves.
     def saveMosaic(self, event = None):
-        dialog = wx.FileDialog(self, style = wx.FD_SAVE, wildcard = '*.txt',
+        dialog = wx.FileDialog(self, style = wx.FD_SAVE,
+                wildcard = 'Mosaic files (*.mosaic)|*.mosaic',
                 message = "Please select where to save the file.",
                 defaultDir = cockpit.util.files.getUserSaveDir())
         if dialog.ShowModal() != wx.ID_OK:
@@ -1148,8 +1325,9 @@ class MosaicWindow(wx.Frame, MosaicCommon):
 
     ## Load a mosaic that was previously saved to disk.
     def loadMosaic(self, event = None):
-        dialog = wx.FileDialog(self, style = wx.FD_OPEN, wildcard = '*.txt',
-                message = "Please select the .txt file the mosaic was saved to.")
+        dialog = wx.FileDialog(self, style = wx.FD_OPEN,
+                wildcard = 'Mosaic files (*.mosaic;*.txt)|*.mosaic;*.txt',
+                message = "Please select the .mosaic file the mosaic was saved to, or the .txt file of an older mosaic.")
         if dialog.ShowModal() != wx.ID_OK:
             return
         self.canvas.loadTiles(dialog.GetPath())
@@ -1171,122 +1349,59 @@ class MosaicWindow(wx.Frame, MosaicCommon):
         statusDialog = wx.ProgressDialog(parent = self,
                 title = "Finding bead centers",
                 message = "Scanning mosaic...",
-                maximum = len(tiles),
+                maximum = max(1, len(tiles)),
                 style = wx.PD_CAN_ABORT)
         statusDialog.Show()
-        regionSize = 300
-        # List of BeadSite instances for potential beads
-        beadSites = []
-        for i, tile in enumerate(tiles):
-            # NB shouldSkip is always false because we don't provide a skip
-            # button.
-            shouldContinue, shouldSkip = statusDialog.Update(i)
-            if not shouldContinue:
-                # User cancelled.
-                break
-            try:
-                data = self.canvas.getCompositeTileData(tile, tiles)
-            except Exception as e:
-                print ("Failed to get tile data at %s: %s" % (tile.pos, e))
-                break
+        self.findBeadSites(tiles, statusDialog, threading.Event())
+
+
+    ## Update the progress dialog of a bead scan, and note if the user
+    # cancelled it.
+    def updateBeadProgress(self, statusDialog, count, shouldStop):
+        # NB shouldSkip is always false because we don't provide a skip
+        # button.
+        shouldContinue, shouldSkip = statusDialog.Update(count)
+        if not shouldContinue:
+            shouldStop.set()
+
+
+    ## Find beads in the given tiles, refine their focus, and save them as
+    # sites.  This runs in its own thread so that the UI stays responsive;
+    # the tiles are searched in a pool of worker processes.
+    @cockpit.util.threads.callInNewThread
+    def findBeadSites(self, tiles, statusDialog, shouldStop):
+        # Maps tile index to array of beads found in that tile.
+        tileToBeads = {}
+        results = cockpit.util.processes.imapBounded(
+                self.getBeadSearchTasks(tiles, shouldStop))
+        for i, tileBeads in enumerate(results):
+            tileToBeads[i] = tileBeads
+            wx.CallAfter(self.updateBeadProgress, statusDialog,
+                         len(tileToBeads), shouldStop)
+
+        # Convert to stage coordinates, earlier tiles first.
+        positions = []
+        sizes = []
+        intensities = []
+        for i in sorted(tileToBeads):
+            tile = tiles[i]
             pixelSize = tile.getPixelSize()
-            median = numpy.median(data)
-            std = numpy.std(data)
-            # Threshold the data so that background becomes 0 and signal
-            # becomes 1 -- admittedly the threshold value is somewhat
-            # arbitrary.
-            thresholded = numpy.zeros(data.shape, dtype = numpy.uint16)
-            thresholded[numpy.where(data > median + std * 15)] = 1
-
-            # Slice up into overlapping regions. Only examine the center
-            # portion of the composite image.
-            for j in range(data.shape[0] / 3, 2 * data.shape[0] / 3, regionSize / 4):
-                for k in range(data.shape[1] / 3, 2 * data.shape[1] / 3, regionSize / 4):
-                    region = thresholded[j : j + regionSize, k : k + regionSize]
-                    # Skip overly small regions (on the off-chance that
-                    # regionSize is a significant portion of the tile size).
-                    if region.shape[0] < regionSize or region.shape[1] < regionSize:
-                        continue
-                    # Find connected components in data.
-                    labeled, numComponents = scipy.ndimage.measurements.label(region)
-                    if numComponents != 1:
-                        # More than one bead visible, or no beads at all.
-                        continue
-                    # Find the centroid of the component
-                    yVals, xVals = numpy.where(region == 1)
-                    x, y = numpy.mean(xVals), numpy.mean(yVals)
-                    # Ensure that the bead is not near the edge, where
-                    # it might be close to a bead in a different region. Note
-                    # that our region iteration overlaps, so if a bead is truly
-                    # isolated we'll pick it up on a different loop.
-                    if (x < regionSize * .25 or x > regionSize * .75 or
-                            y < regionSize * .25 or y > regionSize * .75):
-                        continue
-                    # Ensure that the bead is circular, by comparing the area
-                    # of the bead to the area of a circle containing all of
-                    # the bead's pixels.
-                    xDists = [(x - xi) ** 2 for xi in xVals]
-                    yDists = [(y - yi) ** 2 for yi in yVals]
-                    maxDistSquared = max(map(sum, list(zip(xDists, yDists))))
-                    # Area of a circle containing all pixels
-                    area = numpy.pi * maxDistSquared
-                    # Reject beads whose area is less than 60% of the area of
-                    # the circle.
-                    if len(xVals) / area < .6:
-                        continue
-
-                    # Go from the subregion coordinates to full-tile coordinates
-                    x += k - data.shape[1] / 3
-                    y += j - data.shape[0] / 3
-                    pos = numpy.array([-tile.pos[0] - x * pixelSize[0],
-                            tile.pos[1] + y * pixelSize[1],
-                            tile.pos[2]])
-                    # Check for other marked beads that are close to this one.
-                    # \todo This process makes the entire system N^2
-                    # (where N is the number of sites), so it's moderately
-                    # expensive.
-                    canKeep = True
-                    for site in beadSites:
-                        distance = numpy.sqrt(sum((pos - site.pos) ** 2))
-                        if distance < 40:
-                            # Within 40 microns of another bead; skip it.
-                            canKeep = False
-                            break
-                    if not canKeep:
-                        continue
-                    # Record this potential bead. Its "size" is the number
-                    # of pixels in the component, and its intensity is the
-                    # average intensity of pixels in the component.
-                    newSite = BeadSite(pos, len(xVals),
-                            numpy.mean(data[(yVals, xVals)]))
-                    beadSites.append(newSite)
-
-        # Examine our bead sites and reject ones that are:
-        # - too large (probably conjoined or overlapping beads)
-        # - too bright (ditto)
-        # - too dim (bad signal:noise ratio)
-        # - too small (Could just be autoflourescing dust or something)
-        # Part of the trick here is that many beads may be slightly out of
-        # focus, so these constraints can't actually be all that tight.
-        sizes = numpy.array([b.size for b in beadSites])
-        sizeMedian = numpy.median(sizes)
-        sizeStd = numpy.std(sizes)
-        intensities = numpy.array([b.intensity for b in beadSites])
-        intenMedian = numpy.median(intensities)
-        intenStd = numpy.std(intensities)
-        siteQueue = []
-        for i, site in enumerate(beadSites):
-            if (site.size < sizeMedian - sizeStd * .5 or
-                    site.size > sizeMedian + sizeStd * 2):
-                # Too big or too small.
-                continue
-            if abs(site.intensity - intenMedian) > intenStd * 5:
-                # Wrong brightness.
-                continue
-            siteQueue.append(site.pos)
-
-        # Scan each site in Z to get perfect focus. Look up/down +- 1 micron,
-        # and pick the Z altitude with the brightest image.
+            for x, y, size, intensity in tileToBeads[i]:
+                positions.append((-tile.pos[0] - x * pixelSize[0],
+                                  tile.pos[1] + y * pixelSize[1],
+                                  tile.pos[2]))
+                sizes.append(size)
+                intensities.append(intensity)
+        # Drop beads within MIN_SITE_DISTANCE of another bead, then ones
+        # that are the wrong size or brightness.
+        keep = beads.removeCrowdedSites(positions)
+        positions = numpy.array(positions).reshape(-1, 3)[keep]
+        isGood = beads.filterSites(numpy.array(sizes)[keep],
+                                   numpy.array(intensities)[keep])
+        siteQueue = positions[isGood]
+        wx.CallAfter(statusDialog.Destroy)
+
+        # Scan each site in Z to get perfect focus.
         # HACK: use the first active camera we find.
         cameras = depot.getHandlersOfType(depot.CAMERA)
         camera = None
@@ -1294,23 +1409,100 @@ class MosaicWindow(wx.Frame, MosaicCommon):
             if alt.getIsEnabled():
                 camera = alt
                 break
+        if camera is None:
+            cockpit.util.logger.log.error(
+                    "No camera enabled to focus on beads with.")
+            wx.CallAfter(wx.MessageBox,
+                         "No camera is enabled to focus on the beads with,"
+                         " so no bead sites were saved.",
+                         "Bead focusing failed")
+            return
+        lights = [light for light in depot.getHandlersOfType(depot.LIGHT_TOGGLE)
+                  if light.getIsEnabled()]
+        exposureSettings = [([camera],
+                             [(light, decimal.Decimal(str(light.getExposureTime())))
+                              for light in lights])]
         for x, y, z in siteQueue:
-            bestOffset = 0
-            bestIntensity = None
-            for offset in numpy.arange(-1, 1.1, .1):
-                cockpit.interfaces.stageMover.goTo((x, y, z + offset), shouldBlock = True)
-                image, timestamp = events.executeAndWaitFor('new image %s' % camera.name,
-                        cockpit.interfaces.imager.takeImage, shouldBlock = True)
-                if bestIntensity is None or image.max() > bestIntensity:
-                    bestIntensity = image.max()
-                    bestOffset = offset
-            newSite = cockpit.interfaces.stageMover.Site((x, y, z + bestOffset),
+            try:
+                altitude = self.focusBeadSite((x, y, z), camera, lights,
+                                              exposureSettings)
+            except Exception as e:
+                # Keep the sites already focused, which have been saved.
+                cockpit.util.logger.log.error(
+                        "Failed to focus on bead at %s: %s", (x, y, z), e)
+                cockpit.util.logger.log.error(traceback.format_exc())
+                wx.CallAfter(wx.MessageBox,
+                             "Failed to focus on bead at (%.2f, %.2f, %.2f):"
+                             " %s" % (x, y, z, e),
+                             "Bead focusing failed")
+                break
+            if altitude is None:
+                # User cancelled.
+                break
+            newSite = cockpit.interfaces.stageMover.Site((x, y, altitude),
                     group = 'beads', size = 2)
             wx.CallAfter(cockpit.interfaces.stageMover.saveSite, newSite)
-        statusDialog.Destroy()
         wx.CallAfter(self.Refresh)
 
 
+    ## Take a Z-stack around the bead at the given position and return the
+    # altitude at which it is in best focus, or None if the stack was
+    # cancelled.  Raises RuntimeError if the stack does not start or
+    # takes no images.  The stack is a single ActionTable run by the executors,
+    # rather than a move and an exposure per slice, and since every site
+    # uses the same stack, its table is only generated for the first one.
+    def focusBeadSite(self, pos, camera, lights, exposureSettings):
+        x, y, z = pos
+        altBottom = z - beads.FOCUS_RANGE
+        cockpit.interfaces.stageMover.goTo((x, y, altBottom),
+                                           shouldBlock = True)
+        # Find the Z mover with the smallest range of motion, as for any
+        # other experiment.
+        mover = depot.getSortedStageMovers()[2][-1]
+        stack = cockpit.experiment.zStack.ZStackExperiment(
+                numReps = 1, repDuration = 0, zPositioner = mover,
+                altBottom = altBottom, zHeight = 2 * beads.FOCUS_RANGE,
+                sliceHeight = beads.FOCUS_STEP, cameras = [camera],
+                lights = lights, exposureSettings = exposureSettings)
+        images = []
+        def onImage(image, timestamp):
+            images.append(image)
+        isComplete = threading.Event()
+        events.subscribe('new image %s' % camera.name, onImage)
+        events.oneShotSubscribe(events.EXPERIMENT_COMPLETE, isComplete.set)
+        try:
+            if not stack.run():
+                raise RuntimeError("the Z stack did not start")
+            isComplete.wait()
+        finally:
+            events.unsubscribe('new image %s' % camera.name, onImage)
+        if stack.shouldAbort:
+            return None
+        ignored = stack.cameraToIgnoredImageIndices[camera]
+        scores = [beads.getFocusScore(image)
+                  for i, image in enumerate(images) if i not in ignored]
+        if not scores:
+            raise RuntimeError("the Z stack took no images with %s"
+                               % camera.name)
+        return altBottom + int(numpy.argmax(scores)) * beads.FOCUS_STEP
+
+
+    ## Generate the imapBounded tasks of a bead scan, which search the
+    # composite around each tile in turn, until the scan is stopped.
+    # Composites are only made as there is room for them in the pool, so
+    # they don't pile up in memory faster than they are searched.
+    def getBeadSearchTasks(self, tiles, shouldStop):
+        for tile in tiles:
+            if shouldStop.is_set():
+                return
+            try:
+                data = self.canvas.getCompositeTileData(tile, tiles)
+            except Exception as e:
+                print ("Failed to get tile data at %s: %s" % (tile.pos, e))
+                return
+            yield (beads.findBeadsInComposite, (data,))
+
+
     ## Handle the user clicking the abort button.
     def onAbort(self, *args):
         self.shouldContinue.clear()
@@ -51,12 +51,13 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
-import collections
+import collections.abc
 from cockpit import depot
 from . import deviceHandler
 from cockpit import events
 from cockpit.handlers.genericPositioner import GenericPositionerHandler
 from numbers import Number
+import numpy
 import operator
 import time
 from cockpit import util
@@ -64,6 +65,107 @@ import wx
 import functools
 
 
+## Given a sorted array of rows, return an array that gives, for each of
+# numRows rows, the index into that array of the latest row at or before
+# it, or -1 if there is none.
+def _getLatestRows(rows, numRows):
+    latest = numpy.full(numRows, -1, dtype=numpy.intp)
+    latest[rows] = numpy.arange(len(rows))
+    return numpy.maximum.accumulate(latest)
+
+
+## The digital and analog state of an executor at each distinct time
+# point of a section of an ActionTable, as compiled by
+# ExecutorHandler.compileTable, in arrays that executor devices can turn
+# into whatever their hardware needs.  It can also be used as the list of
+# (time, (digital state, analog states)) tuples that executor devices
+# used to be given.
+class ExecutorProfile:
+    ## \param times Sequence of times, in ms.
+    # \param digitals Sequence of digital states, or None if there are no
+    #        digital lines.
+    # \param analogs Sequence of sequences of analog states, one per
+    #        line, for each time; or None if there are no analog lines.
+    def __init__(self, times, digitals, analogs):
+        self.times = numpy.asarray(times, dtype=numpy.float64)
+        self.digitals = None
+        if digitals is not None:
+            self.digitals = numpy.asarray(digitals, dtype=numpy.int64)
+        self.analogs = None
+        if analogs is not None:
+            self.analogs = numpy.asarray(analogs, dtype=numpy.float64)
+            self.analogs = self.analogs.reshape(len(self.times), -1)
+
+    ## Make a profile from a list of (time, (digital state, analog states))
+    # tuples.
+    @classmethod
+    def fromActions(cls, actions):
+        times = [float(t) for t, state in actions]
+        digitals = [digital for t, (digital, analogs) in actions]
+        analogs = [analogs for t, (digital, analogs) in actions]
+        if not actions or digitals[0] is None:
+            digitals = None
+        if not actions or analogs[0] is None:
+            analogs = None
+        return cls(times, digitals, analogs)
+
+    def __len__(self):
+        return len(self.times)
+
+    ## Return the (time, (digital state, analog states)) tuple at index, or
+    # a list of them for a slice.
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        digital = None
+        if self.digitals is not None:
+            digital = int(self.digitals[index])
+        analogs = None
+        if self.analogs is not None:
+            analogs = self.analogs[index].tolist()
+        return (float(self.times[index]), (digital, analogs))
+
+    ## Return a profile of the time points from startIndex up to, but not
+    # including, stopIndex, with times relative to the first of them.  If
+    # repDuration is not None, and the time points end before it, the
+    # final state is repeated at repDuration so that repeats wait until
+    # then.
+    def rebase(self, startIndex, stopIndex, repDuration=None):
+        t0 = self.times[startIndex]
+        times = self.times[startIndex:stopIndex] - t0
+        rows = numpy.arange(startIndex, stopIndex)
+        if repDuration is not None:
+            repDuration = float(repDuration)
+            if times[-1] < repDuration:
+                times = numpy.append(times, t0 + repDuration)
+                rows = numpy.append(rows, stopIndex - 1)
+        return ExecutorProfile(
+            times,
+            None if self.digitals is None else self.digitals[rows],
+            None if self.analogs is None else self.analogs[rows])
+
+    ## Return the times as integer ticks of a clock with tickrate ticks
+    # per ms, rounded to the nearest tick.
+    def getTicks(self, tickrate):
+        return numpy.floor(self.times * tickrate + 0.5).astype(numpy.int64)
+
+    ## Return arrays of the ticks at which the digital state is set, and
+    # of the states.  Of several states on the same tick, only the last
+    # is kept.
+    def getDigitalEvents(self, tickrate):
+        ticks = self.getTicks(tickrate)
+        isLast = numpy.append(ticks[1:] != ticks[:-1], True)
+        return ticks[isLast], self.digitals[isLast]
+
+    ## Return arrays of the ticks at which the level of an analog line
+    # changes, and of the levels.  The first level is always included.
+    def getAnalogEvents(self, tickrate, line):
+        levels = self.analogs[:, line]
+        isChange = numpy.ones(len(levels), dtype=bool)
+        isChange[1:] = levels[1:] != levels[:-1]
+        return self.getTicks(tickrate)[isChange], levels[isChange]
+
+
 ## This handler is responsible for executing portions of experiments.
 class ExecutorHandler(deviceHandler.DeviceHandler):
     ## callbacks must include the following:
@@ -112,16 +214,18 @@ class ExecutorHandler(deviceHandler.DeviceHandler):
 
     def getNumRunnableLines(self, table, index):
         ## Return number of lines this handler can run.
-        count = 0
-        for time, handler, parameter in table[index:]:
-            # Check for analog and digital devices we control.
-            if (handler is not self and
-                   handler not in self.digitalClients and
-                   handler not in self.analogClients):
-                # Found a device we don't control.
-                break
-            count += 1
-        return count
+        ticks, handlerIndices, handlers = table.getColumns()
+        # Whether we control each handler in the table, either directly or
+        # as analog and digital devices, and not deleted rows.
+        isOurs = numpy.array([handler is self
+                              or handler in self.digitalClients
+                              or handler in self.analogClients
+                              for handler in handlers] + [False])
+        # Find the first device we don't control.
+        notOurs = numpy.flatnonzero(~isOurs[handlerIndices[index:]])
+        if len(notOurs):
+            return int(notOurs[0])
+        return len(handlerIndices) - index
 
     def _raiseNoDigitalException(self, *args, **kwargs):
         raise Exception("Digital lines not supported.")
@@ -142,70 +246,130 @@ class ExecutorHandler(deviceHandler.DeviceHandler):
         # The actions between startIndex and stopIndex may include actions for
         # this handler, or for this handler's clients. All actions are
         # ultimately carried out by this handler, so we need to parse the
-        # table to replace client actions, resulting in a table of
-        # (time, (analogStage, digitalState)).
-        if isinstance(self, DigitalMixin):
-            dstate = self.readDigital()
-        else:
-            dstate = None
-        if isinstance(self, AnalogMixin):
-            astate = [self.getAnalogLine(line) for line in range(self._alines)]
-        else:
-            astate = None
-
-        actions = []
-
-        tPrev = None
-        hPrev = None
-        argsPrev = None
-
-        for i in range(startIndex, stopIndex):
-            t, h, args = table[i]
-            if h in self.analogClients:
-                # update analog state
-                lineHandler = self.analogClients[h]
-                if isinstance(args, collections.Iterable):
-                    # Using an indexed position
-                    pos = lineHandler.indexedPosition(*args)
-                else:
-                    pos = args
-                astate[lineHandler.line] = lineHandler.posToNative(pos)
-            elif h in self.digitalClients:
-                # set/clear appropriate bit
-                change = 1 << self.digitalClients[h]
-                # args contains new bit state
-                if args:
-                    dstate |= change
-                else:
-                    dstate = dstate & (2**self._dlines - 1) - (change)
-
-            # Check for simultaneous actions.
-            if tPrev is not None and t == tPrev:
-                if h not in hPrev:
-                    # Update last action to merge actions at same timepoint.
-                    actions[-1] = (t, (dstate, astate[:]))
-                    # Add handler and args to list for next check.
-                    hPrev.append(h)
-                    argsPrev.append(args)
-                elif args == argsPrev[hPrev.index(h)]:
-                    # Just a duplicate entry
-                    continue
-                else:
-                    # Simultaneous, different actions with same handler.
-                    raise Exception("Simultaneous actions with same hander, %s." % h)
-            else:
-                # Append new action.
-                actions.append((t, (dstate, astate[:])))
-                # Reinitialise hPrev and argsPrev for next check.
-                hPrev, argsPrev = [h], [args]
-                tPrev = t
+        # table to replace client actions, resulting in a profile of
+        # (time, (digitalState, analogStates)).
+        profile = self.compileTable(table, startIndex, stopIndex)
 
         events.publish('update status light', 'device waiting',
                        'Waiting for\n%s to finish' % self.name, (255, 255, 0))
 
-        return self.callbacks['executeTable'](actions, 0, len(actions), numReps,
+        return self.callbacks['executeTable'](profile, 0, len(profile), numReps,
                                               repDuration)
 
+    ## Compile the actions between startIndex and stopIndex of an
+    # ActionTable into an ExecutorProfile of our digital and analog state
+    # at each distinct time point.  This works on whole columns of the
+    # table at a time, rather than row by row.  Actions at the same time
+    # are merged into a single time point; duplicate actions are ignored,
+    # but different actions at the same time for the same handler are an
+    # error.
+    def compileTable(self, table, startIndex, stopIndex):
+        allTicks, allHandlerIndices, handlers = table.getColumns()
+        ticks = allTicks[startIndex:stopIndex]
+        handlerIndices = allHandlerIndices[startIndex:stopIndex]
+        parameters = table.getParameters()[startIndex:stopIndex]
+        if not len(ticks):
+            return ExecutorProfile([], None, None)
+
+        # Number the groups of simultaneous actions.
+        isNewTime = numpy.ones(len(ticks), dtype=bool)
+        isNewTime[1:] = ticks[1:] != ticks[:-1]
+        self._checkSimultaneousActions(numpy.cumsum(isNewTime),
+                                       handlerIndices, handlers, parameters)
+        # The state at each time point is the state after the last action
+        # at that time.
+        lastRows = numpy.flatnonzero(numpy.append(isNewTime[1:], True))
+
+        digitals = None
+        if isinstance(self, DigitalMixin):
+            digitals = self._compileDigital(handlerIndices, handlers,
+                                            parameters)[lastRows]
+        analogs = None
+        if isinstance(self, AnalogMixin):
+            analogs = self._compileAnalog(handlerIndices, handlers,
+                                          parameters)[lastRows]
+        return ExecutorProfile(ticks[lastRows] / table.ticksPerMs,
+                               digitals, analogs)
+
+    ## Raise an exception if a handler has different actions in the same
+    # group of simultaneous actions.
+    def _checkSimultaneousActions(self, groups, handlerIndices, handlers,
+                                  parameters):
+        # Deleted rows have a handler index of -1, which does not collide
+        # with any handler in the next group.
+        keys = groups * (len(handlers) + 1) + handlerIndices
+        order = numpy.argsort(keys, kind='mergesort')
+        sortedKeys = keys[order]
+        for i in numpy.flatnonzero(sortedKeys[1:] == sortedKeys[:-1]).tolist():
+            first, second = order[i], order[i + 1]
+            if parameters[first] != parameters[second]:
+                raise Exception("Simultaneous actions with same hander, %s."
+                                % handlers[handlerIndices[first]])
+
+    ## Return an array of the digital state after each action.
+    def _compileDigital(self, handlerIndices, handlers, parameters):
+        # Line of each handler in the table, and -1 for handlers that are
+        # not digital clients and for deleted rows.
+        handlerLines = numpy.array(
+            [self.digitalClients.get(handler, -1)
+             if handler not in self.analogClients else -1
+             for handler in handlers] + [-1])
+        rowLines = handlerLines[handlerIndices]
+        states = numpy.full(len(handlerIndices), self.readDigital(),
+                            dtype=numpy.int64)
+        for line in numpy.unique(rowLines[rowLines >= 0]).tolist():
+            rows = numpy.flatnonzero(rowLines == line)
+            # Parameters contain the new bit state.
+            values = numpy.array([bool(parameters[i]) for i in rows.tolist()],
+                                 dtype=numpy.int64)
+            latest = _getLatestRows(rows, len(handlerIndices))
+            isSet = numpy.where(latest >= 0, values[latest],
+                                (states >> line) & 1)
+            states = (states & ~(1 << line)) | (isSet << line)
+        return states
+
+    ## Return a 2D array of the analog state of each line after each
+    # action.
+    def _compileAnalog(self, handlerIndices, handlers, parameters):
+        states = numpy.empty((len(handlerIndices), self._alines))
+        for line in range(self._alines):
+            states[:, line] = self.getAnalogLine(line)
+        # Rows and native levels of the actions on each line.
+        lineToRows = collections.defaultdict(list)
+        lineToLevels = collections.defaultdict(list)
+        for handlerIndex, handler in enumerate(handlers):
+            if handler not in self.analogClients:
+                continue
+            lineHandler = self.analogClients[handler]
+            rows = numpy.flatnonzero(handlerIndices == handlerIndex)
+            if not len(rows):
+                continue
+            # Indexed positions are looked up once per distinct index.
+            indexToPosition = {}
+            positions = []
+            for i in rows.tolist():
+                args = parameters[i]
+                if isinstance(args, collections.abc.Iterable):
+                    # Using an indexed position
+                    if args not in indexToPosition:
+                        indexToPosition[args] = lineHandler.indexedPosition(*args)
+                    positions.append(indexToPosition[args])
+                else:
+                    positions.append(args)
+            lineToRows[lineHandler.line].append(rows)
+            lineToLevels[lineHandler.line].append(
+                lineHandler.posToNative(numpy.array(positions, dtype=float)))
+        for line, rows in lineToRows.items():
+            rows = numpy.concatenate(rows)
+            levels = numpy.concatenate(lineToLevels[line])
+            order = numpy.argsort(rows, kind='mergesort')
+            rows = rows[order]
+            levels = levels[order]
+            latest = _getLatestRows(rows, len(handlerIndices))
+            states[:, line] = numpy.where(latest >= 0, levels[latest],
+                                          states[:, line])
+        return states
+
     ## Debugging function: display ExecutorOutputWindow.
     def showDebugWindow(self):
         # Ensure only a single instance of the window.
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time to build, sort and query a SIM action table.
+
+This is not part of the testsuite.  Run it with::
+
+    python -m cockpit.testsuite.benchmark_actionTable [NPLANES]
+
+The table is built the way StructuredIlluminationExperiment builds
+one: for each Z plane, 3 angles by 5 phases of polarizer and SLM
+moves, light pulses and camera triggers.  Before each exposure it
+looks up the last polarizer action and the last trigger of each
+camera, as Experiment.expose does through getTimeWhenCameraCanExpose.
+The second camera is only used once per plane, so finding its last
+action means looking back over the whole plane.  It compares the
+current ActionTable against the previous list of tuples.
+
+It also times looking up the last action of a handler that was only
+used at the start of the experiment, which used to mean searching the
+whole table.
+"""
+
+import decimal
+import sys
+import time
+
+import cockpit.experiment.actionTable
+
+
+## The ActionTable as it was before it had columns and a per-handler
+## index, reduced to what the benchmark uses.
+class LegacyActionTable:
+    def __init__(self):
+        self.actions = []
+        self.firstActionTime = None
+        self.lastActionTime = None
+
+    def addAction(self, time, handler, parameter):
+        self.actions.append((time, handler, parameter))
+        if self.firstActionTime is None or self.firstActionTime > time:
+            self.firstActionTime = time
+        if self.lastActionTime is None or self.lastActionTime < time:
+            self.lastActionTime = time
+        return time
+
+    def getLastActionFor(self, handler):
+        for time, altHandler, parameter in reversed(self.actions):
+            if altHandler is handler:
+                return time, parameter
+        return None, None
+
+    def sort(self):
+        self.actions.sort(key=lambda a: a[0])
+
+
+class Handler:
+    def __init__(self, name):
+        self.name = name
+
+
+def buildSIMTable(table, numPlanes, shutter):
+    zStage, polarizer, slm, light = [Handler(name) for name in
+                                     ('z', 'polarizer', 'slm', 'light')]
+    cameras = [Handler('camera 1'), Handler('camera 2')]
+    curTime = decimal.Decimal(0)
+    step = decimal.Decimal('.1')
+    table.addAction(curTime, shutter, True)
+    for plane in range(numPlanes):
+        table.addAction(curTime, zStage, plane * step)
+        curTime += 1
+        for angle in range(3):
+            for phase in range(5):
+                table.getLastActionFor(polarizer)
+                table.addAction(curTime, polarizer, angle)
+                table.addAction(curTime, slm, (angle, phase))
+                curTime += 2
+                for camera in cameras:
+                    table.getLastActionFor(camera)
+                table.addAction(curTime, light, True)
+                table.addAction(curTime + 5, light, False)
+                table.addAction(curTime + 5, cameras[0], True)
+                table.addAction(curTime + 5 + step, cameras[0], False)
+                curTime += 6
+        table.addAction(curTime, cameras[1], True)
+        table.addAction(curTime + step, cameras[1], False)
+        curTime += 1
+    return table
+
+
+def main(argv):
+    numPlanes = int(argv[1]) if len(argv) > 1 else 10000
+    for name, tableClass in (
+            ('legacy', LegacyActionTable),
+            ('current', cockpit.experiment.actionTable.ActionTable)):
+        shutter = Handler('shutter')
+        start = time.perf_counter()
+        table = buildSIMTable(tableClass(), numPlanes, shutter)
+        built = time.perf_counter()
+        table.sort()
+        sortDone = time.perf_counter()
+        for i in range(100):
+            table.getLastActionFor(shutter)
+        done = time.perf_counter()
+        print('%-8s %d actions: build %6.2f s, sort %6.3f s,'
+              ' first-action lookup %8.3f ms'
+              % (name, len(table.actions), built - start, sortDone - built,
+                 (done - sortDone) * 10))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sustained write rate of DataSaver.writeImage.
+
+This is not part of the testsuite (it writes several GB to disk).
+Run it with::
+
+    python -m cockpit.testsuite.benchmark_dataSaver [NFRAMES [SIZE]]
+
+It compares the current write path, which writes full-size frames
+straight from the camera buffer, against the previous one, which
+padded every frame into a freshly allocated buffer.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest.mock
+
+import numpy
+
+import cockpit.depot
+import cockpit.experiment.dataSaver
+
+
+def makeSaver(path, nFrames, size):
+    cockpit.depot.deviceDepot = cockpit.depot.DeviceDepot()
+    objective = unittest.mock.Mock(deviceType=cockpit.depot.OBJECTIVE)
+    objective.getPixelSize.return_value = 0.1
+    objective.getLensID.return_value = 0
+    cockpit.depot.deviceDepot.deviceTypeToHandlers = {
+        cockpit.depot.OBJECTIVE: [objective],
+    }
+    camera = unittest.mock.Mock(dye=None, wavelength=525)
+    camera.name = 'benchmark'
+    camera.getImageSize.return_value = (size, size)
+    return cockpit.experiment.dataSaver.DataSaver(
+        [camera], 1, {camera: nFrames}, {camera: set()}, None, path,
+        0.1, [], {camera: 488})
+
+
+## The write path as it was before DataSaver reused its buffers.
+def legacyWrite(handle, frames, size):
+    extendedBytes = 4 * (8 + 32)
+    planeBytes = size * size * 2
+    dataOffset = 1024 + extendedBytes * len(frames)
+    ints = numpy.zeros(8, dtype=numpy.int32)
+    floats = numpy.zeros(32, dtype=numpy.float32)
+    for i, frame in enumerate(frames):
+        padded = numpy.zeros((size, size), dtype=numpy.uint16)
+        padded[:frame.shape[0], :frame.shape[1]] = frame
+        floats[5] = frame.min()
+        floats[6] = frame.max()
+        handle.seek(1024 + i * extendedBytes)
+        handle.write(ints)
+        handle.write(floats)
+        handle.seek(dataOffset + i * planeBytes)
+        handle.write(padded)
+
+
+def main(argv):
+    nFrames = int(argv[1]) if len(argv) > 1 else 200
+    size = int(argv[2]) if len(argv) > 2 else 2048
+    ## A handful of distinct frames, cycled, so that we measure the
+    ## writer and not the random number generator.
+    frames = [numpy.random.randint(100, 4000, (size, size), dtype=numpy.uint16)
+              for i in range(8)]
+    stream = [frames[i % len(frames)] for i in range(nFrames)]
+    mbytes = nFrames * size * size * 2 / 2**20
+
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'legacy.dv')
+        with open(path, 'wb') as handle:
+            start = time.perf_counter()
+            cpuStart = time.process_time()
+            legacyWrite(handle, stream, size)
+            handle.flush()
+            os.fsync(handle.fileno())
+            legacyCPU = time.process_time() - cpuStart
+            legacyTime = time.perf_counter() - start
+        os.remove(path)
+
+        saver = makeSaver(os.path.join(dirname, 'current.dv'), nFrames, size)
+        start = time.perf_counter()
+        cpuStart = time.process_time()
+        for i, frame in enumerate(stream):
+            saver.writeImage(0, frame, i * 0.01)
+        for writer in saver.writers:
+            writer.sync()
+        currentCPU = time.process_time() - cpuStart
+        currentTime = time.perf_counter() - start
+        saver.closeFiles()
+
+    print('%d frames of %dx%d (%.0f MB)' % (nFrames, size, size, mbytes))
+    for name, elapsed, cpu in (('legacy', legacyTime, legacyCPU),
+                               ('current', currentTime, currentCPU)):
+        print('  %-10s %8.1f frames/s %8.1f MB/s %6.2f ms CPU/frame'
+              % (name, nFrames / elapsed, mbytes / elapsed,
+                 1000 * cpu / nFrames))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time to the first displayed plane when opening a file with DataDoc.
+
+This is not part of the testsuite (it writes a file of several GB).
+Run it with::
+
+    python -m cockpit.testsuite.benchmark_datadoc [NPLANES [SIZE]]
+
+It compares opening the file with DataDoc, which maps the file and only
+reads what is used, against the previous way, which read the whole file
+into memory and averaged every wavelength before anything was shown.
+The file has just been written, so it is likely to be in the page
+cache; the legacy times are much longer when it is not.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+import cockpit.util.Mrc
+import cockpit.util.datadoc
+
+
+## DataDoc's loading as it was before the array became a view of the
+# file: a copy of all of the data, and the average of each wavelength.
+def legacyLoad(path):
+    image = cockpit.util.Mrc.bindFile(path)
+    header = image.Mrc.hdr
+    numWavelengths = header.NumWaves
+    numTimepoints = header.NumTimes
+    numZ = header.Num[2] // (numWavelengths * numTimepoints)
+    size = [numWavelengths, numTimepoints, numZ, header.Num[1], header.Num[0]]
+    imageArray = cockpit.util.datadoc.reorderArray(
+        numpy.array(image), size, image.Mrc.axisOrderStr())
+    averages = [imageArray[wavelength].mean()
+                for wavelength in range(numWavelengths)]
+    return imageArray, averages
+
+
+def main(argv):
+    nPlanes = int(argv[1]) if len(argv) > 1 else 512
+    size = int(argv[2]) if len(argv) > 2 else 2048
+    plane = numpy.random.randint(100, 4000, (size, size), dtype=numpy.uint16)
+    gbytes = nPlanes * plane.nbytes / 2**30
+
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'benchmark.dv')
+        header = cockpit.util.datadoc.makeHeaderForShape(
+            (1, 1, nPlanes, size, size), numpy.uint16)
+        with open(path, 'wb') as handle:
+            cockpit.util.datadoc.writeMrcHeader(header, handle)
+            for i in range(nPlanes):
+                handle.write(plane)
+
+        start = time.perf_counter()
+        imageArray, averages = legacyLoad(path)
+        first = numpy.array(imageArray[:, 0, 0])
+        legacyTime = time.perf_counter() - start
+        del imageArray, first
+
+        start = time.perf_counter()
+        doc = cockpit.util.datadoc.DataDoc(path)
+        first = numpy.array(doc.imageArray[:, 0, 0])
+        currentTime = time.perf_counter() - start
+        averages = doc.averages
+        averagesTime = time.perf_counter() - start - currentTime
+        del doc, first
+
+    print('%d planes of %dx%d (%.1f GB)' % (nPlanes, size, size, gbytes))
+    print('  %-10s %8.3f s to first plane' % ('legacy', legacyTime))
+    print('  %-10s %8.3f s to first plane, %.3f s more for averages'
+          % ('current', currentTime, averagesTime))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time to find the mosaic tiles to paint and to delete.
+
+This is not part of the testsuite.  Run it with::
+
+    python -m cockpit.testsuite.benchmark_mosaic [NTILES ...]
+
+The mosaic is a square of overlapping 100 micron tiles, by default of
+10000 and 100000 tiles.  It times the work MosaicCanvas does on the
+CPU, since there is no OpenGL context to draw in:
+
+* paint: finding the tiles in a zoomed in view, and the megatiles in a
+  zoomed out view, for views spread over the mosaic.
+* delete: removing a selection of about a thousand tiles from the list
+  of tiles, and finding the megatiles it dirtied.
+
+It compares the current TileGrid index against the previous scans of
+every tile and megatile.
+"""
+
+import math
+import sys
+import time
+
+import cockpit.gui.mosaic.tile
+
+
+TILE_SIZE = 100
+TILE_STEP = 90
+MEGATILE_SIZE = 4096
+
+
+## Just enough of a Tile to be indexed and tested for intersection.
+class BoxTile:
+    intersectsBox = cockpit.gui.mosaic.tile.Tile.intersectsBox
+
+    def __init__(self, pos, size):
+        self.pos = pos
+        self.size = size
+        self.box = (pos, (pos[0] + size, pos[1] + size))
+
+
+def makeMosaic(nTiles):
+    side = int(math.ceil(math.sqrt(nTiles)))
+    tiles = [BoxTile((i * TILE_STEP, j * TILE_STEP), TILE_SIZE)
+             for i in range(side) for j in range(side)][:nTiles]
+    extent = side * TILE_STEP + TILE_SIZE
+    megaTiles = [BoxTile((x, y), MEGATILE_SIZE)
+                 for x in range(-MEGATILE_SIZE, extent + MEGATILE_SIZE,
+                                MEGATILE_SIZE)
+                 for y in range(-MEGATILE_SIZE, extent + MEGATILE_SIZE,
+                                MEGATILE_SIZE)]
+    return side, tiles, megaTiles
+
+
+## View boxes of the given width spread along the diagonal of the mosaic.
+def makeViews(side, width, numViews=20):
+    extent = side * TILE_STEP
+    views = []
+    for i in range(numViews):
+        x = extent * i / numViews
+        views.append(((x, x), (x + width, x + width)))
+    return views
+
+
+def legacyPaint(tiles, megaTiles, tileViews, megaTileViews):
+    for viewBox in tileViews:
+        [tile for tile in tiles if tile.intersectsBox(viewBox)]
+    for viewBox in megaTileViews:
+        [tile for tile in megaTiles if tile.intersectsBox(viewBox)]
+
+
+def currentPaint(grid, megaGrid, tileViews, megaTileViews):
+    for viewBox in tileViews:
+        grid.getIntersecting(viewBox)
+    for viewBox in megaTileViews:
+        megaGrid.getIntersecting(viewBox)
+
+
+def legacyDelete(tiles, megaTiles, toDelete):
+    for tile in toDelete:
+        del tiles[tiles.index(tile)]
+    dirtied = []
+    for megaTile in megaTiles:
+        for tile in toDelete:
+            if megaTile.intersectsBox(tile.box):
+                dirtied.append(megaTile)
+                break
+    return dirtied
+
+
+def currentDelete(tiles, grid, megaGrid, toDelete):
+    for tile in toDelete:
+        grid.remove(tile)
+    deleted = set(toDelete)
+    tiles[:] = [tile for tile in tiles if tile not in deleted]
+    dirtied = set()
+    for tile in toDelete:
+        dirtied.update(megaGrid.getIntersecting(tile.box))
+    return dirtied
+
+
+def benchmark(nTiles):
+    side, tiles, megaTiles = makeMosaic(nTiles)
+    grid = cockpit.gui.mosaic.tile.TileGrid()
+    for tile in tiles:
+        grid.add(tile)
+    megaGrid = cockpit.gui.mosaic.tile.TileGrid()
+    for megaTile in megaTiles:
+        megaGrid.add(megaTile)
+    tileViews = makeViews(side, 5 * TILE_SIZE)
+    megaTileViews = makeViews(side, 5 * MEGATILE_SIZE)
+    # A block of tiles from the middle of the mosaic.
+    middle = side // 2
+    toDelete = grid.getIntersecting(
+        ((middle * TILE_STEP + 1, middle * TILE_STEP + 1),
+         ((middle + 29) * TILE_STEP + 1, (middle + 29) * TILE_STEP + 1)))
+
+    times = {}
+    start = time.perf_counter()
+    legacyPaint(tiles, megaTiles, tileViews, megaTileViews)
+    times['legacy paint'] = (time.perf_counter() - start) / len(tileViews)
+    start = time.perf_counter()
+    currentPaint(grid, megaGrid, tileViews, megaTileViews)
+    times['current paint'] = (time.perf_counter() - start) / len(tileViews)
+
+    legacyTiles = list(tiles)
+    start = time.perf_counter()
+    legacyDirtied = legacyDelete(legacyTiles, megaTiles, toDelete)
+    times['legacy delete'] = time.perf_counter() - start
+    start = time.perf_counter()
+    currentDirtied = currentDelete(tiles, grid, megaGrid, toDelete)
+    times['current delete'] = time.perf_counter() - start
+    assert legacyTiles == tiles
+    assert set(legacyDirtied) == currentDirtied
+
+    print('%d tiles, %d megatiles, deleting %d tiles'
+          % (nTiles, len(megaTiles), len(toDelete)))
+    for name in ('legacy paint', 'current paint',
+                 'legacy delete', 'current delete'):
+        print('  %-15s %10.3f ms' % (name, 1000 * times[name]))
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or [10000, 100000]
+    for nTiles in sizes:
+        benchmark(nTiles)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
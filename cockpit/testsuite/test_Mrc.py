@@ -18,7 +18,14 @@
 ## You should have received a copy of the GNU General Public License
 ## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import os.path
+import tempfile
+import threading
 import unittest
+import unittest.mock
+
+import numpy
 
 import cockpit.util.Mrc as Mrc
 
@@ -55,3 +62,110 @@ class TruncatedMrcFiles(unittest.TestCase):
                 numel = case[0]
                 shape = case[1]
                 Mrc.adjusted_data_shape(numel, shape)
+
+
+class TestMrcWriter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'test.dv')
+        self.hdr = Mrc.makeHdrArray()
+        Mrc.init_simple(self.hdr, Mrc.dtype2MrcMode(numpy.uint16), (6, 4, 5))
+        self.hdr.NumIntegers = 1
+        self.hdr.NumFloats = 2
+        self.hdr.next = 6 * 12
+        self.record = numpy.zeros(1, [('int', numpy.int32, (1,)),
+                                      ('float', numpy.float32, (2,))])
+        self.planes = numpy.arange(6 * 4 * 5,
+                                   dtype=numpy.uint16).reshape(6, 4, 5)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def read(self):
+        data = Mrc.bindFile(self.path)
+        ## Copies, as the header is only valid while the file is mapped.
+        return (Mrc.implement_hdr(data.Mrc.hdr._array.copy()),
+                numpy.array(data), numpy.array(data.Mrc.extFloats))
+
+    def test_preallocates(self):
+        with Mrc.MrcWriter(self.path, self.hdr):
+            self.assertEqual(os.path.getsize(self.path),
+                             1024 + 6 * 12 + 6 * 4 * 5 * 2)
+        hdr, data, floats = self.read()
+        self.assertEqual(data.shape, (6, 4, 5))
+        self.assertFalse(data.any())
+
+    def test_write_sections_from_threads(self):
+        with Mrc.MrcWriter(self.path, self.hdr) as writer:
+            def write(i):
+                record = self.record.copy()
+                record['float'][0, 1] = i
+                writer.writeSec(i, self.planes[i], record)
+            threads = [threading.Thread(target=write, args=(i,))
+                       for i in reversed(range(6))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        hdr, data, floats = self.read()
+        numpy.testing.assert_array_equal(data, self.planes)
+        numpy.testing.assert_array_equal(floats[:, 1], range(6))
+
+    def test_write_sections_vectored(self):
+        with Mrc.MrcWriter(self.path, self.hdr) as writer:
+            ## A stack, a plane, and a stack that is not contiguous.
+            writer.writeSecs(1, [self.planes[1:3], self.planes[3],
+                                 numpy.asfortranarray(self.planes[4:])])
+        hdr, data, floats = self.read()
+        numpy.testing.assert_array_equal(data[1:], self.planes[1:])
+        self.assertFalse(data[0].any())
+
+    @unittest.skipUnless(hasattr(os, 'pwritev'), 'no os.pwritev')
+    def test_short_writes(self):
+        pwritev = os.pwritev
+        def shortWrite(fd, buffers, offset):
+            ## Write at most half of the first buffer.
+            return pwritev(fd, [buffers[0][:max(1, len(buffers[0]) // 2)]],
+                           offset)
+        with Mrc.MrcWriter(self.path, self.hdr) as writer:
+            with unittest.mock.patch('os.pwritev', shortWrite):
+                writer.writeSecs(0, list(self.planes))
+        hdr, data, floats = self.read()
+        numpy.testing.assert_array_equal(data, self.planes)
+
+    def test_byte_order(self):
+        for isSwapped in (False, True):
+            hdr = self.hdr
+            if isSwapped:
+                ## As the header of a file of the other byte order.
+                hdr = Mrc.implement_hdr(self.hdr._array.astype(
+                    self.hdr._array.dtype.newbyteorder()))
+            with Mrc.MrcWriter(self.path, hdr) as writer:
+                writer.writeSecs(0, [self.planes[:3]])
+                writer.writeSecs(3, [self.planes[3:].byteswap().view(
+                    self.planes.dtype.newbyteorder())])
+            data = Mrc.bindFile(self.path)
+            self.assertEqual(data.Mrc.isByteSwapped, isSwapped)
+            numpy.testing.assert_array_equal(data, self.planes)
+            del data
+
+    def test_header_finalized_on_close(self):
+        initial = numpy.array(self.hdr.mmm1)
+        writer = Mrc.MrcWriter(self.path, self.hdr)
+        self.hdr.mmm1 = (1, 2, 3)
+        hdr, data, floats = self.read()
+        numpy.testing.assert_array_equal(hdr.mmm1, initial)
+        writer.close()
+        hdr, data, floats = self.read()
+        numpy.testing.assert_array_equal(hdr.mmm1, (1, 2, 3))
+
+    def test_out_of_range(self):
+        with Mrc.MrcWriter(self.path, self.hdr) as writer:
+            with self.assertRaisesRegex(ValueError, 'beyond'):
+                writer.writeSecs(5, [numpy.zeros((2, 4, 5), numpy.uint16)])
+            with self.assertRaisesRegex(ValueError, 'beyond'):
+                writer.writeExtHeader(6, self.record)
+            with self.assertRaisesRegex(ValueError, 'not sections'):
+                writer.writeSec(0, numpy.zeros((4, 4), numpy.uint16))
+            with self.assertRaisesRegex(ValueError, 'not sections'):
+                writer.writeSec(0, numpy.zeros((4, 5), numpy.float32))
@@ -228,6 +228,164 @@ class TestActionTable(unittest.TestCase):
         for i, action in enumerate(self.action_table):
             self.assertLessEqual(self.action_table[i][0], action[0])
 
+    def test_sort_is_stable(self):
+        handlers = [_MockDeviceHandler(str(n)) for n in range(3)]
+        self.action_table.addAction(1, handlers[0], None)
+        self.action_table.addAction(0, handlers[1], None)
+        self.action_table.addAction(1, handlers[2], None)
+        self.action_table.sort()
+        self.assertEqual([a[1] for a in self.action_table],
+                         [handlers[1], handlers[0], handlers[2]])
+
+    def test_sort_keeps_exact_times(self):
+        third = decimal.Decimal(1) / 3
+        self.action_table.addAction(third, None, 'a')
+        self.action_table.addAction(0, None, 'b')
+        self.action_table.sort()
+        self.assertEqual(self.action_table[1], (third, None, 'a'))
+
+    def test___getitem___slice(self):
+        for n in range(5):
+            self.action_table.addAction(n, None, n)
+        self.assertEqual(self.action_table[3:],
+                         [(3, None, 3), (4, None, 4)])
+
+    def test___getitem___out_of_range(self):
+        self.action_table.addAction(0, None, None)
+        with self.assertRaises(IndexError):
+            self.action_table[1]
+
+    def test___setitem___replaces_action(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(0, None, None)
+        self.action_table[0] = (2, handler, 'on')
+        self.assertEqual(self.action_table[0], (2, handler, 'on'))
+
+    def test_actions_marks_deleted(self):
+        self.action_table.addAction(0, None, None)
+        self.action_table.addAction(1, None, None)
+        self.action_table[0] = None
+        self.assertEqual(self.action_table.actions, [None, (1, None, None)])
+
+    def test_shiftActionsBack_skips_earlier_and_deleted(self):
+        for t in range(3):
+            self.action_table.addAction(t, None, t)
+        self.action_table[2] = None
+        self.action_table.shiftActionsBack(1, 5)
+        self.action_table.clearBadEntries()
+        self.assertEqual(self.action_table.actions,
+                         [(0, None, 0), (6, None, 1)])
+
+    def test_getLastActionFor_missing_handler(self):
+        self.action_table.addAction(0, None, None)
+        self.assertEqual(
+            self.action_table.getLastActionFor(_MockDeviceHandler()),
+            (None, None))
+
+    def test_getLastActionFor_after_sort(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(2, handler, 'late')
+        self.action_table.addAction(1, handler, 'early')
+        self.action_table.sort()
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (2, 'late'))
+        self.action_table.addAction(3, handler, 'later')
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (3, 'later'))
+
+    def test_getLastActionFor_after_delete(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(0, handler, 'first')
+        self.action_table.addAction(1, handler, 'second')
+        self.action_table[1] = None
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (0, 'first'))
+        self.action_table.clearBadEntries()
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (0, 'first'))
+
+    def test_getLastActionFor_after_replace(self):
+        handlers = [_MockDeviceHandler(str(n)) for n in range(2)]
+        self.action_table.addAction(0, handlers[0], None)
+        self.action_table.addAction(1, handlers[0], None)
+        self.action_table[1] = (1, handlers[1], None)
+        self.assertEqual(self.action_table.getLastActionFor(handlers[0]),
+                         (0, None))
+        self.assertEqual(self.action_table.getLastActionFor(handlers[1]),
+                         (1, None))
+
+    def test_getLastActionBefore(self):
+        handler = _MockDeviceHandler()
+        for t in range(0, 10, 2):
+            self.action_table.addAction(t, handler, t)
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 5),
+                         (4, 4))
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 4),
+                         (2, 2))
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 0),
+                         (None, None))
+
+    def test_getLastActionBefore_unsorted(self):
+        handler = _MockDeviceHandler()
+        for t in (6, 2, 4, 8):
+            self.action_table.addAction(t, handler, t)
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 7),
+                         (6, 6))
+
+    def test_getLastActionBefore_ties(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(1, handler, 'a')
+        self.action_table.addAction(1, handler, 'b')
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 2),
+                         (1, 'b'))
+
+    def test_getLastActionBefore_after_shift(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(0, handler, 'a')
+        self.action_table.addAction(1, handler, 'b')
+        self.action_table.shiftActionsBack(1, 5)
+        self.assertEqual(self.action_table.getLastActionBefore(handler, 5),
+                         (0, 'a'))
+
+    def test_getIndicesFor(self):
+        handler = _MockDeviceHandler()
+        for t in range(4):
+            self.action_table.addAction(t, handler if t % 2 else None, None)
+        self.assertEqual(list(self.action_table.getIndicesFor(handler)),
+                         [1, 3])
+
+    def test_getIndicesInRange(self):
+        for t in range(5):
+            self.action_table.addAction(decimal.Decimal(t) / 2, None, None)
+        self.assertEqual(self.action_table.getIndicesInRange(
+            decimal.Decimal('.5'), decimal.Decimal('1.5')), (1, 3))
+
+    def test_getFirstAndLastActionTimes_no_cache(self):
+        for t in (3, 1, 2):
+            self.action_table.addAction(t, None, None)
+        self.assertEqual(
+            self.action_table.getFirstAndLastActionTimes(canUseCache=False),
+            (1, 3))
+
+    def test_copy_is_independent(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(0, handler, 'a')
+        copy = self.action_table.copy()
+        copy.addAction(1, handler, 'b')
+        copy[0] = None
+        self.assertEqual(self.action_table.actions, [(0, handler, 'a')])
+        self.assertEqual(copy.actions, [None, (1, handler, 'b')])
+        self.assertEqual(copy.getLastActionFor(handler), (1, 'b'))
+
+    def test_offsetParameters(self):
+        handler = _MockDeviceHandler()
+        other = _MockDeviceHandler()
+        self.action_table.addAction(0, handler, 1)
+        self.action_table.addAction(1, other, 1)
+        self.action_table.addAction(2, handler, 2)
+        self.action_table.offsetParameters(handler, 10)
+        self.assertEqual([a[2] for a in self.action_table], [11, 1, 12])
+
     def test_creation(self):
         pass
 
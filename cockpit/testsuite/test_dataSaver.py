@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.depot
+import cockpit.experiment.dataSaver
+import cockpit.util.Mrc
+
+
+class TestIntensityStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = cockpit.experiment.dataSaver.IntensityStats()
+
+    def addImage(self, image):
+        self.stats.addImage(image, image.min(), image.max())
+
+    def test_empty(self):
+        self.assertEqual((self.stats.min, self.stats.max), (0, 0))
+        self.assertEqual(self.stats.getPercentile(50), 0)
+
+    def test_small_image_is_exact(self):
+        image = numpy.arange(1, 101, dtype=numpy.uint16).reshape(10, 10)
+        self.addImage(image)
+        self.assertEqual((self.stats.min, self.stats.max), (1, 100))
+        self.assertEqual(self.stats.getPercentile(50), 50)
+        self.assertEqual(self.stats.getPercentile(1), 1)
+        self.assertEqual(self.stats.getPercentile(100), 100)
+
+    def test_large_image_is_sampled(self):
+        image = numpy.random.randint(1000, 3000, (1024, 1024),
+                                     dtype=numpy.uint16)
+        image[0, 1] = 5
+        self.addImage(image)
+        self.assertLess(self.stats.counts.sum(), image.size)
+        ## Exact min/max even for pixels that were not sampled.
+        self.assertEqual(self.stats.min, 5)
+        self.assertAlmostEqual(self.stats.getPercentile(50), 2000, delta=20)
+
+    def test_update(self):
+        self.addImage(numpy.full((4, 4), 10, dtype=numpy.uint16))
+        other = cockpit.experiment.dataSaver.IntensityStats()
+        image = numpy.full((4, 4), 30, dtype=numpy.uint16)
+        other.addImage(image, 30, 30)
+        self.stats.update(other)
+        self.stats.update(cockpit.experiment.dataSaver.IntensityStats())
+        self.assertEqual(self.stats.numImages, 2)
+        self.assertEqual((self.stats.min, self.stats.max), (10, 30))
+        self.assertEqual(self.stats.getPercentile(75), 30)
+
+
+class TestQueueBudget(unittest.TestCase):
+    def test_reserve_and_release(self):
+        budget = cockpit.experiment.dataSaver.QueueBudget(100)
+        self.assertTrue(budget.reserve(40))
+        self.assertTrue(budget.reserve(60))
+        self.assertEqual((budget.numBytes, budget.numImages), (100, 2))
+        self.assertFalse(budget.reserve(1))
+        budget.release(40)
+        self.assertTrue(budget.reserve(30))
+        budget.release(60)
+        budget.release(30)
+        self.assertEqual((budget.numBytes, budget.numImages), (0, 0))
+        self.assertEqual((budget.peakBytes, budget.peakImages), (100, 2))
+
+    def test_release_nothing(self):
+        ## Images that did not fit were not charged for.
+        budget = cockpit.experiment.dataSaver.QueueBudget(100)
+        budget.reserve(10)
+        budget.release(0)
+        self.assertEqual((budget.numBytes, budget.numImages), (10, 1))
+
+    def test_no_limit(self):
+        budget = cockpit.experiment.dataSaver.QueueBudget()
+        for i in range(3):
+            self.assertTrue(budget.reserve(2**40))
+        self.assertEqual(budget.peakImages, 3)
+
+    def test_always_admits_one_image(self):
+        budget = cockpit.experiment.dataSaver.QueueBudget(10)
+        self.assertTrue(budget.reserve(100))
+        self.assertFalse(budget.reserve(1))
+        budget.release(100)
+        self.assertTrue(budget.reserve(100))
+
+    def test_block_gives_up(self):
+        budget = cockpit.experiment.dataSaver.QueueBudget(10)
+        budget.reserve(10)
+        self.assertFalse(budget.reserve(10, shouldBlock=True,
+                                        shouldGiveUp=lambda: True))
+        self.assertEqual(budget.numImages, 1)
+
+    def test_block_until_released(self):
+        budget = cockpit.experiment.dataSaver.QueueBudget(10)
+        budget.reserve(10)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(budget.reserve(10, True)))
+        thread.start()
+        thread.join(.3)
+        self.assertTrue(thread.is_alive())
+        budget.release(10)
+        thread.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(budget.peakImages, 1)
+
+
+class TestSpillFile(unittest.TestCase):
+    def setUp(self):
+        self.spillFile = cockpit.experiment.dataSaver.SpillFile()
+
+    def tearDown(self):
+        self.spillFile.close()
+
+    def test_spill(self):
+        image = numpy.arange(12, dtype=numpy.uint16).reshape(3, 4)
+        spilled = self.spillFile.spill(image)
+        self.assertIsInstance(spilled, numpy.memmap)
+        numpy.testing.assert_array_equal(spilled, image)
+        self.assertEqual(self.spillFile.offset, image.nbytes)
+
+    def test_reuses_file_once_saved(self):
+        images = [numpy.full((3, 4), i, dtype=numpy.uint16) for i in range(3)]
+        first = self.spillFile.spill(images[0])
+        second = self.spillFile.spill(images[1])
+        self.assertEqual(self.spillFile.offset, 2 * images[0].nbytes)
+        self.spillFile.release()
+        ## One is still pending, so its space is not reused.
+        self.assertEqual(self.spillFile.offset, 2 * images[0].nbytes)
+        numpy.testing.assert_array_equal(second, images[1])
+        self.spillFile.release()
+        self.assertEqual((self.spillFile.numPending, self.spillFile.offset),
+                         (0, 0))
+        self.spillFile.spill(images[2])
+        self.assertEqual(self.spillFile.offset, images[0].nbytes)
+        self.assertEqual(self.spillFile.numSpilled, 3)
+        numpy.testing.assert_array_equal(first, images[2])
+
+
+class DataSaverTestCase(unittest.TestCase):
+    def setUp(self):
+        cockpit.depot.deviceDepot = cockpit.depot.DeviceDepot()
+        objective = unittest.mock.Mock(deviceType=cockpit.depot.OBJECTIVE)
+        objective.getPixelSize.return_value = 0.1
+        objective.getLensID.return_value = 0
+        cockpit.depot.deviceDepot.deviceTypeToHandlers = {
+            cockpit.depot.OBJECTIVE: [objective],
+        }
+        self.cameras = []
+        for name, size in (('big', (16, 8)), ('small', (8, 4))):
+            camera = unittest.mock.Mock(dye=None, wavelength=525)
+            camera.name = name
+            camera.getImageSize.return_value = size
+            self.cameras.append(camera)
+        self.dirname = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dirname.name, 'test.dv')
+        self.saver = self.makeSaver()
+
+    def makeSaver(self, numReps=1, **kwargs):
+        return cockpit.experiment.dataSaver.DataSaver(
+            self.cameras, numReps, {c: 3 for c in self.cameras},
+            {c: set() for c in self.cameras}, None, self.path, 0.1, [],
+            {c: 488 for c in self.cameras}, **kwargs)
+
+    def tearDown(self):
+        self.stopSaving()
+        self.saver.closeFiles()
+        self.dirname.cleanup()
+
+    ## Stop the save threads, once they have saved what is queued.
+    def stopSaving(self):
+        for imageQueue in self.saver.imageQueues:
+            imageQueue.put(None)
+        for thread in self.saver.saveThreads:
+            thread.join()
+
+    ## Return the planes of the file at path, in the order they are
+    # stored.
+    def readPlanes(self, path):
+        data = cockpit.util.Mrc.bindFile(path)
+        planes = numpy.array(data).reshape(-1, self.saver.maxHeight,
+                                           self.saver.maxWidth)
+        return planes, numpy.array(data.Mrc.extFloats)
+
+
+class TestDataSaverHeader(DataSaverTestCase):
+    def test_header_statistics(self):
+        for i in range(3):
+            self.saver.writeImage(0, numpy.full((8, 16), 100 * (i + 1),
+                                                dtype=numpy.uint16), i)
+            self.saver.writeImage(1, numpy.full((4, 8), 7 + i,
+                                                dtype=numpy.uint16), i)
+        self.saver.updateHeaders()
+        self.saver.closeFiles()
+        data = cockpit.util.Mrc.bindFile(self.path)
+        numpy.testing.assert_array_equal(data.Mrc.hdr.mmm1, [100, 300, 200])
+        numpy.testing.assert_array_equal(data.Mrc.hdr.mm2, [7, 9])
+
+
+
+class TestSaveThreads(DataSaverTestCase):
+    def test_interleaved_cameras_into_split_files(self):
+        self.saver.closeFiles()
+        ## Two repeats of 3 planes of 16x8 uint16 pixels per camera in
+        ## each file, so three repeats need two files.
+        with unittest.mock.patch.object(cockpit.experiment.dataSaver.DataSaver,
+                                        'maxFilesize',
+                                        2 * 3 * 2 * 16 * 8 * 2 / 2**20):
+            self.saver = self.makeSaver(numReps=3)
+        self.assertEqual(self.saver.filenames,
+                         [self.path + '.0', self.path + '.1'])
+        sizes = [(8, 16), (4, 8)]
+        for rep in range(3):
+            for z in range(3):
+                for cameraIndex, shape in enumerate(sizes):
+                    value = 100 * cameraIndex + 10 * rep + z
+                    self.saver.onImage(cameraIndex,
+                                       numpy.full(shape, value,
+                                                  dtype=numpy.uint16),
+                                       rep * 3 + z)
+        ## The sentinel is only reached once each queue is drained.
+        self.stopSaving()
+        self.assertTrue(all(q.empty() for q in self.saver.imageQueues))
+        self.assertEqual(self.saver.imagesKept, [9, 9])
+        self.saver.closeFiles()
+        filePlanes = [self.readPlanes(filename)
+                      for filename in self.saver.filenames]
+        self.assertEqual([len(planes) for planes, floats in filePlanes],
+                         [12, 6])
+        for rep in range(3):
+            planes, floats = filePlanes[rep // 2]
+            for z in range(3):
+                for cameraIndex, (height, width) in enumerate(sizes):
+                    planeIndex = (rep % 2) * 6 + z * 2 + cameraIndex
+                    plane = planes[planeIndex]
+                    value = 100 * cameraIndex + 10 * rep + z
+                    numpy.testing.assert_array_equal(
+                        plane[:height, :width], value)
+                    self.assertFalse(plane[height:].any())
+                    self.assertFalse(plane[:, width:].any())
+                    self.assertEqual(floats[planeIndex, 1], rep * 3 + z)
+
+
+class TestOverflowPolicies(DataSaverTestCase):
+    def setUp(self):
+        super().setUp()
+        self.images = [numpy.full((4, 8), i + 1, dtype=numpy.uint16)
+                       for i in range(3)]
+
+    def saveWithFullBudget(self, policy):
+        self.saver.closeFiles()
+        self.saver = self.makeSaver(queueBudget=self.images[0].nbytes,
+                                    overflowPolicy=policy)
+        ## An image is kept, then the next comes when the budget is used
+        ## up, then the last once it is free again.
+        self.saver.onImage(1, self.images[0], 10)
+        while self.saver.queueBudget.numImages:
+            time.sleep(.01)
+        self.assertTrue(
+            self.saver.queueBudget.reserve(self.images[0].nbytes))
+        self.saver.onImage(1, self.images[1], 11)
+        self.saver.queueBudget.release(self.images[0].nbytes)
+        self.saver.onImage(1, self.images[2], 12)
+        self.stopSaving()
+        self.saver.closeFiles()
+        planes, floats = self.readPlanes(self.path)
+        ## The small camera's images are in the odd planes.
+        return planes[1::2, :4, :8], floats[1::2]
+
+    def test_drop(self):
+        planes, floats = self.saveWithFullBudget(
+            cockpit.experiment.dataSaver.OVERFLOW_DROP)
+        self.assertEqual(self.saver.imagesDropped, [0, 1])
+        ## The dropped image leaves a blank plane, even though the
+        ## padded buffer held the previous image, and the next image is
+        ## in the plane after it.
+        numpy.testing.assert_array_equal(
+            planes, [self.images[0], numpy.zeros((4, 8)), self.images[2]])
+        numpy.testing.assert_array_equal(floats[:, 1], [0, 1, 2])
+        self.assertEqual(self.saver.imagesKept, [0, 3])
+
+    def test_spill(self):
+        planes, floats = self.saveWithFullBudget(
+            cockpit.experiment.dataSaver.OVERFLOW_SPILL)
+        self.assertEqual(self.saver.imagesDropped, [0, 0])
+        self.assertEqual(self.saver.spillFile.numSpilled, 1)
+        self.assertEqual(self.saver.spillFile.numPending, 0)
+        numpy.testing.assert_array_equal(planes, self.images)
+
+    def test_block(self):
+        self.saver.closeFiles()
+        self.saver = self.makeSaver(
+            queueBudget=self.images[0].nbytes,
+            overflowPolicy=cockpit.experiment.dataSaver.OVERFLOW_BLOCK)
+        self.saver.queueBudget.reserve(self.images[0].nbytes)
+        thread = threading.Thread(target=self.saver.onImage,
+                                  args=(1, self.images[1], 11))
+        thread.start()
+        thread.join(.3)
+        ## The image waits for the budget, rather than being dropped.
+        self.assertTrue(thread.is_alive())
+        self.saver.queueBudget.release(self.images[0].nbytes)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.stopSaving()
+        self.assertEqual(self.saver.imagesDropped, [0, 0])
+        self.assertEqual(self.saver.imagesKept, [0, 1])
+
+    def test_block_gives_up_on_abort(self):
+        self.saver.closeFiles()
+        self.saver = self.makeSaver(
+            queueBudget=self.images[0].nbytes,
+            overflowPolicy=cockpit.experiment.dataSaver.OVERFLOW_BLOCK)
+        self.saver.queueBudget.reserve(self.images[0].nbytes)
+        self.saver.shouldAbort = True
+        start = time.time()
+        self.saver.onImage(1, self.images[1], 11)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.saver.imagesDropped, [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.util.datadoc
+
+
+class TestDataDoc(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'test.dv')
+        ## Two wavelengths, with all pixels of a plane the same value.
+        planes = numpy.arange(2 * 3 * 4, dtype=numpy.uint16)
+        self.data = numpy.empty((2, 3, 4, 5, 6), dtype=numpy.uint16)
+        self.data[...] = planes.reshape(2, 3, 4, 1, 1)
+        header = cockpit.util.datadoc.makeHeaderFor(self.data)
+        ## Extended header with the plane's value in the first int and
+        ## float.
+        self.extended = numpy.zeros(
+            planes.size, cockpit.util.datadoc.makeExtendedHeaderDtype(2, 3))
+        self.extended['int'][:, 0] = planes
+        self.extended['float'][:, 0] = planes
+        header.next = self.extended.nbytes
+        header.NumIntegers = 2
+        header.NumFloats = 3
+        with open(self.path, 'wb') as handle:
+            cockpit.util.datadoc.writeMrcHeader(header, handle)
+            handle.write(self.extended)
+            handle.write(self.data)
+        self.doc = cockpit.util.datadoc.DataDoc(self.path)
+
+    def tearDown(self):
+        del self.doc
+        self.tempdir.cleanup()
+
+    def test_array_maps_file(self):
+        self.assertEqual(self.doc.imageArray.shape, (2, 3, 4, 5, 6))
+        self.assertFalse(self.doc.imageArray.flags.owndata)
+        self.assertTrue(numpy.shares_memory(self.doc.imageArray,
+                                            self.doc.image))
+
+    def test_averages(self):
+        expected = [self.doc.imageArray[w].mean() for w in range(2)]
+        with unittest.mock.patch.object(cockpit.util.datadoc,
+                                        'AVERAGE_SAMPLE_PLANES', 100):
+            numpy.testing.assert_allclose(self.doc.averages, expected)
+
+    def test_averages_are_sampled(self):
+        ## With one plane per wavelength, only the first is used.
+        expected = [self.doc.imageArray[w, 0, 0].mean() for w in range(2)]
+        with unittest.mock.patch.object(cockpit.util.datadoc,
+                                        'AVERAGE_SAMPLE_PLANES', 1):
+            numpy.testing.assert_allclose(self.doc.averages, expected)
+
+    def test_extended_header(self):
+        self.assertEqual(self.doc.extendedHeaderInts.shape, (2, 3, 4, 1, 2))
+        self.assertEqual(self.doc.extendedHeaderFloats.shape, (2, 3, 4, 1, 3))
+        ## Each plane's metadata is where its image data is.
+        numpy.testing.assert_array_equal(
+            self.doc.extendedHeaderInts[..., 0, 0],
+            self.doc.imageArray[..., 0, 0])
+        numpy.testing.assert_array_equal(
+            self.doc.extendedHeaderFloats[..., 0, 0],
+            self.doc.imageArray[..., 0, 0])
+        self.assertTrue(numpy.shares_memory(self.doc.extendedHeaderFloats,
+                                            self.doc.image.Mrc.m))
+
+    def test_write_extended_header(self):
+        header, headerBuffer, ints, floats = cockpit.util.datadoc.loadHeader(
+            self.path)
+        mapped = numpy.memmap(self.path, mode='r+')
+        extended = cockpit.util.datadoc.getExtendedHeaderArray(
+            mapped[1024:], header)
+        numpy.testing.assert_array_equal(extended, self.extended)
+        extended['float'][5, 2] = 1.5
+        mapped.flush()
+        del extended, mapped
+        with open(self.path, 'rb') as handle:
+            handle.seek(1024 + 5 * self.extended.itemsize + 4 * (2 + 2))
+            self.assertEqual(numpy.fromfile(handle, numpy.float32, 1), 1.5)
+
+    def test_no_extended_header(self):
+        header = cockpit.util.datadoc.makeHeaderFor(self.data)
+        extended = cockpit.util.datadoc.getExtendedHeaderArray(b'', header)
+        self.assertEqual(extended.shape, (24,))
+        ints, floats = cockpit.util.datadoc.getExtendedHeader(b'', header)
+        self.assertEqual(ints.size + floats.size, 0)
+
+    def alignAndCrop(self, **kwargs):
+        self.doc.alignParams[1] = (1.5, -1, 0, 10, 1.1)
+        self.doc.cropMin[1:] = (1, 1, 1, 2)
+        self.doc.cropMax[1:] = (3, 3, 5, 6)
+        return self.doc.alignAndCrop(**kwargs)
+
+    def test_align_and_crop(self):
+        result = self.alignAndCrop()
+        self.assertEqual(result.shape, (2, 2, 2, 4, 4))
+        self.assertEqual(result.dtype, numpy.float32)
+        crop = (slice(1, 3), slice(1, 5), slice(2, 6))
+        for timeIndex, timepoint in enumerate((1, 2)):
+            numpy.testing.assert_array_equal(
+                result[0, timeIndex], self.doc.imageArray[0, timepoint][crop])
+            expected = cockpit.util.datadoc.transformArray(
+                self.doc.imageArray[1, timepoint], 1.5, -1, 0, 10, 1.1)
+            numpy.testing.assert_allclose(result[1, timeIndex],
+                                          expected[crop], rtol=1e-6)
+
+    def test_align_and_crop_to_file(self):
+        expected = self.alignAndCrop()
+        savePath = os.path.join(self.tempdir.name, 'aligned.dv')
+        progress = []
+        self.alignAndCrop(savePath=savePath,
+                          progressCallback=lambda *args: progress.append(args))
+        self.assertEqual(progress, [(1, 4), (2, 4), (3, 4), (4, 4)])
+        saved = cockpit.util.datadoc.DataDoc(savePath)
+        numpy.testing.assert_array_equal(saved.imageArray, expected)
+
+    def test_align_and_crop_abort(self):
+        savePath = os.path.join(self.tempdir.name, 'aligned.dv')
+        abortEvent = threading.Event()
+        abortEvent.set()
+        self.assertIsNone(self.alignAndCrop(savePath=savePath,
+                                            abortEvent=abortEvent))
+        self.assertFalse(os.path.exists(savePath))
+
+    def test_raw_projection(self):
+        result = self.doc.takeProjectedSlice({1: 0, 2: 0}, 2, False)
+        numpy.testing.assert_array_equal(
+            result, self.doc.imageArray.max(axis=2)[:, 0])
+        self.assertIn(('raw', 1, 2), self.doc.projectionCache.keyToProjection)
+
+    @unittest.mock.patch('cockpit.util.datadoc.wx.ProgressDialog')
+    def test_aligned_projection(self, dialog):
+        self.doc.alignParams[0] = (1, 0, 0, 30, 1)
+        self.doc.alignParams[1] = (0, 1, 0, 0, 1.2)
+        result = self.doc.takeProjectedSlice({1: 0, 2: 0}, 4, False)
+        timepoint = self.doc.curViewIndex[1]
+        for wavelength in range(2):
+            volume = cockpit.util.datadoc.transformArray(
+                self.doc.imageArray[wavelength, timepoint],
+                *self.doc.alignParams[wavelength], order=1)
+            numpy.testing.assert_array_equal(
+                result[wavelength],
+                volume.astype(numpy.uint16).max(axis=2))
+        ## Changing one wavelength's alignment only loses its projections.
+        cache = self.doc.projectionCache.keyToProjection
+        self.assertEqual(len(cache), 2)
+        self.doc.setAlignParams(1, (0, 2, 0, 0, 1.2))
+        self.assertEqual([key[1] for key in cache], [0])
+
+    @unittest.mock.patch('cockpit.util.datadoc.wx.ProgressDialog')
+    def test_time_projection(self, dialog):
+        self.doc.alignParams[1] = (0, 1, 0, 10, 1)
+        result = self.doc.takeProjectedSlice({1: 0, 2: 3}, 1, False)
+        expected = []
+        for wavelength in range(2):
+            volumes = [cockpit.util.datadoc.transformArray(
+                self.doc.imageArray[wavelength, t],
+                *self.doc.alignParams[wavelength], order=1).astype(numpy.uint16)
+                       for t in range(3)]
+            expected.append(numpy.max(volumes, axis=0)[3])
+        numpy.testing.assert_array_equal(result, expected)
+
+
+class TestProjectionCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = cockpit.util.datadoc.ProjectionCache(budget=2 * 8)
+        projections = [numpy.zeros(1) for i in range(3)]
+        cache.put(('raw', 0, 2), projections[0])
+        cache.put(('raw', 1, 2), projections[1])
+        self.assertIs(cache.get(('raw', 0, 2)), projections[0])
+        cache.put(('raw', 2, 2), projections[2])
+        self.assertIsNone(cache.get(('raw', 1, 2)))
+        self.assertEqual(list(cache.keyToProjection),
+                         [('raw', 0, 2), ('raw', 2, 2)])
+        self.assertEqual(cache.numBytes, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+import cockpit.events
+
+
+EVENT = 'test events'
+
+
+class TestDelivery(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        for subscriber in cockpit.events.eventToSubscriberMap.get(EVENT, ()):
+            if isinstance(subscriber, cockpit.events.QueuedSubscriber):
+                subscriber.stop()
+        cockpit.events.eventToSubscriberMap.pop(EVENT, None)
+        cockpit.events.measureLatency(False)
+        cockpit.events.eventToDispatchStats.clear()
+
+    def onEvent(self, value):
+        self.received.append(value)
+        if value == 'last':
+            self.done.set()
+
+    def test_sync(self):
+        cockpit.events.subscribe(EVENT, self.onEvent)
+        cockpit.events.publish(EVENT, 1)
+        self.assertEqual(self.received, [1])
+        cockpit.events.unsubscribe(EVENT, self.onEvent)
+        cockpit.events.publish(EVENT, 2)
+        self.assertEqual(self.received, [1])
+
+    def test_unsubscribe_while_publishing(self):
+        ## Subscribers removed during a publish still see that event.
+        def unsubscriber(value):
+            cockpit.events.unsubscribe(EVENT, unsubscriber)
+            cockpit.events.unsubscribe(EVENT, self.onEvent)
+        cockpit.events.subscribe(EVENT, unsubscriber)
+        cockpit.events.subscribe(EVENT, self.onEvent)
+        cockpit.events.publish(EVENT, 1)
+        cockpit.events.publish(EVENT, 2)
+        self.assertEqual(self.received, [1])
+        self.assertEqual(cockpit.events.eventToSubscriberMap[EVENT], ())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            cockpit.events.subscribe(EVENT, self.onEvent, 'eventually')
+
+    def test_queued(self):
+        cockpit.events.subscribe(EVENT, self.onEvent,
+                                 cockpit.events.DELIVER_QUEUED)
+        for i in range(100):
+            cockpit.events.publish(EVENT, i)
+        cockpit.events.publish(EVENT, 'last')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.received, list(range(100)) + ['last'])
+
+    def test_latest(self):
+        isBlocked = threading.Event()
+        shouldContinue = threading.Event()
+        def onEvent(value):
+            if value == 'first':
+                isBlocked.set()
+                shouldContinue.wait(5)
+            self.onEvent(value)
+        cockpit.events.measureLatency()
+        cockpit.events.subscribe(EVENT, onEvent,
+                                 cockpit.events.DELIVER_LATEST)
+        cockpit.events.publish(EVENT, 'first')
+        self.assertTrue(isBlocked.wait(5))
+        # These arrive while the subscriber is busy, so all but the last
+        # are dropped.
+        for i in range(10):
+            cockpit.events.publish(EVENT, i)
+        cockpit.events.publish(EVENT, 'last')
+        shouldContinue.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.received, ['first', 'last'])
+        stats = cockpit.events.getDispatchStats(EVENT)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.numCoalesced, 10)
+        self.assertGreater(stats.maxWait, 0)
+
+    def test_unsubscribe_queued(self):
+        cockpit.events.subscribe(EVENT, self.onEvent,
+                                 cockpit.events.DELIVER_QUEUED)
+        subscriber, = cockpit.events.eventToSubscriberMap[EVENT]
+        cockpit.events.unsubscribe(EVENT, self.onEvent)
+        subscriber.thread.join(5)
+        self.assertFalse(subscriber.thread.is_alive())
+        self.assertEqual(cockpit.events.eventToSubscriberMap[EVENT], ())
+
+    def test_latency_stats(self):
+        cockpit.events.subscribe(EVENT, self.onEvent)
+        cockpit.events.publish(EVENT, 1)
+        self.assertIsNone(cockpit.events.getDispatchStats(EVENT))
+        cockpit.events.measureLatency()
+        cockpit.events.publish(EVENT, 2)
+        cockpit.events.publish(EVENT, 3)
+        stats = cockpit.events.getDispatchStats(EVENT)
+        self.assertEqual(stats.count, 2)
+        self.assertLess(stats.totalWait, stats.totalLatency)
+        self.assertGreaterEqual(stats.maxLatency, stats.getMeanLatency())
+
+
+if __name__ == '__main__':
+    unittest.main()
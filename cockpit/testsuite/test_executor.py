@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import decimal
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.devices.executorDevices
+import cockpit.experiment.actionTable
+import cockpit.handlers.executor
+
+
+class Client:
+    def __init__(self, name):
+        self.name = name
+
+
+class TestExecutorHandler(unittest.TestCase):
+    def setUp(self):
+        self.executeTable = unittest.mock.Mock()
+        self.executor = cockpit.handlers.executor.AnalogDigitalExecutorHandler(
+            'executor', 'executor group',
+            {'examineActions': lambda *args: None,
+             'executeTable': self.executeTable,
+             'readDigital': lambda: 0b1000,
+             'getAnalog': lambda line: 10 * line},
+            dlines=4, alines=2)
+        self.camera = Client('camera')
+        self.light = Client('light')
+        self.executor.registerDigital(self.camera, 0)
+        self.executor.registerDigital(self.light, 1)
+        self.stage = self.executor.registerAnalog(Client('stage'), 1,
+                                                  offset=1, gain=2)
+        self.stage.positions = [5, 7]
+        self.table = cockpit.experiment.actionTable.ActionTable()
+
+    def compile(self):
+        return self.executor.compileTable(self.table, 0, len(self.table))
+
+    def test_states(self):
+        self.table.addAction(0, self.light, True)
+        self.table.addAction(decimal.Decimal('1.5'), self.camera, True)
+        self.table.addAction(2, self.stage, 3)
+        self.table.addAction(3, self.camera, False)
+        self.table.addAction(3, self.light, False)
+        self.assertEqual(self.compile()[:],
+                         [(0.0, (0b1010, [0.0, 10.0])),
+                          (1.5, (0b1011, [0.0, 10.0])),
+                          (2.0, (0b1011, [0.0, 8.0])),
+                          (3.0, (0b1000, [0.0, 8.0]))])
+
+    def test_indexed_positions(self):
+        self.table.addAction(0, self.stage, (1, None))
+        self.table.addAction(1, self.stage, (0, None))
+        self.table.addAction(2, self.stage, (1, None))
+        profile = self.compile()
+        numpy.testing.assert_array_equal(profile.analogs[:, 1], [16, 12, 16])
+
+    def test_duplicate_actions(self):
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(1, self.camera, False)
+        self.assertEqual(len(self.compile()), 2)
+
+    def test_simultaneous_different_actions(self):
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(1, self.camera, False)
+        with self.assertRaisesRegex(Exception, 'Simultaneous actions'):
+            self.compile()
+
+    def test_deleted_rows(self):
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(1, self.light, True)
+        self.table.addAction(1, self.light, False)
+        self.table[2] = None
+        self.table[1] = None
+        self.assertEqual([state for t, (state, a) in self.compile()],
+                         [0b1001, 0b1001])
+
+    def test_section(self):
+        for i in range(4):
+            self.table.addAction(i, self.camera, i % 2 == 0)
+        profile = self.executor.compileTable(self.table, 1, 3)
+        self.assertEqual(profile[:], [(1.0, (0b1000, [0.0, 10.0])),
+                                      (2.0, (0b1001, [0.0, 10.0]))])
+
+    def test_executeTable(self):
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(1, self.camera, False)
+        self.executor.executeTable(self.table, 0, 2, 1, None)
+        profile, start, stop, numReps, repDuration = self.executeTable.call_args[0]
+        self.assertEqual((start, stop), (0, 2))
+        self.assertEqual(profile[-1], (1.0, (0b1000, [0.0, 10.0])))
+
+    def test_getNumRunnableLines(self):
+        other = Client('other')
+        self.table.addAction(0, self.camera, True)
+        self.table.addAction(1, self.stage, 1)
+        self.table.addAction(2, other, True)
+        self.table.addAction(3, self.camera, False)
+        self.assertEqual(self.executor.getNumRunnableLines(self.table, 0), 2)
+        self.assertEqual(self.executor.getNumRunnableLines(self.table, 3), 1)
+
+
+class TestExecutorProfile(unittest.TestCase):
+    def setUp(self):
+        self.profile = cockpit.handlers.executor.ExecutorProfile.fromActions(
+            [(0, (1, [0, 5])),
+             (0.01, (3, [1, 5])),
+             (0.2, (2, [1, 5])),
+             (0.5, (0, [2, 5]))])
+
+    def test_digital_events(self):
+        ticks, states = self.profile.getDigitalEvents(10)
+        numpy.testing.assert_array_equal(ticks, [0, 2, 5])
+        numpy.testing.assert_array_equal(states, [3, 2, 0])
+
+    def test_analog_events(self):
+        ticks, levels = self.profile.getAnalogEvents(10, 0)
+        numpy.testing.assert_array_equal(ticks, [0, 0, 5])
+        numpy.testing.assert_array_equal(levels, [0, 1, 2])
+        ticks, levels = self.profile.getAnalogEvents(10, 1)
+        numpy.testing.assert_array_equal(ticks, [0])
+
+    def test_actions_from_table(self):
+        actions = cockpit.devices.executorDevices.actions_from_table(
+            self.profile, 1, 3, 1)
+        self.assertEqual(actions, [(0.0, (3, [1.0, 5.0])),
+                                   (0.19, (2, [1.0, 5.0])),
+                                   (1.01, (2, [1.0, 5.0]))])
+
+
+if __name__ == '__main__':
+    unittest.main()
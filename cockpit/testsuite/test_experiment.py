@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import unittest.mock
+
+import cockpit.experiment.actionTable
+import cockpit.experiment.experiment
+import cockpit.experiment.mosaicSpiral
+
+
+class _Positioner:
+    name = 'z'
+
+    def getIsEligibleForExperiments(self):
+        return True
+
+    def getMovementTime(self, start, end):
+        return (1, 0)
+
+
+class _SlowPositioner(_Positioner):
+    name = 'y'
+
+    def getMovementTime(self, start, end):
+        return (abs(end - start), 2)
+
+
+class _ZExperiment(cockpit.experiment.experiment.Experiment):
+    canCacheActions = True
+    ## Z positions of the tables generated, in order.
+    generated = []
+
+    def generateActions(self):
+        self.generated.append(self.zStart)
+        table = cockpit.experiment.actionTable.ActionTable()
+        for i in range(3):
+            table.addAction(i, self.zPositioner,
+                            self.zStart + i * self.sliceHeight)
+        return table
+
+
+class TestActionTableCache(unittest.TestCase):
+    def setUp(self):
+        cockpit.experiment.experiment.clearActionTableCache()
+        _ZExperiment.generated = []
+        self.zPositioner = _Positioner()
+
+    def createTable(self, zStart, sliceHeight=1):
+        experiment = _ZExperiment(1, 0, self.zPositioner, 0, 2, sliceHeight,
+                                  [], [], [])
+        experiment.zStart = zStart
+        with unittest.mock.patch.object(_ZExperiment,
+                                        'examineActions') as examine:
+            experiment.createValidActionTable()
+        examine.assert_called_once_with()
+        return experiment.table
+
+    def test_replay_at_other_position(self):
+        self.createTable(0)
+        table = self.createTable(10)
+        self.assertEqual(_ZExperiment.generated, [0])
+        self.assertEqual([action[2] for action in table], [10, 11, 12])
+
+    def test_replay_does_not_change_cache(self):
+        self.createTable(0)
+        self.createTable(10)
+        table = self.createTable(0)
+        self.assertEqual([action[2] for action in table], [0, 1, 2])
+
+    def test_different_parameters(self):
+        self.createTable(0)
+        table = self.createTable(0, sliceHeight=2)
+        self.assertEqual(_ZExperiment.generated, [0, 0])
+        self.assertEqual([action[2] for action in table], [0, 2, 4])
+
+    def test_not_cached(self):
+        with unittest.mock.patch.object(_ZExperiment, 'canCacheActions',
+                                        False):
+            self.createTable(0)
+            self.createTable(0)
+        self.assertEqual(_ZExperiment.generated, [0, 0])
+        self.assertEqual(len(cockpit.experiment.experiment.actionTableCache), 0)
+
+
+class TestMosaicSpiral(unittest.TestCase):
+    def test_moves(self):
+        xPositioner = _Positioner()
+        xPositioner.name = 'x'
+        yPositioner = _SlowPositioner()
+        experiment = cockpit.experiment.mosaicSpiral.MosaicSpiralExperiment(
+            xPositioner, yPositioner, (0, -3), [(0, 0), (5, 0), (5, 5)],
+            1, 0, None, 0, 0, 0, [], [], [])
+        self.assertIn(xPositioner, experiment.allHandlers)
+        table = experiment.generateActions()
+        table.sort()
+        moves = [(action[0], action[1].name, action[2]) for action in table]
+        # Every move, including the first one from the start position,
+        # takes 1 for X and as long as its distance for Y, and the stage
+        # settles for 2 after each move.
+        self.assertEqual(moves[:4], [(3, 'x', 0), (3, 'y', 0),
+                                     (5, 'x', 0), (5, 'y', 0)])
+        self.assertEqual(moves[4:8], [(6, 'x', 5), (6, 'y', 0),
+                                      (8, 'x', 5), (8, 'y', 0)])
+        self.assertEqual(moves[8:], [(13, 'x', 5), (13, 'y', 5),
+                                     (15, 'x', 5), (15, 'y', 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
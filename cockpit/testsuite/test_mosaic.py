@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import os.path
+import tempfile
+import types
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.gui.mosaic.beads
+import cockpit.gui.mosaic.canvas
+import cockpit.gui.mosaic.mosaicFile
+import cockpit.gui.mosaic.tile
+import cockpit.gui.mosaic.tileStore
+import cockpit.util.datadoc
+
+
+class BoxTile:
+    intersectsBox = cockpit.gui.mosaic.tile.Tile.intersectsBox
+
+    def __init__(self, pos, size):
+        self.box = (pos, (pos[0] + size[0], pos[1] + size[1]))
+
+
+class TestTileGrid(unittest.TestCase):
+    def setUp(self):
+        self.grid = cockpit.gui.mosaic.tile.TileGrid()
+        self.tiles = [BoxTile((x, y), (10, 10))
+                      for x in range(-50, 50, 8) for y in range(-50, 50, 8)]
+        for tile in self.tiles:
+            self.grid.add(tile)
+
+    def assertMatchesScan(self, box):
+        expected = [tile for tile in self.tiles if tile.intersectsBox(box)]
+        self.assertEqual(self.grid.getIntersecting(box), expected)
+
+    def test_cell_size(self):
+        self.assertEqual(self.grid.cellSize, 10)
+
+    def test_intersecting(self):
+        for box in [((0, 0), (1, 1)),
+                    ((-13, 7), (22, 9)),
+                    ((-1000, -1000), (1000, 1000)),
+                    ((100, 100), (200, 200))]:
+            self.assertMatchesScan(box)
+
+    def test_touching(self):
+        ## Tiles that only touch the box are included.
+        self.assertMatchesScan(((-40, -40), (-40, -40)))
+        self.assertEqual(len(self.grid.getIntersecting(((-40, -40),
+                                                        (-40, -40)))), 4)
+
+    def test_reversed_box(self):
+        self.assertEqual(self.grid.getIntersecting(((22, 9), (-13, 7))),
+                         self.grid.getIntersecting(((-13, 7), (22, 9))))
+
+    def test_insertion_order(self):
+        ## Later tiles are drawn over earlier ones, so order matters.
+        tile = BoxTile((0, 0), (100, 100))
+        self.grid.add(tile)
+        self.tiles.append(tile)
+        self.assertEqual(self.grid.getIntersecting(((1, 1), (2, 2)))[-1],
+                         tile)
+        self.assertMatchesScan(((1, 1), (30, 30)))
+
+    def test_remove(self):
+        removed = self.tiles[::3]
+        for tile in removed:
+            self.grid.remove(tile)
+        self.tiles = [tile for tile in self.tiles if tile not in removed]
+        self.assertEqual(len(self.grid), len(self.tiles))
+        self.assertNotIn(removed[0], self.grid)
+        self.assertMatchesScan(((-1000, -1000), (1000, 1000)))
+        self.assertMatchesScan(((-13, 7), (22, 9)))
+
+
+class TestTileStore(unittest.TestCase):
+    def setUp(self):
+        self.store = cockpit.gui.mosaic.tileStore.TileStore(segmentSize=1024)
+
+    def tearDown(self):
+        self.store.clear()
+
+    def test_copies(self):
+        data = numpy.arange(100, dtype=numpy.uint16).reshape(10, 10)
+        stored = self.store.add(data)
+        data[:] = 0
+        numpy.testing.assert_array_equal(
+            stored, numpy.arange(100).reshape(10, 10))
+        self.assertEqual(stored.dtype, numpy.uint16)
+        self.assertFalse(stored.flags.writeable)
+
+    def test_non_contiguous(self):
+        data = numpy.arange(100, dtype='>u2').reshape(10, 10)[::2, 1:4]
+        stored = self.store.add(data)
+        numpy.testing.assert_array_equal(stored, data)
+        self.assertEqual(stored.dtype, data.dtype)
+
+    def test_segments(self):
+        tiles = [numpy.full((10, 10), i, dtype=numpy.uint16)
+                 for i in range(20)]
+        stored = [self.store.add(data) for data in tiles]
+        stored.append(self.store.add(numpy.ones((40, 40), numpy.float32)))
+        # Four 200 byte tiles, aligned to 256 bytes, fit in each segment,
+        # and the last tile needs a larger one of its own.
+        self.assertEqual(len(self.store.segments), 6)
+        for data, copy in zip(tiles, stored):
+            numpy.testing.assert_array_equal(data, copy)
+        self.assertEqual(stored[-1].sum(), 1600)
+
+    def test_clear(self):
+        stored = self.store.add(numpy.ones((10, 10)))
+        self.store.clear()
+        self.assertEqual(self.store.numBytes, 0)
+        self.assertEqual(stored.sum(), 100)
+
+
+class FakeTile:
+    bytesPerPixel = cockpit.gui.mosaic.tile.Tile.bytesPerPixel
+
+    def __init__(self, shape, dtype=numpy.float32):
+        self.textureData = numpy.zeros(shape, dtype=dtype)
+        self.isWiped = False
+
+    def wipe(self):
+        self.isWiped = True
+
+
+class TestTextureCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        # Room for two 16x16 textures.
+        cache = cockpit.gui.mosaic.tile.TextureCache(2 * 16 * 16 * 4)
+        tiles = [FakeTile((16, 16)) for i in range(3)]
+        cache.touch(tiles[0])
+        cache.touch(tiles[1])
+        cache.touch(tiles[0])
+        cache.touch(tiles[2])
+        self.assertEqual([tile.isWiped for tile in tiles],
+                         [False, True, False])
+        self.assertEqual(list(cache.tileToBytes), [tiles[0], tiles[2]])
+
+    def test_texture_size(self):
+        cache = cockpit.gui.mosaic.tile.TextureCache()
+        cache.touch(FakeTile((10, 20)))
+        self.assertEqual(cache.numBytes, 16 * 32 * 4)
+
+    def test_texture_bytes_per_pixel(self):
+        ## Integer data is held as it is, and anything else as floats.
+        for dtype, bytesPerPixel in [(numpy.uint8, 1), (numpy.uint16, 2),
+                                     (numpy.float32, 4), (numpy.float64, 4),
+                                     (numpy.int32, 4)]:
+            cache = cockpit.gui.mosaic.tile.TextureCache()
+            cache.touch(FakeTile((16, 16), dtype))
+            self.assertEqual(cache.numBytes, 16 * 16 * bytesPerPixel)
+
+    def test_keeps_latest(self):
+        cache = cockpit.gui.mosaic.tile.TextureCache(0)
+        tile = FakeTile((16, 16))
+        cache.touch(tile)
+        self.assertFalse(tile.isWiped)
+        cache.discard(tile)
+        self.assertEqual(cache.numBytes, 0)
+
+
+class StubMegaTile:
+    intersectsBox = cockpit.gui.mosaic.tile.Tile.intersectsBox
+
+    def __init__(self, pos, level):
+        self.level = level
+        self.micronSize = 100 * 2 ** level
+        self.box = (pos, (pos[0] + self.micronSize, pos[1] + self.micronSize))
+        self.numTiles = 0
+        self.haveAllocatedMemory = False
+        self.sources = None
+
+    def prerenderTiles(self, tiles, viewer):
+        self.sources = list(tiles)
+        self.haveAllocatedMemory = bool(tiles)
+
+    def wipe(self):
+        self.haveAllocatedMemory = False
+
+
+class StubCanvas:
+    MosaicCanvas = cockpit.gui.mosaic.canvas.MosaicCanvas
+    getPyramidLevel = MosaicCanvas.getPyramidLevel
+    buildMegaTile = MosaicCanvas.buildMegaTile
+    discardMegaTile = MosaicCanvas.discardMegaTile
+    discardOldMegaTiles = MosaicCanvas.discardOldMegaTiles
+    getChildMegaTiles = MosaicCanvas.getChildMegaTiles
+    iterUnbuiltMegaTiles = MosaicCanvas.iterUnbuiltMegaTiles
+
+    ## Make a pyramid of 100 micron megatiles covering 400x400 microns.
+    def __init__(self, tiles, makeMegaTile=StubMegaTile):
+        self.scale = 1.0
+        self.megaTileBudget = 2**30
+        self.allocatedMegaTiles = collections.OrderedDict()
+        self.megaTiles = []
+        self.pyramid = []
+        for level in range(3):
+            step = 100 * 2 ** level
+            grid = cockpit.gui.mosaic.tile.TileGrid(step)
+            for x in range(0, 400, step):
+                for y in range(0, 400, step):
+                    megaTile = makeMegaTile((x, y), level)
+                    megaTile.numTiles = len([tile for tile in tiles
+                                             if tile.intersectsBox(megaTile.box)])
+                    self.megaTiles.append(megaTile)
+                    grid.add(megaTile)
+            self.pyramid.append(grid)
+        self.tileGrid = cockpit.gui.mosaic.tile.TileGrid()
+        for tile in tiles:
+            self.tileGrid.add(tile)
+
+
+class TestMegaTilePyramid(unittest.TestCase):
+    def setUp(self):
+        # One texture pixel per micron at level 0.
+        patcher = unittest.mock.patch.multiple(
+            cockpit.gui.mosaic.tile.MegaTile, pixelSize=100, micronSize=100)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tiles = [BoxTile((10, 10), (50, 50)),
+                      BoxTile((150, 120), (20, 20)),
+                      BoxTile((310, 310), (20, 20))]
+        self.canvas = StubCanvas(self.tiles)
+
+    def getMegaTile(self, level, pos):
+        box = ((pos[0] + 1, pos[1] + 1), (pos[0] + 2, pos[1] + 2))
+        return self.canvas.pyramid[level].getIntersecting(box)[0]
+
+    def test_pyramid_level(self):
+        for scale, level in [(4, 0), (1, 0), (0.6, 0), (0.5, 1), (0.3, 1),
+                             (0.25, 2), (0.01, 2)]:
+            self.canvas.scale = scale
+            self.assertEqual(self.canvas.getPyramidLevel(), level)
+
+    def test_build_from_tiles(self):
+        megaTile = self.getMegaTile(0, (100, 100))
+        self.canvas.buildMegaTile(megaTile)
+        self.assertEqual(megaTile.sources, [self.tiles[1]])
+        self.assertIn(megaTile, self.canvas.allocatedMegaTiles)
+
+    def test_build_from_children(self):
+        children = [self.getMegaTile(0, (0, 0)),
+                    self.getMegaTile(0, (100, 100))]
+        for child in children:
+            self.canvas.buildMegaTile(child)
+        megaTile = self.getMegaTile(1, (0, 0))
+        self.canvas.buildMegaTile(megaTile)
+        # Empty children, and neighbours that only touch the megatile,
+        # are not needed.
+        self.assertEqual(megaTile.sources, children)
+
+    def test_build_missing_children(self):
+        self.canvas.buildMegaTile(self.getMegaTile(0, (0, 0)))
+        megaTile = self.getMegaTile(1, (0, 0))
+        self.canvas.buildMegaTile(megaTile)
+        child = self.getMegaTile(0, (100, 100))
+        self.assertEqual(megaTile.sources,
+                         [self.getMegaTile(0, (0, 0)), child])
+        self.assertEqual(child.sources, [self.tiles[1]])
+        self.assertIn(child, self.canvas.allocatedMegaTiles)
+
+    def test_unbuilt_megatiles_after_their_children(self):
+        self.canvas.buildMegaTile(self.getMegaTile(0, (0, 0)))
+        order = list(self.canvas.iterUnbuiltMegaTiles())
+        self.assertEqual(order, [self.getMegaTile(0, (100, 100)),
+                                 self.getMegaTile(1, (0, 0)),
+                                 self.getMegaTile(0, (300, 300)),
+                                 self.getMegaTile(1, (200, 200)),
+                                 self.getMegaTile(2, (0, 0))])
+
+    def test_empty_megatile_is_not_allocated(self):
+        megaTile = self.getMegaTile(0, (200, 0))
+        self.canvas.buildMegaTile(megaTile)
+        self.assertNotIn(megaTile, self.canvas.allocatedMegaTiles)
+
+    def allocate(self, megaTiles):
+        for megaTile in megaTiles:
+            megaTile.haveAllocatedMemory = True
+            self.canvas.allocatedMegaTiles[megaTile] = True
+
+    def test_discard_least_recently_displayed(self):
+        MegaTile = cockpit.gui.mosaic.tile.MegaTile
+        self.canvas.megaTileBudget = 2 * 100 ** 2 * MegaTile.bytesPerPixel
+        megaTiles = list(self.canvas.pyramid[0].getIntersecting(
+            ((0, 0), (399, 99))))
+        self.allocate(megaTiles)
+        self.canvas.discardOldMegaTiles([megaTiles[0]])
+        self.assertEqual(list(self.canvas.allocatedMegaTiles),
+                         [megaTiles[0], megaTiles[3]])
+        self.assertEqual([megaTile.haveAllocatedMemory
+                          for megaTile in megaTiles],
+                         [True, False, False, True])
+
+    def test_discard_keeps_displayed_over_budget(self):
+        self.canvas.megaTileBudget = 0
+        megaTiles = list(self.canvas.pyramid[0].getIntersecting(
+            ((0, 0), (399, 99))))
+        self.allocate(megaTiles)
+        self.canvas.discardOldMegaTiles(megaTiles[1:])
+        self.assertEqual(list(self.canvas.allocatedMegaTiles), megaTiles[1:])
+
+
+class TestMegaTileRendering(unittest.TestCase):
+    ## Render real tiles and megatiles, with the OpenGL functions stubbed.
+    def setUp(self):
+        tileModule = cockpit.gui.mosaic.tile
+        MegaTile = tileModule.MegaTile
+        self.originalPrerenderTiles = MegaTile.prerenderTiles
+        glFunctions = {name: unittest.mock.MagicMock()
+                       for name in dir(tileModule) if name.startswith('gl')}
+        patchers = [
+            unittest.mock.patch.multiple(
+                tileModule, tileShader=None, megaTileFramebuffer=None,
+                textureCache=tileModule.TextureCache(), **glFunctions),
+            unittest.mock.patch.multiple(
+                MegaTile, pixelSize=16, micronSize=100,
+                _emptyTileData=numpy.zeros((16, 16), numpy.float32)),
+            unittest.mock.patch.object(MegaTile, 'prerenderTiles',
+                                       autospec=True,
+                                       side_effect=self.prerenderTiles),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        ## A tile every 25 microns over the whole pyramid.
+        self.tiles = [tileModule.Tile(numpy.zeros((8, 8), numpy.uint16),
+                                      (x, y, 0), (25, 25), (0, 1), 0)
+                      for x in range(0, 400, 25) for y in range(0, 400, 25)]
+        self.canvas = StubCanvas(self.tiles, MegaTile)
+        ## (megatile, sources, number of megatiles with textures) of each
+        # megatile rendered.
+        self.rendered = []
+
+    def prerenderTiles(self, megaTile, tiles, viewer):
+        self.rendered.append((megaTile, list(tiles),
+                              len(self.canvas.allocatedMegaTiles)))
+        self.originalPrerenderTiles(megaTile, tiles, viewer)
+
+    def test_top_level_renders_only_children(self):
+        top = self.canvas.pyramid[2].getIntersecting(((1, 1), (2, 2)))[0]
+        self.canvas.buildMegaTile(top)
+        self.assertIn(top, self.canvas.allocatedMegaTiles)
+        self.assertEqual(len(self.rendered), 16 + 4 + 1)
+        for megaTile, sources, numAllocated in self.rendered:
+            if megaTile.level:
+                self.assertLessEqual(len(sources), 4)
+                for source in sources:
+                    self.assertIsInstance(source,
+                                          cockpit.gui.mosaic.tile.MegaTile)
+                    self.assertEqual(source.level, megaTile.level - 1)
+        self.assertEqual(len(self.rendered[-1][1]), 4)
+
+    def test_build_within_budget(self):
+        ## Room for two textures, which is less than a build needs.
+        MegaTile = cockpit.gui.mosaic.tile.MegaTile
+        self.canvas.megaTileBudget = 2 * 16 ** 2 * MegaTile.bytesPerPixel
+        top = self.canvas.pyramid[2].getIntersecting(((1, 1), (2, 2)))[0]
+        self.canvas.buildMegaTile(top)
+        self.assertEqual(len(self.rendered), 16 + 4 + 1)
+        ## No more than the four children of a megatile and of each of
+        # its ancestors have textures at once.
+        self.assertLessEqual(max(numAllocated for megaTile, sources,
+                                 numAllocated in self.rendered), 8)
+
+
+class ScaledTile:
+    def __init__(self, histogramScale):
+        self.histogramScale = histogramScale
+
+
+class TestSpanHistograms(unittest.TestCase):
+    def test_span(self):
+        tiles = [ScaledTile((10, 100)), ScaledTile((-5, 50)),
+                 ScaledTile((20, 200))]
+        self.assertEqual(cockpit.gui.mosaic.tile.spanHistograms(tiles),
+                         (-5, 200))
+
+
+class TestBeads(unittest.TestCase):
+    def setUp(self):
+        ## A composite of three 200x200 tiles on each side.
+        self.data = numpy.random.RandomState(0).normal(
+            100, 1, (600, 600)).astype(numpy.float32)
+
+    def addBead(self, x, y, radius=4):
+        yy, xx = numpy.mgrid[:600, :600]
+        self.data[(xx - x) ** 2 + (yy - y) ** 2 <= radius ** 2] = 1000
+
+    def findBeads(self):
+        return cockpit.gui.mosaic.beads.findBeadsInComposite(self.data, 100)
+
+    def test_isolated_bead(self):
+        self.addBead(300, 250)
+        beads = self.findBeads()
+        self.assertEqual(len(beads), 1)
+        x, y, size, intensity = beads[0]
+        self.assertAlmostEqual(x, 100)
+        self.assertAlmostEqual(y, 50)
+        self.assertEqual(size, 49)
+        self.assertEqual(intensity, 1000)
+
+    def test_outside_central_tile(self):
+        self.addBead(100, 300)
+        self.assertEqual(len(self.findBeads()), 0)
+
+    def test_crowded(self):
+        ## Beads with others nearby are not isolated.
+        self.addBead(300, 300)
+        self.addBead(318, 300)
+        self.addBead(250, 380)
+        beads = self.findBeads()
+        self.assertEqual(len(beads), 1)
+        self.assertAlmostEqual(beads[0][1], 180)
+
+    def test_not_round(self):
+        self.data[300:302, 280:320] = 1000
+        self.assertEqual(len(self.findBeads()), 0)
+
+    def test_no_signal(self):
+        self.assertEqual(self.findBeads().shape, (0, 4))
+
+    def test_remove_crowded_sites(self):
+        positions = [(0, 0, 0), (30, 0, 0), (50, 0, 0), (100, 0, 0),
+                     (0, 10, 0)]
+        keep = cockpit.gui.mosaic.beads.removeCrowdedSites(positions, 40)
+        self.assertEqual(list(keep), [0, 2, 3])
+        self.assertEqual(
+            len(cockpit.gui.mosaic.beads.removeCrowdedSites([], 40)), 0)
+
+    def test_filter_sites(self):
+        sizes = [50, 52, 48, 51, 49, 50, 300, 5]
+        intensities = [1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000]
+        isGood = cockpit.gui.mosaic.beads.filterSites(sizes, intensities)
+        self.assertEqual(list(isGood), [True] * 6 + [False, False])
+
+    def test_focus_score_ignores_hot_pixels(self):
+        inFocus = numpy.full((20, 20), 100)
+        inFocus[9:12, 9:12] = 500
+        outOfFocus = numpy.full((20, 20), 100)
+        outOfFocus[8:13, 8:13] = 300
+        outOfFocus[2, 2] = 4000
+        self.assertGreater(
+            cockpit.gui.mosaic.beads.getFocusScore(inFocus),
+            cockpit.gui.mosaic.beads.getFocusScore(outOfFocus))
+
+
+class TestMosaicFile(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'test.mosaic')
+        self.tiles = [numpy.arange(i, i + 48, dtype=numpy.uint16).reshape(6, 8)
+                      for i in range(3)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self):
+        writer = cockpit.gui.mosaic.mosaicFile.MosaicWriter(self.path)
+        for i, data in enumerate(self.tiles):
+            writer.addTile(data, (i, -i, 0.5), (8, 6), (0, 100), i % 2)
+        writer.close()
+
+    def test_round_trip(self):
+        self.write()
+        records = cockpit.gui.mosaic.mosaicFile.readMosaic(self.path)
+        self.assertEqual(len(records), 3)
+        for i, (record, data) in enumerate(zip(records, self.tiles)):
+            numpy.testing.assert_array_equal(record.data, data)
+            self.assertEqual(record.data.dtype, data.dtype)
+            self.assertEqual(record.pos, (i, -i, 0.5))
+            self.assertEqual(record.size, (8, 6))
+            self.assertEqual(record.histogramScale, (0, 100))
+            self.assertEqual(record.layer, i % 2)
+
+    def test_truncated(self):
+        self.write()
+        with open(self.path + cockpit.gui.mosaic.mosaicFile.DATA_SUFFIX,
+                  'r+b') as handle:
+            handle.truncate(230)
+        with open(self.path, 'a') as handle:
+            handle.write('{"offset": ')
+        records = cockpit.gui.mosaic.mosaicFile.readMosaic(self.path)
+        self.assertEqual(len(records), 2)
+
+    def test_not_a_mosaic(self):
+        with open(self.path, 'w') as handle:
+            handle.write('{}\n')
+        with self.assertRaises(ValueError):
+            cockpit.gui.mosaic.mosaicFile.readMosaic(self.path)
+
+    def test_version_1(self):
+        ## No name of the data file in the header.
+        self.write()
+        with open(self.path, 'r') as handle:
+            lines = handle.readlines()
+        lines[0] = '{"format": "cockpit-mosaic", "version": 1}\n'
+        with open(self.path, 'w') as handle:
+            handle.writelines(lines)
+        records = cockpit.gui.mosaic.mosaicFile.readMosaic(self.path)
+        numpy.testing.assert_array_equal(records[2].data, self.tiles[2])
+
+    def makeTiles(self, records):
+        return [types.SimpleNamespace(textureData=record.data, pos=record.pos,
+                                      size=record.size,
+                                      histogramScale=record.histogramScale,
+                                      layer=record.layer)
+                for record in records]
+
+    def test_save_over_loaded_mosaic(self):
+        self.write()
+        oldDataPath = self.path + cockpit.gui.mosaic.mosaicFile.DATA_SUFFIX
+        tiles = self.makeTiles(
+            cockpit.gui.mosaic.mosaicFile.readMosaic(self.path))
+        tiles[0].layer = 5
+        replace = os.replace
+        replaced = []
+        def recordReplace(src, dst):
+            replaced.append(dst)
+            replace(src, dst)
+        with unittest.mock.patch('os.replace', recordReplace):
+            cockpit.gui.mosaic.mosaicFile.saveMosaic(self.path, tiles)
+        ## Only the index, which is not mapped, is replaced.
+        self.assertEqual(replaced, [self.path])
+        self.assertFalse(os.path.exists(oldDataPath))
+        self.assertFalse(os.path.exists(self.path + '.partial'))
+        records = cockpit.gui.mosaic.mosaicFile.readMosaic(self.path)
+        self.assertEqual([record.layer for record in records], [5, 1, 0])
+        for tile, record, data in zip(tiles, records, self.tiles):
+            numpy.testing.assert_array_equal(record.data, data)
+            numpy.testing.assert_array_equal(tile.textureData, data)
+        ## Saving again goes back to the default data file.
+        cockpit.gui.mosaic.mosaicFile.saveMosaic(self.path, tiles)
+        self.assertEqual(
+            cockpit.gui.mosaic.mosaicFile.getDataPath(self.path), oldDataPath)
+        self.assertEqual(sorted(os.listdir(self.tempdir.name)),
+                         ['test.mosaic', 'test.mosaic.tiles'])
+
+    def test_save_failure(self):
+        tiles = self.makeTiles(
+            [cockpit.gui.mosaic.mosaicFile.TileRecord(
+                data, (0, 0, 0), (8, 6), (0, 100), 0)
+             for data in self.tiles])
+        tiles[1].layer = 'not a layer'
+        with self.assertRaises(ValueError):
+            cockpit.gui.mosaic.mosaicFile.saveMosaic(self.path, tiles)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_legacy(self):
+        ## The .txt and .mrc pair saved by older versions.
+        txtPath = os.path.join(self.tempdir.name, 'test.txt')
+        mrcPath = os.path.join(self.tempdir.name, 'test.mrc')
+        imageData = numpy.zeros((1, 1, 2, 8, 8), dtype=numpy.uint16)
+        imageData[0, 0, 0, :6, :8] = self.tiles[0]
+        imageData[0, 0, 1, :6, :8] = self.tiles[1]
+        header = cockpit.util.datadoc.makeHeaderFor(imageData)
+        with open(mrcPath, 'wb') as handle:
+            cockpit.util.datadoc.writeMrcHeader(header, handle)
+            handle.write(imageData)
+        with open(txtPath, 'w') as handle:
+            handle.write(mrcPath + '\n')
+            handle.write('1,2,3,8,6,6,8,0,100,0\n')
+            handle.write('4,5,6,8,6,6,8,10,20,1\n')
+        records = cockpit.gui.mosaic.mosaicFile.readLegacyMosaic(txtPath)
+        self.assertEqual(len(records), 2)
+        numpy.testing.assert_array_equal(records[1].data, self.tiles[1])
+        self.assertEqual(records[1].pos, (4, 5, 6))
+        self.assertEqual(records[1].histogramScale, (10, 20))
+        self.assertEqual(records[1].layer, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+import threading
+import unittest
+
+import numpy
+
+import cockpit.devices.ni_cRIOFPGA
+
+
+class LoopbackRTHost(threading.Thread):
+    """Stand-in for the RT-ipAddress command server, on the loopback interface.
+
+    It accepts a single connection, and records each command it receives as
+    a (command, message cluster, values) tuple in self.commands, where values
+    is the list of decoded messages: integers for tables and numbers, either
+    from decimal strings or from packed binary tables.  Every command is
+    acknowledged with no error.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+        self.commands = []
+
+    def _receive(self, connection, numBytes):
+        data = b''
+        while len(data) < numBytes:
+            chunk = connection.recv(numBytes - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _receiveLine(self, connection):
+        data = b''
+        while not data.endswith(b'\r\n'):
+            chunk = connection.recv(1)
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data[:-2]
+
+    def run(self):
+        connection, address = self.socket.accept()
+        with connection:
+            while True:
+                try:
+                    cluster = json.loads(self._receiveLine(connection))
+                    numBytes = (cluster['Message Length']
+                                * cluster['Number of Messages'])
+                    data = self._receive(connection, numBytes)
+                except EOFError:
+                    break
+                if cluster.get('Encoding') == 'binary':
+                    pairs = numpy.frombuffer(data, dtype='>u4').reshape(-1, 2)
+                    values = cockpit.devices.ni_cRIOFPGA.joinTable(pairs).tolist()
+                else:
+                    length = cluster['Message Length']
+                    values = [int(data[i:i + length])
+                              for i in range(0, len(data), length)]
+                self.commands.append((cluster['Command'], cluster, values))
+                connection.sendall(json.dumps({'status': False}).encode())
+        self.socket.close()
+
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        self.server = LoopbackRTHost()
+        self.server.start()
+        self.digitals = numpy.array([[1, 5], [10, 0], [2**32 - 1, 2**31]],
+                                    dtype=numpy.uint32)
+        self.analogues = [numpy.array([[1, 100]], dtype=numpy.uint32),
+                          numpy.array([[1, 0], [20, 65535]], dtype=numpy.uint32)]
+        self.expected = [
+            (100, cockpit.devices.ni_cRIOFPGA.joinTable(self.digitals).tolist()),
+            (200, [2**32 + 100]),
+            (201, [2**32, 20 * 2**32 + 65535]),
+        ]
+
+    def connect(self, tableEncoding):
+        connection = cockpit.devices.ni_cRIOFPGA.Connection(
+            None, '127.0.0.1', [self.server.port, None], '127.0.0.1',
+            tableEncoding=tableEncoding)
+        connection.connection = connection.createSendSocket(
+            '127.0.0.1', self.server.port, 5)
+        return connection
+
+    def sendTables(self, tableEncoding, progressCallback=None):
+        connection = self.connect(tableEncoding)
+        connection.sendTables(self.digitals, self.analogues,
+                              progressCallback=progressCallback)
+        connection.connection.close()
+        self.server.join(5)
+        self.assertEqual(self.server.commands[0][0], 409)
+        return self.server.commands[1:]
+
+    def test_decimal_tables(self):
+        commands = self.sendTables('decimal')
+        self.assertEqual([(c, v) for c, cluster, v in commands], self.expected)
+        self.assertEqual(commands[0][1]['Message Length'], 20)
+
+    def test_binary_tables(self):
+        progress = []
+        commands = self.sendTables('binary',
+                                   lambda *args: progress.append(args))
+        self.assertEqual([(c, v) for c, cluster, v in commands], self.expected)
+        self.assertEqual(progress[-1], (48, 48))
+
+    def test_binary_chunks(self):
+        self.digitals = numpy.arange(40000, dtype=numpy.uint32).reshape(-1, 2)
+        self.analogues = []
+        progress = []
+        commands = self.sendTables('binary',
+                                   lambda *args: progress.append(args))
+        self.assertEqual(commands[0][2],
+                         cockpit.devices.ni_cRIOFPGA.joinTable(self.digitals).tolist())
+        self.assertEqual(progress, [(65536, 160000), (131072, 160000),
+                                    (160000, 160000)])
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(ValueError):
+            self.connect('hex')
+        # Let the server finish.
+        socket.create_connection(('127.0.0.1', self.server.port)).close()
+
+
+if __name__ == '__main__':
+    unittest.main()
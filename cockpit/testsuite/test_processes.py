@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import unittest.mock
+
+import cockpit.util.processes
+
+
+def square(x):
+    return x * x
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+class TestImapBounded(unittest.TestCase):
+    def test_in_order(self):
+        tasks = [(square, (i,)) if i % 3 else (None, -i) for i in range(10)]
+        self.assertEqual(list(cockpit.util.processes.imapBounded(tasks)),
+                         [-0, 1, 4, -3, 16, 25, -6, 49, 64, -9])
+
+    def test_bounded(self):
+        numTaken = []
+        def getTasks():
+            for i in range(6):
+                numTaken.append(i)
+                yield (square, (i,))
+        results = cockpit.util.processes.imapBounded(getTasks(),
+                                                     maxPending = 2)
+        for i, result in enumerate(results):
+            self.assertEqual(result, i * i)
+            self.assertEqual(len(numTaken), min(i + 2, 6))
+
+    def test_no_pool_without_work(self):
+        with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor',
+                                 side_effect = AssertionError):
+            results = cockpit.util.processes.imapBounded(
+                    (None, i) for i in range(3))
+            self.assertEqual(list(results), [0, 1, 2])
+
+    def test_raises(self):
+        tasks = [(square, (1,)), (fail, ('bad',)), (square, (2,))]
+        results = cockpit.util.processes.imapBounded(tasks)
+        self.assertEqual(next(results), 1)
+        with self.assertRaisesRegex(ValueError, 'bad'):
+            next(results)
+
+    def test_stop_early(self):
+        results = cockpit.util.processes.imapBounded(
+                (square, (i,)) for i in range(100))
+        self.assertEqual(next(results), 0)
+        results.close()
+        self.assertEqual(list(results), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+
+import cockpit.gui.imageViewer.viewCanvas
+
+
+## The shifted average histogram as it used to be computed, with one
+# digitize per shifted bin set.
+def digitizeHistogram(data, nbins = 64, m = 4):
+    bins = numpy.linspace(data.min(), data.max(), nbins)
+    counts = numpy.zeros(nbins)
+    h = bins[1] - bins[0]
+    for i in range(m):
+        these = numpy.bincount(numpy.digitize(data.flat, bins + i*h/m,
+                                              right=True), minlength=nbins)
+        counts += these[0:nbins]
+    return bins, counts
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = cockpit.gui.imageViewer.viewCanvas.Histogram()
+        self.rng = numpy.random.RandomState(0)
+
+    def assertMatchesDigitize(self, data):
+        self.histogram.setData(data)
+        bins, counts = digitizeHistogram(data)
+        numpy.testing.assert_allclose(self.histogram.bins, bins)
+        numpy.testing.assert_array_equal(self.histogram.counts, counts)
+
+    def test_uint16(self):
+        data = self.rng.randint(100, 4000, (64, 48)).astype(numpy.uint16)
+        self.assertMatchesDigitize(data)
+        self.assertEqual((self.histogram.dataMin, self.histogram.dataMax),
+                         (data.min(), data.max()))
+
+    def test_uint8(self):
+        self.assertMatchesDigitize(
+            self.rng.randint(0, 256, (30, 30)).astype(numpy.uint8))
+
+    def test_float(self):
+        self.assertMatchesDigitize(self.rng.normal(size = (40, 50)))
+
+    def test_constant(self):
+        self.assertMatchesDigitize(numpy.full((8, 8), 7, dtype = numpy.uint16))
+
+    def test_subsampled(self):
+        self.histogram.maxSamples = 100
+        data = self.rng.randint(0, 1000, (100, 100)).astype(numpy.uint16)
+        data[1, 1] = 5000
+        self.histogram.setData(data)
+        # The range is exact, but only every 10th pixel on each axis
+        # is counted.
+        self.assertEqual(self.histogram.dataMax, 5000)
+        self.assertEqual(self.histogram.counts.sum(),
+                         data[::10, ::10].size * self.histogram.nshifts)
+
+
+if __name__ == '__main__':
+    unittest.main()
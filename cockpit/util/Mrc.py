@@ -52,11 +52,15 @@ http://www.msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
 
 Mrc class uses memory mapping (file size limit about 1GB (more or less)
 Mrc2 class section wise file/array I/O
+MrcWriter class positional, thread-safe writing of files of any size
 """
 
 __author__  = "Sebastian Haase <haase@msg.ucsf.edu>"
 
 
+import os
+import threading
+
 import numpy as N
 
 
@@ -671,6 +675,166 @@ class Mrc2:
             self.seekSec(0)
 
 
+class MrcWriter:
+    """
+    this class is for writing Mrc files of any size, section by section
+    and in any order, from any number of threads
+
+    the header given describes the whole file: hdr.Num, hdr.PixelType,
+    hdr.next, hdr.NumIntegers and hdr.NumFloats fix the offset of every
+    section and extended header record.  The file is created with its
+    full size; sections and records never written read as zeros.
+
+    writes are positional (os.pwrite / os.pwritev where available), so
+    threads do not share a file position and do not need to lock.
+
+    the header is written when the file is created, so that a partial
+    file can be read, and again on close, so that changes made to
+    self.hdr meanwhile (e.g. min/max values) end up in the file.
+
+    the file has the byte order of the header, e.g. that of a
+    byte-swapped file it was read from; sections of either byte order
+    are converted to it.
+    """
+    def __init__(self, path, hdr):
+        '''
+        path is filename - an existing file is overwritten
+        hdr is the header of the file, as from makeHdrArray
+        '''
+        self.hdr = hdr
+        self._path = path
+
+        nx, ny, nsecs = [int(n) for n in hdr.Num]
+        self._numSecs = nsecs
+        self._shape2d = (ny, nx)
+        byteorder = hdr._array.dtype['Num'].base.byteorder
+        self._dtype = N.dtype(MrcMode2dtype(hdr.PixelType)).newbyteorder(byteorder)
+        self._secByteSize = self._dtype.itemsize * nx * ny
+
+        self._hdrSize = 1024
+        self._extHdrSize = int(hdr.next)
+        self._extHdrBytesPerSec = 4 * (int(hdr.NumIntegers)
+                                       + int(hdr.NumFloats))
+        self._dataOffset = self._hdrSize + self._extHdrSize
+
+        # Only used where there is no positional write, to make each
+        # seek and write atomic.
+        self._lock = threading.Lock()
+
+        flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        self._fd = os.open(path, flags, 0o666)
+        try:
+            os.ftruncate(self._fd,
+                         self._dataOffset + nsecs * self._secByteSize)
+            self.writeHeader()
+        except:
+            os.close(self._fd)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def writeHeader(self):
+        self._writeAt([memoryview(self.hdr._array.tobytes())], 0)
+
+    def writeExtHeader(self, i, records):
+        """write records (e.g. an array of makeExtendedHeaderDtype in
+        cockpit.util.datadoc) to the extended header, starting with the
+        record of section i
+        """
+        data = _asBytes(records)
+        if not len(data):
+            return
+        if not self._extHdrBytesPerSec or len(data) % self._extHdrBytesPerSec:
+            raise ValueError("extended header data of %d bytes is not a"
+                             " whole number of records" % len(data))
+        offset = self._hdrSize + i * self._extHdrBytesPerSec
+        if i < 0 or offset + len(data) > self._dataOffset:
+            raise ValueError("extended header records %d to %d are beyond"
+                             " the extended header"
+                             % (i, i + len(data) // self._extHdrBytesPerSec))
+        self._writeAt([data], offset)
+
+    def writeSec(self, i, a, extRecord=None):
+        """write section i, and its extended header record if given
+        """
+        self.writeSecs(i, [a])
+        if extRecord is not None:
+            self.writeExtHeader(i, extRecord)
+
+    def writeSecs(self, i, arrays):
+        """write arrays, each of one or more whole sections, one after
+        the other from section i on - with a single vectored write where
+        possible
+        """
+        buffers = []
+        for a in arrays:
+            a = N.asarray(a)
+            if (a.dtype.newbyteorder('=') != self._dtype.newbyteorder('=')
+                    or a.shape[-2:] != self._shape2d):
+                raise ValueError("%s array of shape %s is not sections of"
+                                 " %s %s" % (a.dtype, a.shape,
+                                             self._dtype, self._shape2d))
+            a = a.astype(self._dtype, copy=False)
+            buffers.append(_asBytes(a))
+        numSecs = sum(len(b) for b in buffers) // self._secByteSize
+        if i < 0 or i + numSecs > self._numSecs:
+            raise ValueError("sections %d to %d are beyond the %d in the file"
+                             % (i, i + numSecs, self._numSecs))
+        self._writeAt(buffers, self._dataOffset + i * self._secByteSize)
+
+    def sync(self):
+        """make sure what has been written is on disk"""
+        os.fsync(self._fd)
+
+    def close(self):
+        """write the header and close the file"""
+        if self._fd is None:
+            return
+        try:
+            self.writeHeader()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def _writeAt(self, buffers, offset):
+        # Writes can be short, e.g. of over 2GB, so keep going until
+        # every buffer is written.
+        buffers = [b for b in buffers if len(b)]
+        while buffers:
+            if hasattr(os, 'pwritev'):
+                numBytes = os.pwritev(self._fd, buffers[:_IOV_MAX], offset)
+            elif hasattr(os, 'pwrite'):
+                numBytes = os.pwrite(self._fd, buffers[0], offset)
+            else:
+                with self._lock:
+                    os.lseek(self._fd, offset, os.SEEK_SET)
+                    numBytes = os.write(self._fd, buffers[0])
+            offset += numBytes
+            while numBytes:
+                if numBytes >= len(buffers[0]):
+                    numBytes -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][numBytes:]
+                    numBytes = 0
+
+
+def _asBytes(a):
+    """return an array as a memoryview of its bytes - copied only if it
+    is not contiguous
+    """
+    return memoryview(N.ascontiguousarray(a).reshape(-1).view(N.uint8))
+
+## Most buffers one os.pwritev can take.
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+
 ###########################################################################
 ###########################################################################
 ###########################################################################
@@ -58,23 +58,90 @@
 # utility functions for reading and writing MRC files and headers.
 
 from . import Mrc
+from . import processes
 
+import collections
+import concurrent.futures
+import functools
 import numpy
+import os
 import scipy.ndimage
+import tempfile
 import wx
 
 
 ## Maps dimensional axes to their labels.
 DIMENSION_LABELS = ['Wavelength', 'Time', 'Z', 'Y', 'X']
 
+## Maximum number of planes per wavelength used to estimate the averages
+# of a DataDoc.
+AVERAGE_SAMPLE_PLANES = 8
+## Maximum number of bytes of projections each DataDoc keeps.
+PROJECTION_CACHE_BUDGET = 2**29
+
+
+
+## Least recently used cache of the projections made by
+# DataDoc.takeProjectedSlice, up to a budget in bytes. Keys are tuples
+# that start with the projection's kind, 'raw' for projections of the
+# data as it is or 'aligned' for projections of transformed data, and
+# its wavelength.
+class ProjectionCache:
+    ## \param budget Maximum number of bytes of projections.
+    def __init__(self, budget = PROJECTION_CACHE_BUDGET):
+        self.budget = budget
+        ## Maps keys, least recently used first, to projections.
+        self.keyToProjection = collections.OrderedDict()
+        ## Total size of the projections.
+        self.numBytes = 0
+
+
+    ## Return the projection for the given key, or None if there is none.
+    def get(self, key):
+        projection = self.keyToProjection.get(key)
+        if projection is not None:
+            self.keyToProjection.move_to_end(key)
+        return projection
+
+
+    ## Add a projection, and make room for it.
+    def put(self, key, projection):
+        self.discard(key)
+        self.keyToProjection[key] = projection
+        self.numBytes += projection.nbytes
+        self.evict()
+
+
+    def discard(self, key):
+        projection = self.keyToProjection.pop(key, None)
+        if projection is not None:
+            self.numBytes -= projection.nbytes
+
+
+    ## Discard the aligned projections of the given wavelength, whose
+    # alignment has changed. Its raw projections are still valid.
+    def discardAligned(self, wavelength):
+        for key in list(self.keyToProjection):
+            if key[:2] == ('aligned', wavelength):
+                self.discard(key)
+
+
+    ## Discard the least recently used projections until we are within
+    # budget, but always keep the most recently used one.
+    def evict(self):
+        while self.numBytes > self.budget and len(self.keyToProjection) > 1:
+            key, projection = self.keyToProjection.popitem(last = False)
+            self.numBytes -= projection.nbytes
+
 
 
 ## The DataDoc class is, broadly, a wrapper around the Mrc module. When it
-# loads a file, it loads all of the data in that file, and then makes it
-# available as an array in WTZYX order (regardless of the order in which the
-# data is stored in the MRC file). It additionally exposes some attributes of
-# the MRC metadata, and provides functions for transforming and projecting
-# the data array.
+# loads a file, it makes the data in that file available as an array in
+# WTZYX order (regardless of the order in which the data is stored in the
+# MRC file). The array is a view of the memory-mapped file, so data is only
+# read from disk when it is used, and files larger than memory can be
+# opened. It additionally exposes some attributes of the MRC metadata, and
+# provides functions for transforming and projecting the data array.
 class DataDoc:
     ## Instantiate the object.
     # \param filename The filename of the MRC file you want to load.
@@ -112,11 +179,9 @@ class DataDoc:
         ## Datatype of our array.
         self.dtype = self.imageArray.dtype.type
 
-        ## Averages for each wavelength, used to provide fill values when
-        # taking slices.
-        self.averages = []
-        for wavelength in range(self.numWavelengths):
-            self.averages.append(self.imageArray[wavelength].mean())
+        ## Averages for each wavelength, computed when first needed; see
+        # the averages property.
+        self._averages = None
 
         ## Lower boundary of the cropped data.
         self.cropMin = numpy.array([0, 0, 0, 0, 0], numpy.int32)
@@ -140,11 +205,31 @@ class DataDoc:
         # action is necessary.
         self.alignCallbacks = []
 
+        ## Projections made by takeProjectedSlice.
+        self.projectionCache = ProjectionCache()
+
     def getNPlanes(self):
         return numpy.prod(self.size[0:3])
 
-    ## Convert the loaded MRC image data into a 5D array of pixel data in
-    # WTZYX order.
+    ## Averages for each wavelength, used to provide fill values when
+    # taking slices. These are estimated from at most
+    # AVERAGE_SAMPLE_PLANES planes of each wavelength, spread evenly
+    # through time and Z, so as not to read the whole file.
+    @property
+    def averages(self):
+        if self._averages is None:
+            numPlanes = self.size[1] * self.size[2]
+            sampled = numpy.linspace(0, numPlanes - 1,
+                    min(numPlanes, AVERAGE_SAMPLE_PLANES)).astype(int)
+            timepoints, zs = numpy.divmod(sampled, self.size[2])
+            self._averages = []
+            for wavelength in range(self.numWavelengths):
+                planes = self.imageArray[wavelength, timepoints, zs]
+                self._averages.append(planes.mean())
+        return self._averages
+
+    ## Return a view of the loaded MRC image data as a 5D array of pixel
+    # data in WTZYX order.
     def getImageArray(self):
         # This is a string describing the dimension ordering as stored in
         # the file.
@@ -161,15 +246,22 @@ class DataDoc:
     # a given wavelength, so we just have to transform the entire volume. It
     # gets *really* expensive if we want to do projections across time with
     # this...
-    # \todo We could be a bit more efficient here since only the wavelengths
-    # with nonzero rotation/scaling need to be transformed as volumes.
+    #
+    # Projections are made for each wavelength and kept in
+    # self.projectionCache, keyed by what they depend on: the projection
+    # axis, and for transformed data the wavelength's alignment parameters
+    # and, unless projecting through time, the current timepoint. Changing
+    # the alignment of one wavelength only makes its projections be made
+    # again. Volumes are transformed in parallel in worker processes.
     def takeProjectedSlice(self, axes, projectionAxis, shouldTransform,
             order = 1):
         if (projectionAxis == 2 or
                 (numpy.all(self.alignParams[:,3] == 0) and
                  numpy.all(self.alignParams[:,4] == 1))):
             # Scaling/rotation doesn't affect the projection; lucky us!
-            data = self.imageArray.max(axis = projectionAxis)
+            data = numpy.array([self.getRawProjection(wavelength,
+                                                      projectionAxis)
+                                for wavelength in range(self.size[0])])
             # Augment data with an extra dimension to replace the one we
             # flattened out.
             data = numpy.expand_dims(data, projectionAxis)
@@ -179,54 +271,102 @@ class DataDoc:
             return self.takeSliceFromData(data, axes, shouldTransform, order)
         elif projectionAxis in [3, 4]:
             # Projecting through Y or X; just transform the local volume.
-            dialog = wx.ProgressDialog(
-                    title = "Constructing projection",
-                    message = "Please wait...",
-                    maximum = self.size[0],
-                    style = wx.PD_AUTO_HIDE | wx.PD_REMAINING_TIME)
-            curTimepoint = self.curViewIndex[1]
-            data = []
-            for wavelength in range(self.size[0]):
-                data.append(self.transformArray(
-                        self.imageArray[wavelength, curTimepoint],
-                        *self.alignParams[wavelength],
-                        order = 1))
-                dialog.Update(wavelength)
-            data = numpy.array(data, dtype = self.dtype)
-            dialog.Destroy()
-            return data.max(axis = projectionAxis - 1)
+            data = self.getAlignedProjections(projectionAxis,
+                                              self.curViewIndex[1])
+            return numpy.array(data, dtype = self.dtype)
         else:
             # Projecting through time; transform EVERY volume. Ouch.
-            dialog = wx.ProgressDialog(
-                    title = "Constructing projection",
-                    message = "Please wait...",
-                    maximum = self.size[0] * self.size[1],
-                    style = wx.PD_AUTO_HIDE | wx.PD_REMAINING_TIME)
-            data = []
-            for timepoint in range(self.size[1]):
-                timeData = []
-                for wavelength in range(self.size[0]):
-                    volume = self.transformArray(
-                            self.imageArray[wavelength, timepoint],
-                            *self.alignParams[wavelength],
-                            order = 1)
-                    timeData.append(volume)
-                    dialog.Update(timepoint * self.size[0] + wavelength)
-                timeData = numpy.array(timeData, dtype = self.dtype)
-                data.append(timeData)
-
-            data = numpy.array(data, dtype = self.dtype)
-            data = data.max(axis = 0)
-            dialog.Destroy()
+            data = numpy.array(self.getAlignedProjections(projectionAxis),
+                               dtype = self.dtype)
             # Slice through data per our axes parameter.
-            slice = [Ellipsis] * 4
+            index = [slice(None)] * 4
             for axis, position in axes.items():
                 if axis != 1:
-                    slice[axis - 1] = position
-                    return data[slice]
+                    index[axis - 1] = position
+                    return data[tuple(index)]
             raise RuntimeError("Couldn't find a valid slice axis.")
 
 
+    ## Return the max-intensity projection of the given wavelength of our
+    # data, as it is, through the given axis. The projection is made in
+    # chunks along that axis, in parallel.
+    def getRawProjection(self, wavelength, projectionAxis):
+        key = ('raw', wavelength, projectionAxis)
+        projection = self.projectionCache.get(key)
+        if projection is None:
+            volume = self.imageArray[wavelength]
+            axis = projectionAxis - 1
+            numChunks = min(volume.shape[axis], os.cpu_count() or 1)
+            bounds = numpy.linspace(0, volume.shape[axis],
+                                    numChunks + 1).astype(int)
+            chunks = []
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                index = [slice(None)] * volume.ndim
+                index[axis] = slice(start, end)
+                chunks.append(volume[tuple(index)])
+            # numpy releases the GIL while it works, so threads suffice.
+            with concurrent.futures.ThreadPoolExecutor(numChunks) as pool:
+                maxima = list(pool.map(lambda chunk: chunk.max(axis = axis),
+                                       chunks))
+            projection = functools.reduce(numpy.maximum, maxima)
+            self.projectionCache.put(key, projection)
+        return projection
+
+
+    ## Return a list of the max-intensity projections of each wavelength's
+    # volume at the given timepoint, transformed by its alignment
+    # parameters, through the given axis. If timepoint is None, project
+    # through time instead, giving a volume for each wavelength.
+    def getAlignedProjections(self, projectionAxis, timepoint = None):
+        projections = []
+        # Maps wavelengths that have no projection yet to their keys.
+        missing = {}
+        for wavelength in range(self.size[0]):
+            key = ('aligned', wavelength, projectionAxis, timepoint,
+                   tuple(self.alignParams[wavelength]))
+            projections.append(self.projectionCache.get(key))
+            if projections[-1] is None:
+                missing[wavelength] = key
+        if not missing:
+            return projections
+
+        if timepoint is None:
+            timepoints = range(self.size[1])
+            # Project transformed volumes through time ourselves.
+            axis = None
+        else:
+            timepoints = [timepoint]
+            # Drop wavelength and time from WTZYX.
+            axis = projectionAxis - 2
+        tasks = [(wavelength, t) for wavelength in sorted(missing)
+                 for t in timepoints]
+        dialog = wx.ProgressDialog(
+                title = "Constructing projection",
+                message = "Please wait...",
+                maximum = len(tasks),
+                style = wx.PD_AUTO_HIDE | wx.PD_REMAINING_TIME)
+        # Volumes are only read in as the pool has room for them.
+        volumes = ((transformAndProject,
+                    (numpy.asarray(self.imageArray[wavelength, t]),
+                     self.alignParams[wavelength], self.dtype, axis))
+                   for wavelength, t in tasks)
+        results = processes.imapBounded(volumes)
+        try:
+            for numDone, ((wavelength, t), result) in enumerate(
+                    zip(tasks, results)):
+                if projections[wavelength] is not None:
+                    # Project through time as the volumes arrive.
+                    result = numpy.maximum(projections[wavelength], result)
+                projections[wavelength] = result
+                dialog.Update(numDone + 1)
+        finally:
+            results.close()
+            dialog.Destroy()
+        for wavelength, key in missing.items():
+            self.projectionCache.put(key, projections[wavelength])
+        return projections
+
+
     ## Generate a 2D slice of the given data in each wavelength. Since the
     # data is 5D (wavelength/time/Z/Y/X), there are three axes to be
     # perpendicular to, one of which is always wavelength. The "axes"
@@ -296,14 +436,13 @@ class DataDoc:
             return self.mapCoords(data, targetCoords, targetShape, axes, order)
         else:
             # Simply take an ordinary slice.
-            # Ellipsis is a builtin keyword for the full-array slice. Who knew?
-            slices = [Ellipsis]
+            slices = [slice(None)]
             for axis in range(1, 5):
                 if axis in axes:
                     slices.append(axes[axis])
                 else:
-                    slices.append(Ellipsis)
-            return data[slices]
+                    slices.append(slice(None))
+            return data[tuple(slices)]
 
 
     ## Inverse-transform the provided coordinates and use them to look up into
@@ -449,6 +588,7 @@ class DataDoc:
     ## Update the alignment parameters, then invoke our callbacks.
     def setAlignParams(self, wavelength, params):
         self.alignParams[wavelength] = params
+        self.projectionCache.discardAligned(wavelength)
         for callback in self.alignCallbacks:
             callback(self.alignParams)
 
@@ -461,6 +601,18 @@ class DataDoc:
     ## Apply our alignment parameters to the data, then crop them, and either
     # return the result for the specified wavelength(s), or save the result
     # to the specified file path. If no wavelengths are specified, use them all.
+    #
+    # Volumes are aligned one (timepoint, wavelength) pair at a time, in a
+    # pool of worker processes, and written to the file in order as they
+    # are done, so saving needs no more memory than the volumes in flight.
+    # Wavelengths with no transformation are only cropped, and are not
+    # sent to the workers.
+    # \param progressCallback If not None, a function that is called with
+    #        the number of volumes done and the total number of volumes,
+    #        after each volume.
+    # \param abortEvent If not None, a threading.Event that cancels the
+    #        operation when set. Nothing is returned, and a partly-written
+    #        file is removed.
     # \todo All of the logic dealing with the MRC file writing is basically
     # copied from the old imdoc module, and I don't claim to understand why it
     # does what it does.
@@ -468,7 +620,7 @@ class DataDoc:
     # to Eric we don't currently use the extended header anyway, so it was
     # just wasting space.
     def alignAndCrop(self, wavelengths = [], timepoints = [],
-            savePath = None):
+            savePath = None, progressCallback = None, abortEvent = None):
         if not wavelengths:
             wavelengths = range(self.size[0])
         if not timepoints:
@@ -478,6 +630,7 @@ class DataDoc:
         croppedShape = [len(wavelengths)]
         for min, max in zip(self.cropMin[1:], self.cropMax[1:]):
             croppedShape.append(max - min)
+        croppedShape[1] = len(timepoints)
         # Reorder to time/wavelength/z/y/x for saving.
         croppedShape[0], croppedShape[1] = croppedShape[1], croppedShape[0]
         croppedShape = tuple(croppedShape)
@@ -494,61 +647,97 @@ class DataDoc:
         newHeader.ImgSequence = 2
         newHeader.PixelType = Mrc.dtype2MrcMode(numpy.float32)
 
+        outputArray = None
+        writer = None
         if not savePath:
             outputArray = numpy.empty(croppedShape, numpy.float32)
         else:
+            outputPath = savePath
             if self.filePath == savePath:
-                # \todo Why do we do this?
-                del self.image.Mrc
-
-            # Write out the header.
-            outputFile = file(savePath, 'wb')
-            outputFile.write(newHeader._array.tostring())
+                # Our array maps the file we are saving over, so write to
+                # a new file and replace the old one once we are done.
+                handle, outputPath = tempfile.mkstemp(
+                        dir = os.path.dirname(os.path.abspath(savePath)))
+                os.close(handle)
+            writer = Mrc.MrcWriter(outputPath, newHeader)
 
         # Slices to use to crop out the 3D volume we want to use for each
         # wave-timepoint pair.
         volumeSlices = []
         for min, max in zip(self.cropMin[2:], self.cropMax[2:]):
             volumeSlices.append(slice(min, max))
+        volumeSlices = tuple(volumeSlices)
+
+        numVolumes = len(timepoints) * len(wavelengths)
+        results = processes.imapBounded(
+                self._getAlignTasks(wavelengths, timepoints, volumeSlices))
+        isComplete = False
+        try:
+            for numDone, volume in enumerate(results):
+                if abortEvent is not None and abortEvent.is_set():
+                    return
+                self._storeAlignedVolume(volume, numDone, len(wavelengths),
+                        outputArray, writer)
+                if progressCallback is not None:
+                    progressCallback(numDone + 1, numVolumes)
+            isComplete = True
+        finally:
+            # Stop any volumes still being aligned.
+            results.close()
+            if writer is not None:
+                writer.close()
+                if not isComplete:
+                    os.remove(outputPath)
+                elif outputPath != savePath:
+                    os.replace(outputPath, savePath)
 
+        if not savePath:
+            # Reorder to WTZYX since that's what the user expects.
+            return outputArray.transpose([1, 0, 2, 3, 4])
+
+
+    ## Generate the imapBounded tasks of alignAndCrop, which give each
+    # cropped volume in time/wavelength order.  Volumes that need no
+    # alignment are just cropped, here.
+    def _getAlignTasks(self, wavelengths, timepoints, volumeSlices):
         for timepoint in timepoints:
-            for waveIndex, wavelength in enumerate(wavelengths):
+            for wavelength in wavelengths:
                 volume = self.imageArray[wavelength][timepoint]
-
                 dx, dy, dz, angle, zoom = self.alignParams[wavelength]
                 if dz and self.size[2] == 1:
                     # HACK: no Z translate in 2D files. Even
-                    # infinitesimal translates will zero out the entire slice,
-                    # otherwise.
+                    # infinitesimal translates will zero out the entire
+                    # slice, otherwise.
                     dz = 0
                 if dx or dy or dz or angle or zoom != 1:
-                    # Transform the volume.
-                    volume = self.transformArray(
-                            volume, dx, dy, dz, angle, zoom
-                    )
-                # Crop to the desired shape.
-                volume = volume[volumeSlices].astype(numpy.float32)
-
-                if not savePath:
-                    outputArray[timepoint, waveIndex] = volume
+                    yield (alignVolume, (numpy.asarray(volume),
+                                         (dx, dy, dz, angle, zoom),
+                                         volumeSlices))
                 else:
-                    # Write to the file.
-                    for i, zSlice in enumerate(volume):
-                        outputFile.write(zSlice)
-
-        if not savePath:
-            # Reorder to WTZYX since that's what the user expects.
-            return outputArray.transpose([1, 0, 2, 3, 4])
+                    # Just crop to the desired shape.
+                    yield (None, volume[volumeSlices].astype(numpy.float32))
+
+
+    ## Store one volume from alignAndCrop, either in outputArray, or, if
+    # that is None, in its place in the file of writer. Volumes are
+    # numbered in time/wavelength order.
+    def _storeAlignedVolume(self, volume, index, numWavelengths,
+            outputArray, writer):
+        if outputArray is not None:
+            timeIndex, waveIndex = divmod(index, numWavelengths)
+            outputArray[timeIndex, waveIndex] = volume
         else:
-            outputFile.close()
+            writer.writeSecs(index * volume.shape[0], [volume])
 
 
-    ## Just save our array to the specified file.
+    ## Just save our array to the specified file. The planes are saved in
+    # the order of our file, along with its extended header, so that
+    # they match our header.
     def saveTo(self, savePath):
-        filehandle = open(savePath, 'wb')
-        writeMrcHeader(self.imageHeader, filehandle)
-        filehandle.write(self.imageArray)
-        filehandle.close()
+        with Mrc.MrcWriter(savePath, self.imageHeader) as writer:
+            writer.writeExtHeader(0, getExtendedHeaderArray(
+                    self.image.Mrc.e, self.imageHeader))
+            writer.writeSecs(0, [self.image])
 
 
     ## Get the size of a slice in the specified dimensions. Dimensions are as
@@ -599,29 +788,54 @@ class DataDoc:
         return numpy.divide(offsets, self.imageHeader.d)
 
 
-    ## Apply a transformation to an input 3D array in ZYX order. Angle rotates
-    # each slice, zoom scales each slice (i.e. neither is 3D).
+    ## Passthrough to the module-level transformArray.
     def transformArray(self, data, dx, dy, dz, angle, zoom, order = 3):
-        # Input angle is in degrees, but scipy's transformations expect angles
-        # in radians.
-        angle = angle * numpy.pi / 180
-        cosTheta = numpy.cos(-angle)
-        sinTheta = numpy.sin(-angle)
-        affineTransform = zoom * numpy.array(
-                [[cosTheta, sinTheta], [-sinTheta, cosTheta]])
-
-        invertedTransform = numpy.linalg.inv(affineTransform)
-        yxCenter = numpy.array(data.shape[1:]) / 2.0
-        offset = -numpy.dot(invertedTransform, yxCenter) + yxCenter
-
-        output = numpy.zeros(data.shape)
-        for i, slice in enumerate(data):
-            output[i] = scipy.ndimage.affine_transform(slice, invertedTransform,
-                    offset, output = numpy.float32, cval = slice.min(),
-                    order = order)
-        output = scipy.ndimage.interpolation.shift(output, [dz, dy, dx],
+        return transformArray(data, dx, dy, dz, angle, zoom, order)
+
+
+
+## Apply a transformation to an input 3D array in ZYX order. Angle rotates
+# each slice, zoom scales each slice (i.e. neither is 3D).
+def transformArray(data, dx, dy, dz, angle, zoom, order = 3):
+    # Input angle is in degrees, but scipy's transformations expect angles
+    # in radians.
+    angle = angle * numpy.pi / 180
+    cosTheta = numpy.cos(-angle)
+    sinTheta = numpy.sin(-angle)
+    affineTransform = zoom * numpy.array(
+            [[cosTheta, sinTheta], [-sinTheta, cosTheta]])
+
+    invertedTransform = numpy.linalg.inv(affineTransform)
+    yxCenter = numpy.array(data.shape[1:]) / 2.0
+    offset = -numpy.dot(invertedTransform, yxCenter) + yxCenter
+
+    output = numpy.zeros(data.shape)
+    for i, slice in enumerate(data):
+        output[i] = scipy.ndimage.affine_transform(slice, invertedTransform,
+                offset, output = numpy.float32, cval = slice.min(),
                 order = order)
-        return output
+    output = scipy.ndimage.interpolation.shift(output, [dz, dy, dx],
+            order = order)
+    return output
+
+
+## Transform a volume with the given (dx, dy, dz, angle, zoom) alignment
+# parameters, then crop it with the given tuple of slices, for
+# DataDoc.alignAndCrop. This is run in worker processes.
+def alignVolume(volume, alignParams, volumeSlices):
+    volume = transformArray(volume, *alignParams)
+    return volume[volumeSlices].astype(numpy.float32)
+
+
+## Transform a volume with the given (dx, dy, dz, angle, zoom) alignment
+# parameters, convert it to the given dtype, and return its max-intensity
+# projection through the given axis, or the whole volume if axis is None,
+# for DataDoc.getAlignedProjections. This is run in worker processes.
+def transformAndProject(volume, alignParams, dtype, axis):
+    volume = transformArray(volume, *alignParams, order = 1).astype(dtype)
+    if axis is None:
+        return volume
+    return volume.max(axis = axis)
 
 
 
@@ -679,7 +893,7 @@ def makeHeaderForShape(shape, dtype, XYSize = None, ZSize = None,
 ## Write just a header to the provided filehandle.
 def writeMrcHeader(header, filehandle):
     filehandle.seek(0)
-    filehandle.write(header._array.tostring())
+    filehandle.write(header._array.tobytes())
 
 
 ## Write out the provided data array as if it were an MRC file. Note that
@@ -692,40 +906,46 @@ def writeDataAsMrc(data, filename, XYSize = None, ZSize = None, wavelengths = []
         data.shape = [1] + list(data.shape)
     header = makeHeaderFor(data, XYSize = XYSize, ZSize = ZSize,
             wavelengths = wavelengths)
-    handle = open(filename, 'wb')
-    writeMrcHeader(header, handle)
-    handle.seek(1024) # Seek to end of header
-    handle.write(data)
-    handle.close()
+    with Mrc.MrcWriter(filename, header) as writer:
+        writer.writeSecs(0, [data])
+
+
+## Return the structured dtype of one plane's worth of extended header:
+# an 'int' field of numInts 32-bit ints followed by a 'float' field of
+# numFloats 32-bit floats.
+def makeExtendedHeaderDtype(numInts, numFloats):
+    return numpy.dtype([('int', numpy.int32, (numInts,)),
+                        ('float', numpy.float32, (numFloats,))])
+
+
+## Given a buffer of memory that contains the extended header, and the
+# standard header, return the extended header as a 1D array with one
+# record per plane, in the order the planes are stored in the file; see
+# makeExtendedHeaderDtype. The array is a view of the buffer, so if the
+# buffer is writable, e.g. a file memory-mapped in r+ mode, writing to the
+# array writes to the buffer.
+def getExtendedHeaderArray(data, header):
+    dtype = makeExtendedHeaderDtype(header.NumIntegers, header.NumFloats)
+    # \todo Assuming the 'Num' array is in XYZ order.
+    numPlanes = int(header.Num[2])
+    if not dtype.itemsize:
+        # There is no extended header, and nothing to view.
+        return numpy.zeros(numPlanes, dtype = dtype)
+    data = numpy.frombuffer(data, dtype = numpy.uint8)
+    return data[:numPlanes * dtype.itemsize].view(dtype)
 
 
 ## Given a buffer of memory that contains the extended header, and the
 # standard header, return the
 # extended header as two arrays: one of the ints, the other of the floats.
+# Both are views of the buffer.
 def getExtendedHeader(data, header):
     numWavelengths = header.NumWaves
-    # \todo Assuming the 'Num' array is in XYZ order.
-    imagesPerWavelength = header.Num[2] // numWavelengths
     numInts = header.NumIntegers
     numFloats = header.NumFloats
-    # Start with blank bytes; we'll type-convert later.
-    intArray = numpy.zeros(int(imagesPerWavelength * numWavelengths * numInts * 4),
-            dtype = numpy.uint8)
-    floatArray = numpy.zeros(int(imagesPerWavelength * numWavelengths * numFloats * 4),
-            dtype = numpy.uint8)
-    # Amount of memory per image allocated to ints.
-    intSize = int(numInts * 4)
-    # Ditto, for floats.
-    floatSize = int(numFloats * 4)
-    chunkSize = intSize + floatSize
-    # Load the extended header as a bytesequence.
-    for i in range(imagesPerWavelength * numWavelengths):
-        offset = int(i * chunkSize)
-        intArray[i * intSize : (i + 1) * intSize] = data[offset : offset + intSize]
-        floatArray[i * floatSize : (i + 1) * floatSize] = data[offset + intSize : offset + chunkSize]
-    # Cast to appropriate datatypes.
-    intArray.dtype = numpy.int32
-    floatArray.dtype = numpy.float32
+    extendedHeader = getExtendedHeaderArray(data, header)
+    intArray = extendedHeader['int']
+    floatArray = extendedHeader['float']
 
     # Set the array dimensions as if the arrays were of image data.
     # Use the X axis to store the ints/floats (the Y axis is unused).
@@ -742,8 +962,8 @@ def getExtendedHeader(data, header):
     for key in orderStr:
         if key in keyToSize:
             shape.append(keyToSize[key])
-    intArray.shape = tuple(shape + [numInts])
-    floatArray.shape = tuple(shape + [numFloats])
+    intArray = intArray.reshape(tuple(shape + [numInts]))
+    floatArray = floatArray.reshape(tuple(shape + [numFloats]))
     # Reorder the arrays to WTZYX order.
     if numInts:
         intArray = reorderArray(intArray,
@@ -776,18 +996,19 @@ def loadHeader(path):
 # the problem being that the shape of the array in the file is not padded
 # out with dimensions that are length 1 (e.g. a file with 1 wavelength).
 # So we pad out the array until it is five-dimensional, and then
-# rearrange its axes until its ordering is WTZYX.
+# rearrange its axes until its ordering is WTZYX. Only views are made, so
+# the data is not copied.
 def reorderArray(data, size, sequence):
     dimOrder = ['w', 't', 'z', 'y', 'x']
     vals = list(zip(size, dimOrder))
-    dataCopy = numpy.array(data)
+    dataView = numpy.asarray(data)
     # Find missing axes and pad the array until it has 5 axes.
     for val, key in vals[:-2]:
         # The W/T/Z dimensions are left off if they have
         # length 1.
-        if val == 1 and len(dataCopy.shape) < 5:
+        if val == 1 and len(dataView.shape) < 5:
             # The array is missing a dimension, so pad it out.
-            dataCopy = numpy.expand_dims(dataCopy, -1)
+            dataView = numpy.expand_dims(dataView, -1)
             if key in sequence:
                 # Remove the existing position for that key and add it to the
                 # end, since its existing position is actually wrong.
@@ -799,4 +1020,4 @@ def reorderArray(data, size, sequence):
     for val, key in vals:
         ordering.append(sequence.index(key))
 
-    return dataCopy.transpose(ordering)
+    return dataView.transpose(ordering)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module runs work in a pool of worker processes, for tasks that
+# hold the GIL for too long to run in threads.
+
+import collections
+import concurrent.futures
+import os
+
+
+## Return the number of tasks to keep in a pool of worker processes at
+# once: enough to keep every worker busy while the results are handled.
+def getMaxPending():
+    return 2 * (os.cpu_count() or 1)
+
+
+## Run each of the given tasks in a pool of worker processes, yielding
+# their results in the order of the tasks.
+#
+# Tasks are only taken from tasks as there is room for them, so that
+# their arguments, e.g. large arrays, and results do not pile up in
+# memory faster than they are handled.  The pool is only started once a
+# task needs it, and pending tasks are cancelled if the caller stops
+# early, or if a task raises, in which case its exception is raised here.
+# \param tasks Iterable of (function, args) pairs, where function must be
+#        importable by the workers.  A function of None means that args is
+#        already the result, which is yielded in order without using the
+#        pool.
+# \param maxPending Most tasks to have submitted and not yet yielded;
+#        defaults to getMaxPending().
+def imapBounded(tasks, maxPending = None):
+    if maxPending is None:
+        maxPending = getMaxPending()
+    pool = None
+    # Results, or futures that will return them, in the order of the tasks.
+    pending = collections.deque()
+    try:
+        for function, args in tasks:
+            if function is None:
+                pending.append(args)
+            else:
+                if pool is None:
+                    pool = concurrent.futures.ProcessPoolExecutor()
+                pending.append(pool.submit(function, *args))
+            while pending and (len(pending) >= maxPending or
+                               not isinstance(pending[0],
+                                              concurrent.futures.Future)):
+                yield _getResult(pending.popleft())
+        while pending:
+            yield _getResult(pending.popleft())
+    finally:
+        if pool is not None:
+            for item in pending:
+                if isinstance(item, concurrent.futures.Future):
+                    item.cancel()
+            pool.shutdown()
+
+
+def _getResult(item):
+    if isinstance(item, concurrent.futures.Future):
+        return item.result()
+    return item